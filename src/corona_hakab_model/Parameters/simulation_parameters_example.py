@@ -152,12 +152,14 @@
             testing_gap_after_negative_test=1,
             testing_priorities=[
                 DetectionPriority(
-                    lambda agent: (
-                            agent.medical_state.name == "Symptomatic" and
-                            agent not in agent.manager.tested_positive_vector),
-                    max_tests=100),
+                    lambda manager, agents: (
+                            in_medical_states(manager, agents, "Symptomatic") &
+                            np.logical_not(manager.tested_positive_vector[agents])),
+                    max_tests=100,
+                    vectorized=True),
                 DetectionPriority(
-                    lambda agent: agent.medical_state.name == "Recovered"),
+                    lambda manager, agents: in_medical_states(manager, agents, "Recovered"),
+                    vectorized=True),
             ]),
 
         DetectionSettings(
@@ -185,9 +187,11 @@
             testing_gap_after_negative_test=1,
             testing_priorities=[
                 DetectionPriority(
-                    lambda agent: agent.medical_state.name == "Symptomatic"),
+                    lambda manager, agents: in_medical_states(manager, agents, "Symptomatic"),
+                    vectorized=True),
                 DetectionPriority(
-                    lambda agent: agent.medical_state.name == "Recovered"),
+                    lambda manager, agents: in_medical_states(manager, agents, "Recovered"),
+                    vectorized=True),
             ]),
     ],
     "day_to_start_isolations": np.inf,
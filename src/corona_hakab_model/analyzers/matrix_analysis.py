@@ -27,6 +27,10 @@ def import_matrix_as_csr(matrix_data_path):
     lil_matrices = [lil_matrix((matrix_data.size, matrix_data.size)) for _ in range(matrix_data.depth)]
     for depth, index, conns, vals in matrix_data.matrix_assignment_data:
         lil_matrices[depth][index, conns] = vals
+    for depth, members, strength in matrix_data.clique_assignment_data:
+        rows, columns = np.meshgrid(members, members, indexing="ij")
+        not_self = rows != columns
+        lil_matrices[depth][rows[not_self], columns[not_self]] = strength
 
     # Convert lil_matrix to csr_matrix because it's easier to work with
     csr_matrices = [lil.tocsr() for lil in lil_matrices]
@@ -30,13 +30,12 @@ def _generate_agents_randomly(population_size, ages_to_dist: dict) -> List:
 
 
 def _infect_all_agents(list_of_agents, medical_machine_manager, medical_state_machine):
-    for agent in list_of_agents:
-        agent.medical_state = medical_state_machine.default_state_upon_infection
     medical_state_machine.default_state_upon_infection.add_many(list_of_agents)
 
     # take list of agents and create a pending transfer from their initial state to the next state
     medical_machine_manager.pending_transfers.extend(
-        medical_state_machine.default_state_upon_infection.transfer(list_of_agents)
+        medical_state_machine.default_state_upon_infection.transfer(
+            np.array([agent.index for agent in list_of_agents], dtype=np.int64))
     )
 
 
@@ -128,12 +127,11 @@ def monte_carlo_state_machine_analysis(configuration: Dict) -> Dict:
 
     state_counter = Counter({m.name: m.agent_count for m in medical_states})
     days_passed = 1
-    number_terminals_agents = 0
     empty_step = list()
-    while number_terminals_agents != population_size:
+    # once no transfers are pending, all the agents reached terminal states
+    while len(medical_machine_manager.pending_transfers):
         # No manager so we don't update it
         medical_machine_manager.step(empty_step)
-        number_terminals_agents = sum([m.agent_count for m in terminal_states])
         for m in medical_states:
             state_counter[m.name] += m.agent_count
         days_passed += 1
@@ -2,13 +2,14 @@ from __future__ import annotations
 
 from collections import defaultdict
 from dataclasses import dataclass
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List, Optional
+import numpy as np
 import pandas as pd
 from numpy import nan
 
 from .social_circle import SocialCircleConstraint
 from generation.connection_types import ConnectionTypes
-from .util import parse_str_to_num
+from .util import ColumnBuffer, parse_str_to_num
 
 if TYPE_CHECKING:
     from .medical_state import MedicalState
@@ -20,7 +21,7 @@ class Agent:
     This class represents a person in our doomed world.
     """
 
-    __slots__ = ("index", "medical_state", "manager", "age", "policy_props")
+    __slots__ = ("index", "manager", "age", "policy_props")
 
     # todo note that this changed to fit generation. should update simulation manager accordingly
     def __init__(self, index, age=None):
@@ -28,32 +29,23 @@ class Agent:
         self.age = age
         # don't know if this is necessary
         self.manager: SimulationManager = None
-        self.medical_state: MedicalState = None
         self.policy_props = defaultdict(bool)  # Properties that inserted/checked by the policies
 
-    def add_to_simulation(self, manager: SimulationManager, initial_state: MedicalState):
+    def add_to_simulation(self, manager: SimulationManager):
         self.manager = manager
-        self.set_medical_state_no_inform(initial_state)
 
-    def set_test_start(self):
-        self.manager.date_of_last_test[self.index] = self.manager.current_step
-
-    def set_test_result(self, test_result):
-        # TODO: add a property here
-        self.manager.tested_positive_vector[self.index] = test_result
-        self.manager.tested_vector[self.index] = True
-        if test_result:
-            self.manager.ever_tested_positive_vector[self.index] = True
-
-    def set_medical_state_no_inform(self, new_state: MedicalState):
-        self.medical_state = new_state
-        self.manager.contagiousness_vector[self.index] = new_state.contagiousness[self.age]
-
-        if new_state == self.manager.medical_machine.states_by_name["Deceased"]:
-            self.manager.living_agents_vector[self.index] = False
-
-        self.manager.susceptible_vector[self.index] = new_state.susceptible
-        self.manager.test_willingness_vector[self.index] = new_state.test_willingness
+    @property
+    def medical_state(self) -> Optional[MedicalState]:
+        """
+        the medical state of the agent, as held by the manager's medical state machine
+        """
+        if self.manager is None:
+            return None
+        machine = self.manager.medical_machine
+        state_index = machine.state_index[self.index]
+        if state_index == -1:
+            return None
+        return machine.states[state_index]
 
     def __str__(self):
         return f"<Person,  index={self.index}, medical={self.medical_state}>"
@@ -105,32 +97,70 @@ class AgentConstraint:
 
 
 class SickAgents:
+    """
+    A columnar log of infection events: the day, the infected agent (by index), and if known, its infector,
+    the connection type it was infected through and the medical state (by index) of its infector (-1 if unknown)
+    """
+
     def __init__(self):
-        self.agent_snapshots = []
-
-    def add_agent(self, agent_snapshot):
-        self.agent_snapshots.append(agent_snapshot)
-
-    def export(self, file_path):
-        num_sick = len(self.agent_snapshots)
-
-        export_dict = {"agent indexes": [nan] * num_sick, "geographic_circles": [nan] * num_sick,
-                       "age": [nan] * num_sick}
-        social_circles_num_agents = {f'{connection_type.name}_num_agents': [nan] * num_sick for connection_type in
-                                     ConnectionTypes}
-        social_circles_guid = {f'{connection_type.name}_guid': [nan] * num_sick for connection_type in ConnectionTypes}
-
-        for index, agent_snapshot in enumerate(self.agent_snapshots):
-            export_dict["agent indexes"][index] = agent_snapshot.index
-            export_dict["geographic_circles"][index] = agent_snapshot.geographic_circle
-            export_dict["age"][index] = agent_snapshot.age
-            for social_circle_snapshot in agent_snapshot.social_circles:
-                social_circles_num_agents[f'{social_circle_snapshot.type}_num_agents'][
-                    index] = social_circle_snapshot.num_members
-                social_circles_guid[f'{social_circle_snapshot.type}_guid'][index] = social_circle_snapshot.guid
-        export_dict = {**export_dict, **social_circles_num_agents, **social_circles_guid}
+        self.events = ColumnBuffer(dict(day=np.int32, agent=np.int64, infector=np.int64, connection_type=np.int8,
+                                        infector_state=np.int8))
+
+    def __len__(self):
+        return self.events.size
+
+    def add_agents(self, day: int, agents: np.ndarray, infectors: np.ndarray = None,
+                   connection_types: np.ndarray = None, infector_states: np.ndarray = None):
+        unknown = np.full(len(agents), -1)
+        self.events.extend(
+            day=np.full(len(agents), day),
+            agent=agents,
+            infector=unknown if infectors is None else infectors,
+            connection_type=unknown if connection_types is None else connection_types,
+            infector_state=unknown if infector_states is None else infector_states,
+        )
+
+    @staticmethod
+    def _names(names: List[str], codes: np.ndarray) -> np.ndarray:
+        """
+        the name of each code, nan for -1
+        """
+        return np.array(list(names) + [nan], dtype=object)[codes]
+
+    def export(self, file_path, manager: SimulationManager):
+        events = self.events.view()
+        agents = events["agent"]
+        population_size = len(manager.agents)
+
+        # the circles of the agents are joined from per agent circle codes of the population
+        geographic_circle_codes = np.full(population_size, -1)
+        for code, geographic_circle in enumerate(manager.geographic_circles):
+            geographic_circle_codes[[agent.index for agent in geographic_circle.agents]] = code
+        export_dict = {"agent indexes": agents,
+                       "geographic_circles": self._names([c.name for c in manager.geographic_circles],
+                                                         geographic_circle_codes[agents]),
+                       "age": manager.medical_machine.agent_ages[agents]}
+
+        social_circles_num_agents = {}
+        social_circles_guid = {}
+        for connection_type in ConnectionTypes:
+            circles = manager.social_circles_by_connection_type[connection_type]
+            circle_codes = np.full(population_size, -1)
+            for code, circle in enumerate(circles):
+                circle_codes[[agent.index for agent in circle.agents]] = code
+            codes = circle_codes[agents]
+            num_agents = np.append(np.array([circle.agent_count for circle in circles], dtype=float), nan)
+            social_circles_num_agents[f'{connection_type.name}_num_agents'] = num_agents[codes]
+            social_circles_guid[f'{connection_type.name}_guid'] = self._names([c.guid for c in circles], codes)
+
+        infection_dict = {"day": events["day"],
+                          "infector": np.where(events["infector"] == -1, nan, events["infector"]),
+                          "connection_type": self._names([c.name for c in ConnectionTypes], events["connection_type"]),
+                          "infector_medical_state": self._names([state.name for state in manager.medical_machine.states],
+                                                                events["infector_state"])}
+        export_dict = {**export_dict, **social_circles_num_agents, **social_circles_guid, **infection_dict}
         df_export_sick = pd.DataFrame(export_dict)
-        df_export_sick.to_csv(file_path, index=False)
+        manager.output_writer.submit(df_export_sick.to_csv, file_path, index=False)
 
 
 class InitialAgentsConstraints:
@@ -0,0 +1,92 @@
+import queue
+import threading
+from typing import Callable
+
+
+class SynchronousWriter:
+    """
+    runs each output job as soon as it is submitted. the default, when no background writer is given.
+    """
+
+    def submit(self, job: Callable, *args, **kwargs):
+        job(*args, **kwargs)
+
+    def join(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BackgroundWriter(SynchronousWriter):
+    """
+    runs output jobs (writing files, rendering figures) in order on a background thread,
+    so the simulation (or the next one) can go on while the results of the last one are written.
+    at most max_pending jobs wait at a time, submitting more blocks until one is done.
+    the first error of a job is raised again (once) in the thread that submits the next job, joins or closes the
+    writer. the writer stays failed: the jobs that are submitted after the error are skipped, and submitting once
+    it was raised is an error.
+    """
+
+    def __init__(self, max_pending: int = 16):
+        self._jobs = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._error_raised = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._work, name="background writer", daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    function, args, kwargs = job
+                    function(*args, **kwargs)
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._jobs.task_done()
+
+    def _raise_error(self):
+        if self._error is not None and not self._error_raised:
+            self._error_raised = True
+            raise self._error
+
+    def submit(self, job: Callable, *args, **kwargs):
+        if self._closed:
+            raise RuntimeError("the writer is closed")
+        self._raise_error()
+        if self._error is not None:
+            raise RuntimeError("the writer failed, its jobs are skipped") from self._error
+        self._jobs.put((job, args, kwargs))
+
+    def join(self):
+        """
+        wait for all the submitted jobs to be done
+        """
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        wait for all the submitted jobs to be done, and stop the thread
+        """
+        if not self._closed:
+            self._closed = True
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.close()
+        except Exception:
+            # an error in the body is more interesting than the one of the writer
+            if exc_type is None:
+                raise
@@ -1,27 +1,41 @@
 from __future__ import annotations
 from collections import Callable
 from dataclasses import dataclass
-from typing import Dict, List, NamedTuple
+from typing import Dict, List, Sequence, Tuple
 from copy import deepcopy
 from numpy import inf
 import numpy as np
 
-from .agent import Agent
 from .medical_state import MedicalState
 from .util import Queue
 
 
-class PendingTestResult(NamedTuple):
-    agent: Agent
-    test_result: bool
-    original_duration: int
+class PendingTestResults(Queue[Tuple[np.ndarray, np.ndarray]]):
+    """
+    a timing wheel of test results, each bucket holds (agent indices, test results) arrays of a future day
+    """
 
-    def duration(self):
-        return self.original_duration
-
-
-class PendingTestResults(Queue[PendingTestResult]):
-    pass
+    def push(self, agents: np.ndarray, test_results: np.ndarray, times_to_results: np.ndarray):
+        """
+        add the results of tests taken today, each ready after its time to result (at least a day)
+        """
+        if len(agents) == 0:
+            return
+        durations = np.maximum(times_to_results - 1, 0)
+        unique_durations, inverse = np.unique(durations, return_inverse=True)
+        for i, duration in enumerate(unique_durations):
+            in_duration = inverse == i
+            self.append_at((agents[in_duration], test_results[in_duration]), int(duration))
+
+    def pop(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        advance a day, and get the (agent indices, test results) of the tests whose results are ready
+        """
+        ready = self.advance()
+        if not ready:
+            return np.array([], dtype=int), np.array([], dtype=bool)
+        agents, test_results = zip(*ready)
+        return np.concatenate(agents), np.concatenate(test_results)
 
 
 class DetectionTest:
@@ -31,46 +45,71 @@ class DetectionTest:
         self.state_to_detection_prop = deepcopy(state_to_detection_prop)
         self.time_dist_until_result = time_dist_until_result
 
-    def get_times_to_get_results(self, number_of_agents=1):
-        if number_of_agents == 1:
-            return self.time_dist_until_result()
-        return self.time_dist_until_result(size=number_of_agents)
+    def get_detection_probs(self, states: Sequence[MedicalState]) -> np.ndarray:
+        """
+        the detection probability of each of the states, in the same order
+        """
+        return np.array([self.state_to_detection_prop[state.name] for state in states], dtype=float)
 
-    def test(self, agent: Agent):
-        detection_prob = self.state_to_detection_prop[agent.medical_state.name]
-        test_result = np.random.rand() < detection_prob
-        time_to_result = self.get_times_to_get_results()
-        pending_result = PendingTestResult(agent,
-                                           test_result,
-                                           time_to_result)
-        return pending_result
+    def test_many(self, detection_probs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        test many agents at once.
+        @param detection_probs: the detection probability of each tested agent (according to its medical state)
+        @return: the test results, and the number of days until each result is ready
+        """
+        test_results = np.random.random(len(detection_probs)) < detection_probs
+        times_to_results = np.asarray(self.time_dist_until_result(size=len(detection_probs)), dtype=int)
+        return test_results, times_to_results
 
 
 class DetectionPriority:
     def __init__(self,
                  func: Callable,
-                 max_tests: int = inf):
+                 max_tests: int = inf,
+                 vectorized: bool = False):
         """
         medical test for infection detection.
         supports max number of tests for its kind. if not specified, will be infinity.
         @param func: callable lambda or function that receives an agent and returns if should be tested.
                     should return bool.
+                    if vectorized, it receives the manager and an array of agent indices instead,
+                    and should return a bool mask of the agents that should be tested.
         @param max_tests: maximum number of tests allowed.
+        @param vectorized: whether func works on arrays of agent indices. much faster for big populations.
         """
 
         self.func = func
         self.max_tests = max_tests
+        self.vectorized = vectorized
         self.count = 0
 
-    def is_agent_prioritized(self, agent: Agent) -> bool:
+    def choose(self, manager, candidates: np.ndarray, num_of_tests: int) -> np.ndarray:
         """
-        activating the function on an agent. if exceeded the allowed number of tests, return false.
-        else: increase the counter and activate the function, return it's outcome.
+        choose which of the candidates to test. the candidates are given in a random order, so their first ones,
+        as many as can be tested (up to num_of_tests, and without exceeding max_tests), are a random sample of them.
+        the sampled candidates that are prioritized are chosen, whether func is vectorized or not.
+        @return: the positions of the chosen agents in candidates
         """
-        if self.count >= self.max_tests:
-            return False
-        self.count += 1
-        return self.func(agent)
+        limit = int(min(num_of_tests, self.max_tests - self.count))
+        if limit <= 0 or len(candidates) == 0:
+            return np.array([], dtype=int)
+        sampled = candidates[:limit]
+        if self.vectorized:
+            chosen = np.flatnonzero(self.func(manager, sampled))
+        else:
+            chosen = np.array([i for i, ind in enumerate(sampled) if self.func(manager.agents[ind])], dtype=int)
+        self.count += len(chosen)
+        return chosen
+
+
+def in_medical_states(manager, agents: np.ndarray, *state_names: str) -> np.ndarray:
+    """
+    a bool mask of the agents (by index) that are in one of the given medical states, for vectorized priorities
+    """
+    machine = manager.medical_machine
+    # the last entry is for agents without a state (whose index is -1)
+    is_in_states = np.array([state.name in state_names for state in machine.states] + [False])
+    return is_in_states[machine.state_index[agents]]
 
 
 @dataclass()
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Sequence, Union
+
+import numpy as np
+
+"""
+Overview:
+
+Discrete distributions of durations (in days).
+Each distribution samples many values at once,
+and is defined by a spec (its constructor arguments), so it can be exported and loaded back.
+Usage:
+1. Create a distribution - d = dist(1, 3) or d = Discrete([14, 28], [0.8, 0.2])
+2. Sample it - d.sample(size=100), or d(size=100) like the old dist functions
+"""
+
+RandomState = Union[np.random.Generator, np.random.RandomState]
+
+
+class Distribution(ABC):
+    @abstractmethod
+    def sample(self, size: Optional[int] = None, rng: Optional[RandomState] = None):
+        """
+        sample size values (or a single value if size is None), using rng (np.random if None)
+        """
+        pass
+
+    @abstractmethod
+    def spec(self) -> Dict:
+        """
+        the constructor arguments of the distribution
+        """
+        pass
+
+    def __call__(self, size: Optional[int] = None):
+        return self.sample(size)
+
+    def __getstate__(self):
+        return self.spec()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.spec() == other.spec()
+
+    def __hash__(self):
+        return hash(repr(self))
+
+    def __repr__(self):
+        args = ", ".join(f"{key}={value!r}" for key, value in self.spec().items())
+        return f"{type(self).__name__}({args})"
+
+
+class Constant(Distribution):
+    def __init__(self, value: int):
+        self.value = value
+
+    def sample(self, size=None, rng=None):
+        if size is None:
+            return self.value
+        return np.full(size, self.value)
+
+    def spec(self) -> Dict:
+        return dict(value=self.value)
+
+
+class UniformInt(Distribution):
+    """
+    uniform over the integers low to high, inclusive
+    """
+
+    def __init__(self, low: int, high: int):
+        if high < low:
+            raise ValueError("high must not be lower than low")
+        self.low = low
+        self.high = high
+
+    def sample(self, size=None, rng=None):
+        rng = rng or np.random
+        return self.low + np.floor(rng.random(size) * (self.high - self.low + 1)).astype(int)
+
+    def spec(self) -> Dict:
+        return dict(low=self.low, high=self.high)
+
+
+class OffsetBinomial(Distribution):
+    """
+    a binomial over low to high, whose mean is the given mean
+    """
+
+    def __init__(self, low: int, mean: float, high: int):
+        if not low <= mean <= high:
+            raise ValueError("mean must be between low and high")
+        self.low = low
+        self._mean = mean
+        self.high = high
+        self.n = high - low
+        self.p = (mean - low) / self.n if self.n else 0
+
+    def sample(self, size=None, rng=None):
+        rng = rng or np.random
+        return rng.binomial(n=self.n, p=self.p, size=size) + self.low
+
+    def spec(self) -> Dict:
+        return dict(low=self.low, mean=self._mean, high=self.high)
+
+
+class Discrete(Distribution):
+    """
+    an arbitrary distribution over the given values, sampled in O(1) per value using Walker's alias method
+    """
+
+    def __init__(self, values: Sequence[int], probs: Sequence[float]):
+        if len(values) != len(probs) or len(values) == 0:
+            raise ValueError("values and probs must be non-empty and of the same length")
+        if not np.isclose(np.sum(probs), 1) or np.min(probs) < 0:
+            raise ValueError("Probabilities must be non-negative and sum to 1")
+        self.values = list(values)
+        self.probs = list(probs)
+        self._values = np.array(self.values)
+        self._accept, self._alias = self._alias_table(np.array(self.probs, dtype=float) / np.sum(self.probs))
+
+    @staticmethod
+    def _alias_table(probs: np.ndarray):
+        """
+        split the probabilities into equal columns, each holding (at most) two values:
+        its own with probability accept, and its alias otherwise
+        """
+        scaled = probs * len(probs)
+        accept = np.ones(len(probs))
+        alias = np.arange(len(probs))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            accept[less] = scaled[less]
+            alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # whatever is left is 1 up to rounding errors
+        return accept, alias
+
+    def sample(self, size=None, rng=None):
+        rng = rng or np.random
+        columns = np.floor(rng.random(size) * len(self._values)).astype(int)
+        chosen = np.where(rng.random(size) < self._accept[columns], columns, self._alias[columns])
+        return self._values[chosen]
+
+    def spec(self) -> Dict:
+        return dict(values=self.values, probs=self.probs)
+
+
+def dist(*args) -> Distribution:
+    """
+    the distribution is selected by the number of arguments:
+    dist(a) is constant a, dist(a, b) is uniform over a..b, and dist(a, c, b) is an offset binomial over a..b whose
+    mean is c
+    """
+    if len(args) == 1:
+        return Constant(*args)
+    if len(args) == 2:
+        return UniformInt(*args)
+    if len(args) == 3:
+        return OffsetBinomial(*args)
+    raise TypeError
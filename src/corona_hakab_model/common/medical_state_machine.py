@@ -1,13 +1,53 @@
+from typing import Optional, Sequence
+
+import numpy as np
+
 from .medical_state import MedicalState
-from .state_machine import StateMachine
+from .state_machine import StateMachine, _bucket_indices
+
+
+class MedicalStateTables:
+    """
+    The attributes of the medical states, compiled to dense arrays indexed by state index,
+    so the attributes of many agents can be looked up (and written to the manager's vectors) at once.
+    contagiousness also depends on age, so it is indexed by [state index, age bucket id].
+    """
+
+    def __init__(self, states: Sequence[MedicalState]):
+        # the age buckets are refined to the union of all the states' contagiousness buckets
+        self.age_buckets = np.array(sorted({age for state in states for age in state.contagiousness.keys()}) or [0])
+        self.contagiousness = np.array([[state.contagiousness[age] for age in self.age_buckets] for state in states],
+                                       dtype=float)
+        self.susceptible = np.array([state.susceptible for state in states], dtype=bool)
+        self.test_willingness = np.array([state.test_willingness for state in states], dtype=float)
+        self.detectable = np.array([state.detectable for state in states], dtype=bool)
+        self.has_symptoms = np.array([state.has_symptoms for state in states], dtype=bool)
+        self.is_deceased = np.array([state.name == "Deceased" for state in states], dtype=bool)
+
+    def age_bucket_ids(self, ages: np.ndarray) -> np.ndarray:
+        """
+        the contagiousness age bucket id of each of the ages
+        """
+        return _bucket_indices(self.age_buckets, ages)
 
 
 class MedicalStateMachine(StateMachine[MedicalState]):
     def __init__(self, initial_state: MedicalState, default_state_upon_infection: MedicalState, **kwargs):
+        self._tables: Optional[MedicalStateTables] = None
         super().__init__(initial_state, **kwargs)
         self.default_state_upon_infection = default_state_upon_infection
         self.add_state(default_state_upon_infection)
 
+    def add_state(self, state: MedicalState):
+        super().add_state(state)
+        self._tables = None
+
+    @property
+    def tables(self) -> MedicalStateTables:
+        if self._tables is None:
+            self._tables = MedicalStateTables(self.states)
+        return self._tables
+
     def get_state_upon_infection(self, agent) -> MedicalState:
         if agent:  # placeholder
             pass
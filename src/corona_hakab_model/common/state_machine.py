@@ -1,31 +1,144 @@
 from __future__ import annotations
 
-import itertools
 from abc import ABC, abstractmethod
-from collections import defaultdict, Counter
-from typing import Collection, Dict, Generic, Iterable, List, NamedTuple, Optional, Set, Tuple, TypeVar, Union
+from collections import defaultdict
+from typing import Dict, Generic, Iterable, List, Optional, Sequence, Tuple, TypeVar, Union
 
 import numpy as np
 from .agent import Agent
-from .circle import TrackingCircle
-from .util import Queue, BucketDict
+from .util import BucketDict
 
 
-class PendingTransfer(NamedTuple):
-    agent: Agent
-    target_state: State
-    origin_state: State
-    original_duration: int
+class Transfers:
+    """
+    transfers of agents between states, as parallel arrays of agent indices, destination and origin state indices,
+    and the number of days until each transfer
+    """
+
+    __slots__ = ("agents", "destinations", "origins", "durations")
+
+    def __init__(self, agents: np.ndarray, destinations: np.ndarray, origins: np.ndarray, durations: np.ndarray):
+        self.agents = agents
+        self.destinations = destinations
+        self.origins = origins
+        self.durations = durations
+
+    def __len__(self):
+        return len(self.agents)
+
+    def __getitem__(self, item) -> Transfers:
+        return Transfers(self.agents[item], self.destinations[item], self.origins[item], self.durations[item])
+
+    @classmethod
+    def empty(cls) -> Transfers:
+        return cls(np.array([], dtype=np.int64), np.array([], dtype=np.int8), np.array([], dtype=np.int8),
+                   np.array([], dtype=int))
+
+    @classmethod
+    def concatenate(cls, transfers: Sequence[Transfers]) -> Transfers:
+        if not transfers:
+            return cls.empty()
+        if len(transfers) == 1:
+            return transfers[0]
+        return cls(*(np.concatenate([getattr(t, field) for t in transfers]) for field in cls.__slots__))
 
-    def duration(self) -> int:
-        return self.original_duration
 
+class _PendingTransfersBucket:
+    """
+    the transfers due on a single day, in growable typed arrays
+    """
+
+    __slots__ = ("agents", "destinations", "origins", "size")
+
+    def __init__(self, capacity: int = 0):
+        self.agents = np.empty(capacity, dtype=np.int64)
+        self.destinations = np.empty(capacity, dtype=np.int8)
+        self.origins = np.empty(capacity, dtype=np.int8)
+        self.size = 0
+
+    def extend(self, agents: np.ndarray, destinations: np.ndarray, origins: np.ndarray):
+        new_size = self.size + len(agents)
+        if new_size > len(self.agents):
+            capacity = max(new_size, 2 * len(self.agents))
+            for field in ("agents", "destinations", "origins"):
+                old = getattr(self, field)
+                new = np.empty(capacity, dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, field, new)
+        self.agents[self.size:new_size] = agents
+        self.destinations[self.size:new_size] = destinations
+        self.origins[self.size:new_size] = origins
+        self.size = new_size
+
+    def take(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        empty the bucket (keeping its capacity), and return copies of what it held
+        """
+        ret = self.agents[:self.size].copy(), self.destinations[:self.size].copy(), self.origins[:self.size].copy()
+        self.size = 0
+        return ret
 
-TransferCollection = Dict[int, List[PendingTransfer]]
 
+class PendingTransfers:
+    """
+    a timing wheel of pending transfers, with a bucket for each of the upcoming days
+    """
 
-class PendingTransfers(Queue[PendingTransfer]):
-    pass
+    def __init__(self):
+        self.buckets: List[_PendingTransfersBucket] = [_PendingTransfersBucket()]
+        self.next_ind = 0
+
+    def _resize(self, new_size):
+        """
+        resize the wheel to support new_size-length durations
+        """
+        self.buckets = self.buckets[self.next_ind:] + self.buckets[:self.next_ind] + \
+            [_PendingTransfersBucket() for _ in range(new_size - len(self.buckets))]
+        self.next_ind = 0
+
+    def extend(self, transfers: Transfers):
+        """
+        add the transfers, each to happen after its duration (at least a day)
+        """
+        if len(transfers) == 0:
+            return
+        keys = np.maximum(transfers.durations - 1, 0)
+        if keys.max() >= len(self.buckets):
+            self._resize(keys.max() + 1)
+        order = np.argsort(keys, kind="stable")
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        for key, start, end in zip(unique_keys, starts, ends):
+            in_key = order[start:end]
+            bucket = self.buckets[(self.next_ind + key) % len(self.buckets)]
+            bucket.extend(transfers.agents[in_key], transfers.destinations[in_key], transfers.origins[in_key])
+
+    def advance(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        advance a day
+        @return: the agents, destinations and origins of the transfers due today
+        """
+        ret = self.buckets[self.next_ind].take()
+        self.next_ind = (self.next_ind + 1) % len(self.buckets)
+        return ret
+
+    def peek_counts(self) -> np.ndarray:
+        """
+        the number of transfers due on each of the upcoming days (starting at the next advance)
+        """
+        return np.array([self.buckets[(self.next_ind + i) % len(self.buckets)].size
+                         for i in range(len(self.buckets))])
+
+    def __len__(self):
+        return sum(bucket.size for bucket in self.buckets)
+
+
+def _bucket_indices(buckets: np.ndarray, ages: np.ndarray) -> np.ndarray:
+    """
+    the index of the bucket of each age, same as a BucketDict lookup:
+    the first bucket that is not smaller than the age, or the last bucket
+    """
+    return np.minimum(np.searchsorted(buckets, ages, side="left"), len(buckets) - 1)
 
 
 class StochasticTransferGenerator:
@@ -40,6 +153,10 @@ class StochasticTransferGenerator:
         self.probs_cumulative = BucketDict({})
         self.destinations: List[State] = []
         self.durations = []
+        # compiled lazily from the above, for sampling many agents at once
+        self._age_buckets = None
+        self._cumulative_probs = None
+        self._duration_tables = None
 
     def prob_specific(self, ind: int, age: int) -> float:
         return self.probs_cumulative[age][ind]
@@ -60,57 +177,163 @@ class StochasticTransferGenerator:
 
         self.destinations.append(destination)
         self.durations.append(duration)
+        self._age_buckets = None
+
+    def _compile(self):
+        # the age buckets are refined to the union of the probability and duration buckets,
+        # so a single bucket id per agent determines both its destination row and its duration bucket
+        prob_buckets = np.array(sorted(self.probs_cumulative.keys()))
+        self._age_buckets = np.unique(np.concatenate(
+            [prob_buckets] + [np.array(sorted(duration.keys())) for duration in self.durations]))
+        cumulative_probs = np.cumsum([self.probs_cumulative[age] for age in prob_buckets], axis=1)
+        if not np.allclose(cumulative_probs[:, -1], 1):
+            raise ValueError("Probabilities do not sum to 1")
+        cumulative_probs[:, -1] = 1
+        cumulative_probs = cumulative_probs[_bucket_indices(prob_buckets, self._age_buckets)]
+        # shift the cumulative probabilities of each age bucket by its index,
+        # so a single searchsorted samples every agent from the row of its bucket
+        self._cumulative_probs = (cumulative_probs + np.arange(len(cumulative_probs))[:, None]).ravel()
+        self._duration_tables = []
+        for duration in self.durations:
+            duration_buckets = sorted(duration.keys())
+            self._duration_tables.append((_bucket_indices(np.array(duration_buckets), self._age_buckets),
+                                          [duration[age] for age in duration_buckets]))
+
+    @property
+    def bucket_count(self) -> int:
+        if self._age_buckets is None:
+            self._compile()
+        return len(self._age_buckets)
+
+    def bucket_ids(self, ages: np.ndarray) -> np.ndarray:
+        """
+        the age bucket id of each of the ages, to be passed to transfer
+        """
+        if self._age_buckets is None:
+            self._compile()
+        return _bucket_indices(self._age_buckets, ages)
+
+    def transfer(self, agents: np.ndarray, bucket_ids: np.ndarray, origin_state: State) -> Transfers:
+        if self._age_buckets is None:
+            self._compile()
+        # For each agent we sample its destination according to its age bucket
+        bucket_ids = bucket_ids.astype(int)
+        samples = np.random.random(len(agents)) + bucket_ids
+        dests = np.searchsorted(self._cumulative_probs, samples, side="right") - bucket_ids * len(self.destinations)
+
+        # For each destination and duration bucket, sample the number of days of all its agents at once
+        durations = np.zeros(len(agents), dtype=int)
+        for dest in np.unique(dests):
+            in_dest = np.flatnonzero(dests == dest)
+            duration_bucket_of, duration_dists = self._duration_tables[dest]
+            buckets = duration_bucket_of[bucket_ids[in_dest]]
+            for bucket in np.unique(buckets):
+                in_bucket = in_dest[buckets == bucket]
+                durations[in_bucket] = duration_dists[bucket](size=len(in_bucket))
+
+        state_indices = origin_state.machine.state_indices
+        destination_indices = np.array([state_indices[destination] for destination in self.destinations],
+                                       dtype=np.int8)
+        return Transfers(agents,
+                         destination_indices[dests],
+                         np.full(len(agents), state_indices[origin_state], dtype=np.int8),
+                         durations)
+
+
+class EverVisited:
+    """
+    a view of the agents that ever visited a state, backed by the state machine's bitset
+    """
+
+    __slots__ = ("state",)
+
+    def __init__(self, state: State):
+        self.state = state
+
+    def __len__(self):
+        if self.state.machine is None:
+            return 0
+        return int(self.state.machine.ever_visited_counts[self.state.index])
+
+    def __contains__(self, agent: Union[Agent, int]):
+        if self.state.machine is None:
+            return False
+        index = getattr(agent, "index", agent)
+        if index >= len(self.state.machine.state_index):
+            return False
+        return bool(self.state.machine.ever_visited_mask(self.state.index, np.array([index]))[0])
+
+    @property
+    def indices(self) -> np.ndarray:
+        if self.state.machine is None:
+            return np.array([], dtype=int)
+        return self.state.machine.ever_visited_indices(self.state.index)
+
+
+class State(ABC):
+    """
+    a state of a state machine.
+    the membership of agents in states is held by the machine, the state only offers views of it.
+    """
 
-    def transfer(self, agents: Set[Agent], origin_state: State) -> Iterable[PendingTransfer]:
-        ages_list = [_.age for _ in agents]
-        all_ages, ages_count = np.unique(ages_list, return_counts=True)
-
-        # For each age we sample as many transitions as people of that age
-        dests = {age: np.random.choice(a=len(self.destinations),
-                                       p=self.probs_cumulative[age],
-                                       size=num_of_ages) for num_of_ages, age in zip(ages_count, all_ages)}
-        # We have for each age, an array whose values is number of agents at that age transiting to the new state
-        # i.e. agents_dest_counts[10][1] - number of agents whose age is 10 and transition to self.destinations[1]
-        agents_dest_counts = {age: Counter(dict(np.stack(np.unique(dests[age],
-                                                                   return_counts=True),
-                                                         axis=1))) for age in all_ages}
-        # All possible combination of a state index and age
-        all_ages_and_dests = itertools.product(all_ages, range(len(self.destinations)))
-        # For each age and destination, sample enough number of days transitions according to appropriate age
-
-        agents_durations = {(age, dest): self.durations[dest][age](size=agents_dest_counts[age][dest])
-                            for age, dest in all_ages_and_dests}
-        pending_transfers = [None] * len(agents)
-        age_dest_index = Counter()
-        age_dest_duration_index = Counter()
-        # for each agent, create the pending transfer of the predetermined outcome.
-        for agent_index, agent in enumerate(agents):
-            agent_age = agent.age
-            current_dest_index = age_dest_index[agent_age]
-            agent_dest = dests[agent_age][current_dest_index] # Destination of current agent
-            current_duration_index = age_dest_duration_index[(agent_age, agent_dest)]
-            time_to_next_state = agents_durations[(agent.age, agent_dest)][current_duration_index]
-            pending_transfers[agent_index] = PendingTransfer(agent,
-                                                             self.destinations[agent_dest],
-                                                             origin_state,
-                                                             time_to_next_state)
-            age_dest_index[agent_age] += 1
-            age_dest_duration_index[(agent_age, agent_dest)] += 1
-        return pending_transfers
-
-
-class State(TrackingCircle, ABC):
     def __init__(self, name):
-        super().__init__()
         self.name = name
 
         self.machine: Optional[StateMachine] = None
+        self.ever_visited = EverVisited(self)
+
+    @property
+    def index(self) -> int:
+        return self.machine.state_indices[self]
+
+    @property
+    def agent_count(self) -> int:
+        if self.machine is None:
+            return 0
+        return int(self.machine.agent_counts[self.index])
+
+    @property
+    def agent_indices(self) -> np.ndarray:
+        """
+        the indices of the agents currently in the state
+        """
+        if self.machine is None:
+            return np.array([], dtype=int)
+        return np.flatnonzero(self.machine.state_index == self.index)
+
+    def add_many(self, agents: Iterable[Agent]):
+        agents = list(agents)
+        self.machine.add_agents(_agents_indices(agents), self.index,
+                                np.fromiter((agent.age for agent in agents), dtype=int, count=len(agents)))
+
+    def remove_many(self, agents: Iterable[Agent]):
+        self.machine.remove_agents(_agents_indices(agents), self.index)
+
+    def add_agent(self, agent: Agent):
+        self.add_many((agent,))
+
+    def remove_agent(self, agent: Agent):
+        self.remove_many((agent,))
 
     def _add_descendant(self, child: State):
         self.machine.add_state(child)
 
+    def _assert_no_agents(self):
+        assert self.machine is None or len(self.machine.state_index) == 0, \
+            "Cannot add new transfers after agents entered the machine!"
+
+    def bucket_ids_for_ages(self, ages: np.ndarray) -> Optional[np.ndarray]:
+        """
+        the age bucket id of each of the ages in this state, or None if the state does not bucket agents by age.
+        the machine calls this once per agent, when its age is set, and caches the result.
+        """
+        return None
+
     @abstractmethod
-    def transfer(self, agents: Collection[Agent]) -> Iterable[PendingTransfer]:
+    def transfer(self, agents: np.ndarray) -> Transfers:
+        """
+        sample the next state and the time until it, for each of the agents (by index) entering this state
+        """
         pass
 
     def __str__(self):
@@ -124,12 +347,18 @@ class StochasticState(State):
         self.generator = StochasticTransferGenerator()
 
     def add_transfer(self, destination: State, duration: BucketDict, probability: Union[float, type(...)]):
+        self._assert_no_agents()
         self.generator.add_transfer(destination, duration, probability)
 
         self._add_descendant(destination)
 
-    def transfer(self, agents: Set[Agent]) -> Iterable[PendingTransfer]:
-        return self.generator.transfer(agents, self)
+    def bucket_ids_for_ages(self, ages: np.ndarray) -> Optional[np.ndarray]:
+        if not self.generator.destinations or self.generator.bucket_count == 1:
+            return None
+        return self.generator.bucket_ids(ages)
+
+    def transfer(self, agents: np.ndarray) -> Transfers:
+        return self.generator.transfer(agents, self.machine.bucket_ids(self.index, agents), self)
 
     def prob_specific(self, ind: int) -> float:
         return self.generator.prob_specific(ind)
@@ -158,7 +387,6 @@ class AgentAwareState(State):
         # This dict will hold the different generators of the state, and will use the appropriate one based on traits
         # For now, this only takes note of age, meaning the dict is {age_range: StochasticTransferGenerator}
         self.generators = defaultdict(StochasticTransferGenerator)
-        self.agents_by_bucket = defaultdict(set)
         self.sorted_buckets = []
 
     def get_bucket_for_transfer(self, max_age):
@@ -172,23 +400,13 @@ class AgentAwareState(State):
             pass
         return max_age
 
-    def get_bucket_for_agent(self, agent):
-        """
-        Fit agent into bucket.
-        For now, buckets are the max age range.
-        """
-        for bucket in self.sorted_buckets:
-            if agent.age < bucket:
-                return bucket
-        raise ValueError(f"Agent doesnt have handler for state {self.__str__()}")
-
     def add_transfer(self, max_age, destination: State, duration: rv_discrete, probability: Union[float, type(...)]):
         """
         Add a new transfer to the correct bucket.
 
         TODO max_age is only temporary, it should be possible to be more specific
         """
-        assert self.agent_count == 0, "Cannot add new transfers after agents entered the state!"
+        self._assert_no_agents()
         bucket = self.get_bucket_for_transfer(max_age)
         self.generators[bucket].add_transfer(destination, duration, probability)
         self.sorted_buckets = sorted(self.generators)
@@ -218,100 +436,55 @@ class AgentAwareState(State):
         if len(self.sorted_buckets) == 1:
             return self.generators[self.sorted_buckets[0]].destinations
 
-    def transfer(self, agents: Set[Agent]) -> Iterable[PendingTransfer]:
+    def _bucket_offsets(self) -> np.ndarray:
         """
-        Run transfer on each bucket and return sum of PendingTransfer lists
+        the first bucket id of each generator. the ids of a generator's own age buckets follow it
         """
-        pending_transfers = []
-
-        # Sort each agent into the correct bucket
-        incoming_agents_by_bucket = defaultdict(set)
-        for agent in agents:
-            incoming_agents_by_bucket[self.get_bucket_for_agent(agent)].add(agent)
-
-        # transfer each agents group using the correct generator
-        for bucket, agents in incoming_agents_by_bucket.items():
-            # Extend list with each bucket's transfers
-            pending_transfers.extend(self.generators[bucket].transfer(agents, self))
-
-        return pending_transfers
-
-    def validate_agents_count(self):
-        """
-        Make sure the sum of all agent counts in all buckets is the same as the total agents count
-        """
-        agents_count_in_buckets = 0
-        for agents in self.agents_by_bucket.values():
-            agents_count_in_buckets += len(agents)
-        return agents_count_in_buckets == self.agent_count and self.agent_count == len(self.agents)
-
-    def add_agent(self, agent: Agent):
+        return np.cumsum([0] + [self.generators[bucket].bucket_count for bucket in self.sorted_buckets])
+
+    def bucket_ids_for_ages(self, ages: np.ndarray) -> Optional[np.ndarray]:
+        # For now, buckets are the max age range. agents too old for every bucket get -1
+        generator_of_ages = np.searchsorted(self.sorted_buckets, ages, side="right")
+        offsets = self._bucket_offsets()
+        bucket_ids = np.full(len(ages), -1, dtype=int)
+        for generator_index, bucket in enumerate(self.sorted_buckets):
+            in_generator = generator_of_ages == generator_index
+            bucket_ids[in_generator] = offsets[generator_index] + \
+                self.generators[bucket].bucket_ids(ages[in_generator])
+        return bucket_ids
+
+    def transfer(self, agents: np.ndarray) -> Transfers:
         """
-        Update agents_by_bucket - single agent
+        Run transfer on each bucket and concatenate the transfers
         """
-        super().add_agent(agent)
-        bucket = self.get_bucket_for_agent(agent)
-
-        # Sanity
-        assert agent not in self.agents_by_bucket[bucket], "Adding the same Agent into the same state twice!"
+        bucket_ids = self.machine.bucket_ids(self.index, agents)
+        if np.any(bucket_ids == -1):
+            raise ValueError(f"Agent doesnt have handler for state {self.__str__()}")
 
-        self.agents_by_bucket[bucket].add(agent)
-        # Sanity of counters
-        assert self.validate_agents_count()
-
-    def add_many(self, agents: Iterable[Agent]):
-        """
-        Update agents_by_bucket - slightly faster than updating each agent
-        """
-        super().add_many(agents)
-        added_agents_by_bucket = defaultdict(set)
-        # Sort agents into buckets
-        for agent in agents:
-            added_agents_by_bucket[self.get_bucket_for_agent(agent)].add(agent)
-        for bucket, agents in added_agents_by_bucket.items():
-            # Sanity
-            assert not self.agents_by_bucket[bucket].intersection(
-                agents
-            ), "Adding the same Agent into the same state twice!"
-
-            self.agents_by_bucket[bucket].update(agents)
-
-        # Sanity of counters
-        assert self.validate_agents_count()
-
-    def remove_agent(self, agent):
-        """
-        Opposite of add_agent
-        """
-        super().remove_agent(agent)
-        self.agents_by_bucket[self.get_bucket_for_agent(agent)].remove(agent)
-
-        # Sanity of counters
-        assert self.validate_agents_count()
-
-    def remove_many(self, agents):
-        """
-        Opposite on add_many
-        """
-        super().remove_many(agents)
-        removed_agents_by_bucket = defaultdict(set)
-        for agent in agents:
-            removed_agents_by_bucket[self.get_bucket_for_agent(agent)].add(agent)
-        for bucket, agents in removed_agents_by_bucket.items():
-            self.agents_by_bucket[bucket].difference_update(agents)
-
-        # Sanity of counters
-        assert self.validate_agents_count()
+        # transfer each agents group using the correct generator
+        offsets = self._bucket_offsets()
+        generator_of_agents = np.searchsorted(offsets, bucket_ids, side="right") - 1
+        return Transfers.concatenate([
+            self.generators[self.sorted_buckets[generator_index]].transfer(
+                agents[generator_of_agents == generator_index],
+                bucket_ids[generator_of_agents == generator_index] - offsets[generator_index],
+                self)
+            for generator_index in np.unique(generator_of_agents)
+        ])
 
 
 class TerminalState(State):
-    def transfer(self, agents: Set[Agent]) -> Iterable[PendingTransfer]:
-        return ()
+    def transfer(self, agents: np.ndarray) -> Transfers:
+        return Transfers.empty()
 
 
 T = TypeVar("T", bound=State)
 
 
+def _agents_indices(agents: Iterable[Agent]) -> np.ndarray:
+    return np.fromiter((agent.index for agent in agents), dtype=np.int64)
+
+
 class StateMachine(Generic[T]):
     def __init__(self, initial_state: T):
         self.initial: T = initial_state
@@ -320,6 +493,18 @@ class StateMachine(Generic[T]):
         self.state_indices = {initial_state: 0}
         self.states = [initial_state]
 
+        # the state each agent is in (-1 if none)
+        self.state_index = np.full(0, -1, dtype=np.int8)
+        self.agent_ages = np.zeros(0, dtype=int)
+        self.agent_counts = np.zeros(1, dtype=np.int64)
+        # a bitset for each state, of the agents that ever visited it
+        self.ever_visited_bits = np.zeros((1, 0), dtype=np.uint8)
+        self.ever_visited_counts = np.zeros(1, dtype=np.int64)
+        # the age bucket id of each agent, for each state that buckets agents by age
+        self.age_bucket_ids: Dict[int, np.ndarray] = {}
+
+        initial_state.machine = self
+
     def __getitem__(self, item: Union[str, Tuple[str, ...]]):
         if isinstance(item, str):
             return self.states_by_name[item]
@@ -331,7 +516,104 @@ class StateMachine(Generic[T]):
         if state not in self.state_indices:
             self.state_indices[state] = len(self.state_indices)
             self.states.append(state)
+            self.agent_counts = np.append(self.agent_counts, 0)
+            self.ever_visited_counts = np.append(self.ever_visited_counts, 0)
+            self.ever_visited_bits = np.vstack(
+                (self.ever_visited_bits, np.zeros((1, self.ever_visited_bits.shape[1]), dtype=np.uint8)))
 
         state.machine = self
 
+    def _reserve(self, population_size: int):
+        """
+        make sure agents with indices up to population_size can be held
+        """
+        if population_size <= len(self.state_index):
+            return
+        population_size = max(population_size, 2 * len(self.state_index))
+        self.agent_ages = np.concatenate((self.agent_ages, np.zeros(population_size - len(self.state_index), dtype=int)))
+        self.state_index = np.concatenate(
+            (self.state_index, np.full(population_size - len(self.state_index), -1, dtype=np.int8)))
+        bits = np.zeros((len(self.states), (population_size + 7) // 8), dtype=np.uint8)
+        bits[:, :self.ever_visited_bits.shape[1]] = self.ever_visited_bits
+        self.ever_visited_bits = bits
+        for state_index, bucket_ids in self.age_bucket_ids.items():
+            self.age_bucket_ids[state_index] = np.concatenate(
+                (bucket_ids, np.zeros(population_size - len(bucket_ids), dtype=bucket_ids.dtype)))
+
+    def _assign_age_buckets(self, agents: np.ndarray, ages: np.ndarray):
+        """
+        compute the age bucket of each agent in every state, once, when its age is set
+        """
+        for state in self.states:
+            bucket_ids = state.bucket_ids_for_ages(ages)
+            if bucket_ids is None:
+                continue
+            if state.index not in self.age_bucket_ids:
+                self.age_bucket_ids[state.index] = np.zeros(len(self.state_index), dtype=np.int16)
+            self.age_bucket_ids[state.index][agents] = bucket_ids
+
+    def bucket_ids(self, state_index: int, agents: np.ndarray) -> np.ndarray:
+        """
+        the cached age bucket id of each agent (by index) in a state
+        """
+        if state_index not in self.age_bucket_ids:
+            return np.zeros(len(agents), dtype=np.int16)
+        return self.age_bucket_ids[state_index][agents]
+
+    def ever_visited_mask(self, state_indices: Union[int, np.ndarray], agents: np.ndarray) -> np.ndarray:
+        """
+        whether each of the agents ever visited the respective state
+        """
+        return ((self.ever_visited_bits[state_indices, agents >> 3] >> (agents & 7).astype(np.uint8)) & 1) \
+            .astype(bool)
+
+    def ever_visited_indices(self, state_index: int) -> np.ndarray:
+        visited = np.unpackbits(self.ever_visited_bits[state_index], bitorder="little")
+        return np.flatnonzero(visited[:len(self.state_index)])
+
+    def _visit(self, agents: np.ndarray, state_indices: Union[int, np.ndarray]):
+        state_indices = np.broadcast_to(state_indices, agents.shape)
+        first_visit = np.logical_not(self.ever_visited_mask(state_indices, agents))
+        np.add.at(self.ever_visited_counts, state_indices[first_visit], 1)
+        np.bitwise_or.at(self.ever_visited_bits, (state_indices, agents >> 3),
+                         np.left_shift(1, agents & 7).astype(np.uint8))
+
+    def add_agents(self, agents: np.ndarray, state_index: int, ages: Optional[np.ndarray] = None):
+        """
+        add agents (by index) to a state, without removing them from their current state
+        """
+        if len(agents) == 0:
+            return
+        self._reserve(agents.max() + 1)
+        if ages is not None:
+            self.agent_ages[agents] = ages
+            self._assign_age_buckets(agents, ages)
+        if np.any(self.state_index[agents] == state_index) or len(np.unique(agents)) != len(agents):
+            raise ValueError("DuplicateAgent")
+        self.state_index[agents] = state_index
+        self.agent_counts[state_index] += len(agents)
+        self._visit(agents, state_index)
+
+    def remove_agents(self, agents: np.ndarray, state_index: int):
+        """
+        remove agents (by index) from a state. agents whose state was not replaced are left with no state
+        """
+        if len(agents) == 0:
+            return
+        self.agent_counts[state_index] -= len(agents)
+        left = agents[self.state_index[agents] == state_index]
+        self.state_index[left] = -1
+
+    def move_agents(self, agents: np.ndarray, origins: np.ndarray, destinations: np.ndarray):
+        """
+        move each agent (by index) from its origin state to its destination state
+        """
+        if len(agents) == 0:
+            return
+        assert np.array_equal(self.state_index[agents], origins), "Agents are not in their origin states"
+        self.agent_counts += np.bincount(destinations, minlength=len(self.states)) - \
+            np.bincount(origins, minlength=len(self.states))
+        self.state_index[agents] = destinations
+        self._visit(agents, destinations)
+
     # todo function to draw a pretty graph
@@ -0,0 +1,117 @@
+import cProfile
+import json
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+
+class StepProfiler:
+    """
+    Records the wall time of each phase of every simulation step.
+    Phases may be nested, in which case the time of the inner phase is not counted in the outer one.
+    If given a profile path, the steps in profile_steps (first and last, inclusive) are also run under cProfile,
+    and the stats are saved to the path on export.
+    """
+
+    PHASES = (
+        "policies",
+        "healthcare testing",
+        "isolation",
+        "matrix infection",
+        "random connections infection",
+        "infection logging",
+        "medical transitions",
+        "supervisor snapshot",
+    )
+
+    def __init__(self, matrix=None, profile_path: Optional[str] = None,
+                 profile_steps: Optional[Tuple[int, int]] = None):
+        self.matrix = matrix
+        self.records: List[Dict[str, float]] = []
+        self.current: Dict[str, float] = dict.fromkeys(self.PHASES, 0.0)
+        # the time of the phases nested in each of the open phases
+        self._nested_times: List[float] = []
+        self._matrix_counters = self._read_matrix_counters()
+
+        self.profile_path = profile_path
+        self.profile_steps = profile_steps
+        self.cprofile = cProfile.Profile() if profile_path else None
+        self._profiling = False
+
+    def _read_matrix_counters(self) -> Tuple[Optional[int], Optional[float]]:
+        # not every matrix backend counts its rebuilds
+        return getattr(self.matrix, "rebuild_count", None), getattr(self.matrix, "rebuild_time", None)
+
+    def _should_profile(self, step: int) -> bool:
+        if self.cprofile is None:
+            return False
+        if self.profile_steps is None:
+            return True
+        first, last = self.profile_steps
+        return first <= step <= last
+
+    def start_step(self, step: int):
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.current["step"] = step
+        self._step_start = perf_counter()
+        if self._should_profile(step):
+            self.cprofile.enable()
+            self._profiling = True
+
+    def end_step(self):
+        if self._profiling:
+            self.cprofile.disable()
+            self._profiling = False
+        self.current["total"] = perf_counter() - self._step_start
+
+        rebuild_count, rebuild_time = self._read_matrix_counters()
+        previous_count, previous_time = self._matrix_counters
+        self.current["matrix rebuilds"] = rebuild_count - previous_count if rebuild_count is not None else None
+        self.current["matrix rebuild time"] = rebuild_time - previous_time if rebuild_time is not None else None
+        self._matrix_counters = rebuild_count, rebuild_time
+
+        self.records.append(self.current)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+        self._nested_times.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.current[name] += elapsed - self._nested_times.pop()
+            if self._nested_times:
+                self._nested_times[-1] += elapsed
+
+    def total(self) -> float:
+        """
+        the time of the phases of the current step so far
+        """
+        return sum(self.current[phase] for phase in self.PHASES)
+
+    def report(self) -> pd.DataFrame:
+        columns = ["step", *self.PHASES, "total", "matrix rebuilds", "matrix rebuild time"]
+        return pd.DataFrame(self.records, columns=columns).set_index("step")
+
+    def export(self, folder):
+        """
+        write the timing report of all the steps to step_times.json and step_times.csv in folder,
+        and the cProfile stats to the profile path
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        report = self.report()
+        report.to_csv(folder / "step_times.csv")
+        # the totals of the matrix rebuilds are unknown (null) if the matrix backend does not count them
+        totals = report.sum(min_count=1)
+        summary = {"totals": {name: None if pd.isna(value) else value for name, value in totals.items()},
+                   "steps": self.records}
+        with open(folder / "step_times.json", "w") as json_file:
+            json.dump(summary, json_file, indent=2)
+
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(self.profile_path)
@@ -1,36 +1,9 @@
 from abc import abstractmethod
 from collections import OrderedDict
-from typing import Generic, List, Protocol, TypeVar
-from functools import partial
+from typing import Any, Dict, Generic, List, Protocol, TypeVar, Union
 import numpy as np
 
 
-def dist(*args):
-    def const_dist(a):
-        return partial(lambda size=None: np.random.choice([a], size=size))
-
-    def uniform_dist(a, b):
-        range_to_choose_from = list(range(a, b+1))
-        return partial(lambda size=None: np.random.choice(range_to_choose_from, size=size))
-
-    def off_binom(a, c, b):
-        # todo I have no idea what this distribution supposedly represents, we're gonna pretend it's
-        #  an offset-binomial whose mean is c and call it a day
-        n = b-a
-        p = (c-a)/(b-a)
-        return partial(lambda size=None: np.random.binomial(n=n,
-                                                            p=p,
-                                                            size=size) + a)
-
-    if len(args) == 1:
-        return const_dist(*args)
-    if len(args) == 2:
-        return uniform_dist(*args)
-    if len(args) == 3:
-        return off_binom(*args)
-    raise TypeError
-
-
 def parse_str_to_num(val):
     try:
         return int(val)
@@ -92,6 +65,69 @@ class Queue(Generic[T]):
         return ret
 
 
+class IndexQueue(Queue[np.ndarray]):
+    """
+    a queue of agent indices, bucketed by the (absolute) day they are due in.
+    each bucket holds arrays of indices rather than python objects, so pushing and popping many agents is cheap.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.first_day = 0  # the day of the bucket at next_ind
+
+    def push(self, indices: np.ndarray, days: Union[int, np.ndarray]):
+        """
+        schedule each of the indices to pop out on its given day
+        """
+        indices = np.asarray(indices)
+        if len(indices) == 0:
+            return
+        durations = np.broadcast_to(np.asarray(days) - self.first_day, indices.shape)
+        if durations.min() < 0:
+            raise ValueError("Can't schedule agents to a day that already passed")
+        unique_durations, inverse = np.unique(durations, return_inverse=True)
+        for i, duration in enumerate(unique_durations):
+            self.append_at(indices[inverse == i], int(duration))
+
+    def pop(self, day: int) -> np.ndarray:
+        """
+        pop all the indices due on the given day. indices of days skipped on the way are dropped.
+        """
+        while self.first_day < day:
+            self.advance()
+            self.first_day += 1
+        ret = self.advance()
+        self.first_day += 1
+        if not ret:
+            return np.array([], dtype=int)
+        return np.concatenate(ret)
+
+
+class ColumnBuffer:
+    """
+    preallocated columns of a table, that grow (by doubling) as rows are appended to them
+    """
+
+    def __init__(self, dtypes: Dict[str, Any], capacity: int = 1024):
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in dtypes.items()}
+        self.size = 0
+
+    def extend(self, **columns: np.ndarray):
+        rows = len(next(iter(columns.values())))
+        capacity = len(next(iter(self.columns.values())))
+        if self.size + rows > capacity:
+            capacity = max(2 * capacity, self.size + rows)
+            for name, column in self.columns.items():
+                self.columns[name] = np.empty(capacity, dtype=column.dtype)
+                self.columns[name][:self.size] = column[:self.size]
+        for name, values in columns.items():
+            self.columns[name][self.size:self.size + rows] = values
+        self.size += rows
+
+    def view(self) -> Dict[str, np.ndarray]:
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+
 K = TypeVar("K")
 V = TypeVar("K")
 
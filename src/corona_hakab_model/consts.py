@@ -1,18 +1,19 @@
 import os
 from functools import lru_cache
-from typing import Dict, List, NamedTuple, Union, Callable
+from typing import Dict, List, NamedTuple, Union
 import jsonpickle
 import numpy as np
 from numpy.random import random
 
-from common.detection_testing_types import DetectionSettings, DetectionPriority, DetectionTest
+from common.detection_testing_types import DetectionSettings, DetectionPriority, DetectionTest, in_medical_states
 from common.isolation_types import IsolationTypes
 from generation.connection_types import ConnectionTypes
 from common.medical_state import ContagiousState, ImmuneState, SusceptibleState
 from common.medical_state_machine import MedicalStateMachine
 from policies_manager import ConditionedPolicy, Policy
 from common.state_machine import StochasticState, TerminalState
-from common.util import dist, BucketDict
+from common.distributions import Constant, Discrete, Distribution, OffsetBinomial, UniformInt, dist
+from common.util import BucketDict
 
 TransitionProbType = BucketDict[int, Union[float, type(...)]]
 IsolationFactorsType = Dict[IsolationTypes, Dict[ConnectionTypes, float]]
@@ -61,47 +62,48 @@ class Consts(NamedTuple):
     # Tsvika: Currently the distribution is selected based on the number of input parameters.
     # Think we should do something more readable later on.
     # For example: "latent_presymp_to_pre_symptomatic_days": {"type":"uniform","lower_bound":1,"upper_bound":3}
+    # The actual distributions below can be used as Discrete(values, probs)
     # disease states transition lengths distributions
 
     # Binomial distribution for all ages
-    latent_presymp_to_pre_symptomatic_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 3, 10)})
+    latent_presymp_to_pre_symptomatic_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 3, 10)})
 
-    latent_to_latent_asymp_begin_days: BucketDict[int, Callable] = BucketDict({0: dist(1)})
-    latent_to_latent_presymp_begin_days: BucketDict[int, Callable] = BucketDict({0: dist(1)})
+    latent_to_latent_asymp_begin_days: BucketDict[int, Distribution] = BucketDict({0: dist(1)})
+    latent_to_latent_presymp_begin_days: BucketDict[int, Distribution] = BucketDict({0: dist(1)})
 
     # Actual distribution: rv_discrete(values=([1,2,3,4,5,6,7,8,9,10],
     # [0.022,0.052,0.082,0.158,0.234,0.158,0.152,0.082,0.04,0.02]))
-    latent_asym_to_asymptomatic_begin_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 3, 10)})
+    latent_asym_to_asymptomatic_begin_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 3, 10)})
     # Actual distribution: rv_discrete(values=([1,2,3,4,5,6,7,8,9,10,11],
     # [0.02,0.05,0.08,0.15,0.22,0.15,0.15,0.08,0.05,0.03,0.02]))
-    asymptomatic_begin_to_asymptomatic_end_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 3, 5)})
-    pre_symptomatic_to_mild_condition_begin_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 3)})
-    mild_condition_begin_to_mild_condition_end_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 3, 5)})
-    mild_end_to_close_medical_care_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 8)})
+    asymptomatic_begin_to_asymptomatic_end_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 3, 5)})
+    pre_symptomatic_to_mild_condition_begin_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 3)})
+    mild_condition_begin_to_mild_condition_end_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 3, 5)})
+    mild_end_to_close_medical_care_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 8)})
     # Actual distribution: rv_discrete(values=([3,4,5,6,7,8,9,10,11,12],
     # [0.11,0.11,0.11,0.11,0.11,0.11,0.11,0.11,0.11,0.01]))
-    mild_end_to_need_icu_days: BucketDict[int, Callable] = BucketDict({0: dist(3, 10, 26)})
+    mild_end_to_need_icu_days: BucketDict[int, Distribution] = BucketDict({0: dist(3, 10, 26)})
     # Actual distribution: rv_discrete(values=([6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29],
     # [0.012,0.019,0.032,0.046,0.059,0.069,0.076,0.078,0.076,0.072,0.066,0.060,0.053,0.046,0.040,0.035,0.030,0.028,0.026,0.022,0.020,0.015,0.010,0.010]))
-    mild_end_to_pre_recovered_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 13, 23)})
+    mild_end_to_pre_recovered_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 13, 23)})
     # Actual distribution: rv_discrete(values=(
     # [1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28],
     # [0.001,0.001,0.001,0.001,0.001,0.002,0.004,0.008,0.013,0.022,0.032,0.046,0.06,0.075,0.088,0.097,0.1,0.098,0.088,0.075,0.06,0.046,0.032,0.022,0.013,0.008,0.004,0.002]))
-    close_medical_care_to_icu_days: BucketDict[int, Callable] = BucketDict({0: dist(10, 12, 14)})
-    close_medical_care_to_mild_end_days: BucketDict[int, Callable] = BucketDict({0: dist(8, 10, 12)})
-    need_icu_to_deceased_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 3, 20)})
+    close_medical_care_to_icu_days: BucketDict[int, Distribution] = BucketDict({0: dist(10, 12, 14)})
+    close_medical_care_to_mild_end_days: BucketDict[int, Distribution] = BucketDict({0: dist(8, 10, 12)})
+    need_icu_to_deceased_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 3, 20)})
     # Actual distribution: rv_discrete(values=([1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20],
     # [0.030,0.102,0.126,0.112,0.090,0.080,0.075,0.070,0.065,0.050,0.040,0.035,0.030,0.025,0.020,
     # 0.015,0.012,0.010,0.008,0.005]))
-    need_icu_to_improving_days: BucketDict[int, Callable] = BucketDict({0: dist(1, 5, 25)})
+    need_icu_to_improving_days: BucketDict[int, Distribution] = BucketDict({0: dist(1, 5, 25)})
     # Actual distribution: rv_discrete(values=([1,2,3,4,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25],
     # [0.021,0.041,0.081,0.101,0.101,0.081,0.071,0.066,0.061,0.056,0.046,0.041,0.039,0.033,0.031,0.026,0.021,0.016,0.013,0.013,0.011,0.011,0.009,0.005,0.005]))
-    improving_to_need_icu_days: BucketDict[int, Callable] = BucketDict({0: dist(21, 42)})
-    improving_to_pre_recovered_days: BucketDict[int, Callable] = BucketDict({0: dist(21, 42)})  # TODO: check why so long
-    improving_to_mild_condition_end_days: BucketDict[int, Callable] = BucketDict({0: dist(21, 42)})
-    pre_recovered_to_recovered_days: BucketDict[int, Callable] = BucketDict({0: dist(14, 28)})
+    improving_to_need_icu_days: BucketDict[int, Distribution] = BucketDict({0: dist(21, 42)})
+    improving_to_pre_recovered_days: BucketDict[int, Distribution] = BucketDict({0: dist(21, 42)})  # TODO: check why so long
+    improving_to_mild_condition_end_days: BucketDict[int, Distribution] = BucketDict({0: dist(21, 42)})
+    pre_recovered_to_recovered_days: BucketDict[int, Distribution] = BucketDict({0: dist(14, 28)})
     # Actual distribution: rv_discrete(values=([14, 28], [0.8, 0.2]))
-    asymptomatic_end_to_recovered_days: BucketDict[int, Callable] = BucketDict({0: dist(10, 18, 35)})
+    asymptomatic_end_to_recovered_days: BucketDict[int, Distribution] = BucketDict({0: dist(10, 18, 35)})
     # Actual distribution: rv_discrete(values=(
     # [10,11,12,13,14,15,16,17,18,19,20,21,22,23,24,25,26,27,28,29,30,31,32,33,34,35],
     # [0.013,0.016,0.025,0.035,0.045,0.053,0.061,0.065,0.069,0.069,0.065,0.063,0.058,0.053,0.056,0.041,0.040,0.033,
@@ -184,11 +186,13 @@ class Consts(NamedTuple):
             testing_gap_after_negative_test=1,
             testing_priorities=[
                 DetectionPriority(
-                    lambda agent: (agent.medical_state.name == "Symptomatic" and
-                                   agent not in agent.manager.tested_positive_vector),
-                    max_tests=100),
+                    lambda manager, agents: (in_medical_states(manager, agents, "Symptomatic") &
+                                             np.logical_not(manager.tested_positive_vector[agents])),
+                    max_tests=100,
+                    vectorized=True),
                 DetectionPriority(
-                    lambda agent: agent.medical_state.name == "Recovered"),
+                    lambda manager, agents: in_medical_states(manager, agents, "Recovered"),
+                    vectorized=True),
             ]),
 
         DetectionSettings(
@@ -215,13 +219,15 @@ class Consts(NamedTuple):
             testing_gap_after_negative_test=1,
             testing_priorities=[
                 DetectionPriority(
-                    lambda agent: agent.medical_state.name == "Symptomatic"),
+                    lambda manager, agents: in_medical_states(manager, agents, "Symptomatic"),
+                    vectorized=True),
                 DetectionPriority(
-                    lambda agent: agent.medical_state.name == "Recovered"),
+                    lambda manager, agents: in_medical_states(manager, agents, "Recovered"),
+                    vectorized=True),
             ]),
     ]
     day_to_start_isolations: int = np.inf  # The date from which we allow isolations
-    step_to_isolate_dist: Callable = dist(1, 3)  # Isolated today, tomorrow or in 2 days
+    step_to_isolate_dist: Distribution = dist(1, 3)  # Isolated today, tomorrow or in 2 days
     sick_to_p_obey_isolation: Dict[bool, float] = {
         True: 1.0,  # 100% sick will obey the isolation.
         False: .95  # If not sick, 95% to obey isolation
@@ -320,8 +326,13 @@ class Consts(NamedTuple):
         expressions = {
             "__builtins__": None,
             "dist": dist,
+            "Constant": Constant,
+            "UniformInt": UniformInt,
+            "OffsetBinomial": OffsetBinomial,
+            "Discrete": Discrete,
             "DetectionSettings": DetectionSettings,
             "DetectionPriority": DetectionPriority,
+            "in_medical_states": in_medical_states,
             "DetectionTest": DetectionTest,
             "ConditionedPolicy": ConditionedPolicy,
             "ConnectionTypes": ConnectionTypes,
@@ -1,9 +1,9 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Tuple
 import numpy as np
 
-from common.detection_testing_types import DetectionSettings, PendingTestResult, PendingTestResults
+from common.detection_testing_types import DetectionSettings, PendingTestResults
 
 if TYPE_CHECKING:
     from manager import SimulationManager
@@ -19,7 +19,7 @@ rng = np.random.default_rng()
 
 class HealthcareManager:
     __slots__ = ("manager", "positive_detected_today", "freed_neg_tested",
-                 "pending_test_results", "num_of_tested")
+                 "pending_test_results", "num_of_tested", "detection_probs_by_location")
 
     def __init__(self, sim_manager: SimulationManager):
         self.manager = sim_manager
@@ -29,10 +29,15 @@ class HealthcareManager:
                     "The initial number of tests (step=0) wasn't specified in the given schedule: "
                     f"{self.manager.consts.daily_num_of_test_schedule}"
                 )
-        self.positive_detected_today = set()
-        self.freed_neg_tested = set()
+        self.positive_detected_today = np.array([], dtype=int)
+        self.freed_neg_tested = np.array([], dtype=int)
         self.pending_test_results = PendingTestResults()
         self.num_of_tested = None
+        # the detection probability of each medical state (by its index), for every testing location
+        self.detection_probs_by_location = [
+            testing_location.detection_test.get_detection_probs(self.manager.medical_machine.states)
+            for testing_location in self.manager.consts.detection_pool
+        ]
 
     def _get_testable(self, test_location: DetectionSettings):
         tested_pos_too_recently = (
@@ -57,61 +62,83 @@ class HealthcareManager:
 
     def step(self):
         self.manager.left_isolation_by_reason.clear()
-        self.freed_neg_tested.clear()
-        self.progress_tests(self.testing_step())
+        self.progress_tests(*self.testing_step())
         # TODO: Move isolation functions to here
         if self.manager.consts.day_to_start_isolations <= self.manager.current_step:
-            self.manager.progress_isolations()
-
-    def testing_step(self):
+            with self.manager.step_profiler.phase("isolation"):
+                self.manager.progress_isolations()
+
+    def testing_step(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        choose who is tested today, and test them
+        @return: the tested agents, their test results, and the number of days until each result is ready
+        """
         want_to_be_tested = rng.random(len(self.manager.agents)) < self.manager.test_willingness_vector
-        tested: List[PendingTestResult] = []
+        already_tested = np.zeros(len(self.manager.agents), dtype=bool)
+        tested = []
 
-        for test_location in self.manager.consts.detection_pool:
+        for test_location, detection_probs in zip(self.manager.consts.detection_pool,
+                                                  self.detection_probs_by_location):
             num_of_tests = _get_current_num_of_tests(self.manager.current_step, test_location)
 
             # Who can to be tested
             can_be_tested = self._get_testable(test_location)
-            test_candidates = want_to_be_tested & can_be_tested
-            test_candidates_inds = set(np.flatnonzero(test_candidates))
-            test_candidates_inds -= set(result.agent.index for result in tested)
-
-            self._test_according_to_priority(num_of_tests, test_candidates_inds, test_location, tested)
-
-        return tested
-
-    def _test_according_to_priority(self, num_of_tests, test_candidates_inds, test_location, tested):
-        for detection_priority in list(test_location.testing_priorities):
-            # First test the prioritized candidates
-            for ind in rng.choice(list(test_candidates_inds),
-                                  size=min(len(test_candidates_inds), num_of_tests),
-                                  replace=False):
-                # choose random indices so we won't always test the lower indices
-                if detection_priority.is_agent_prioritized(self.manager.agents[ind]):
-                    tested.append(test_location.detection_test.test(self.manager.agents[ind]))
-                    test_candidates_inds.remove(ind)  # Remove so it won't be tested again
-                    num_of_tests -= 1
-
-                    if num_of_tests == 0:
-                        return 0
-        return num_of_tests
-
-    def progress_tests(self, new_tests: List[PendingTestResult]):
-        self.positive_detected_today.clear()
-        new_results = self.pending_test_results.advance()
-        for agent, test_result, _ in new_results:
-            if test_result:
-                self.positive_detected_today.add(agent.index)
-                self.manager.consecutive_negative_tests[agent.index] = 0
-            else:
-                self.manager.consecutive_negative_tests[agent.index] += 1
-                # When isolated agent gets negative result, free him NOW!
-                if self.manager.consecutive_negative_tests[agent.index] == \
-                        self.manager.consts.num_test_to_exit_isolation:
-                    self.manager.step_to_free_agent[agent.index] = self.manager.current_step
-                    self.freed_neg_tested.add(agent.index)
-            agent.set_test_result(test_result)
-
-        for new_test in new_tests:
-            new_test.agent.set_test_start()
-            self.pending_test_results.append(new_test)
+            test_candidates = want_to_be_tested & can_be_tested & np.logical_not(already_tested)
+
+            agents_to_test = self._test_according_to_priority(num_of_tests, np.flatnonzero(test_candidates),
+                                                              test_location)
+            already_tested[agents_to_test] = True
+            test_results, times_to_results = test_location.detection_test.test_many(
+                detection_probs[self.manager.medical_machine.state_index[agents_to_test]])
+            tested.append((agents_to_test, test_results, times_to_results))
+
+        if not tested:
+            return np.array([], dtype=int), np.array([], dtype=bool), np.array([], dtype=int)
+        tested_agents, test_results, times_to_results = (np.concatenate(arrays) for arrays in zip(*tested))
+        self.num_of_tested = len(tested_agents)
+        return tested_agents, test_results, times_to_results
+
+    def _test_according_to_priority(self, num_of_tests, test_candidates_inds: np.ndarray,
+                                    test_location: DetectionSettings) -> np.ndarray:
+        """
+        choose which of the candidates to test, going over the priorities in order.
+        @return: the indices of the agents to test
+        """
+        # choose in random order so we won't always test the lower indices
+        test_candidates_inds = rng.permutation(test_candidates_inds)
+        agents_to_test = []
+        for detection_priority in test_location.testing_priorities:
+            if num_of_tests == 0:
+                break
+            chosen = detection_priority.choose(self.manager, test_candidates_inds, num_of_tests)
+            agents_to_test.append(test_candidates_inds[chosen])
+            test_candidates_inds = np.delete(test_candidates_inds, chosen)  # Remove so it won't be tested again
+            num_of_tests -= len(chosen)
+        if not agents_to_test:
+            return np.array([], dtype=int)
+        return np.concatenate(agents_to_test)
+
+    def progress_tests(self, new_tested_agents: np.ndarray, new_test_results: np.ndarray,
+                       new_times_to_results: np.ndarray):
+        agents, test_results = self.pending_test_results.pop()
+        positive = agents[test_results]
+        negative = agents[np.logical_not(test_results)]
+        self.positive_detected_today = np.unique(positive)
+
+        consecutive_negative_tests = self.manager.consecutive_negative_tests
+        negative_before = consecutive_negative_tests[negative]
+        np.add.at(consecutive_negative_tests, negative, 1)
+        consecutive_negative_tests[positive] = 0
+        # When isolated agent gets negative result, free him NOW!
+        num_test_to_exit_isolation = self.manager.consts.num_test_to_exit_isolation
+        reached_exit = (negative_before < num_test_to_exit_isolation) & \
+                       (consecutive_negative_tests[negative] >= num_test_to_exit_isolation)
+        self.freed_neg_tested = np.unique(negative[reached_exit])
+        self.manager.schedule_release(self.freed_neg_tested, self.manager.current_step)
+
+        self.manager.tested_vector[agents] = True
+        self.manager.tested_positive_vector[agents] = test_results
+        self.manager.ever_tested_positive_vector[positive] = True
+
+        self.manager.date_of_last_test[new_tested_agents] = self.manager.current_step
+        self.pending_test_results.push(new_tested_agents, new_test_results, new_times_to_results)
@@ -1,4 +1,4 @@
-from typing import List, Set
+from typing import Iterable, Optional, Tuple
 
 import numpy as np
 from common.agent import Agent
@@ -18,7 +18,6 @@ class GeographicCircle(Circle):
         "circle_count",
         "connection_type_to_agents",
         "connection_type_to_social_circles",
-
     )
 
     def __init__(self, data_holder: GeographicalCircleDataHolder):
@@ -34,69 +33,64 @@ class GeographicCircle(Circle):
 
     def generate_agents_ages_and_connections_types(self):
         """
-        Iterates over each agent. Generates it's age by a given age distribution (self.data_holder.age_distribution).
-        For each agent, iterates over each connection type, and rolls whether it has this type of connection or not.
-        Gets this probabilities from self.data_holder.connection_types_prob_by_age.
+        Generates the ages of all the agents by a given age distribution (self.data_holder.age_distribution),
+        and rolls all their connection types at once, by the probabilities of their ages
+        (self.data_holder.connection_types_prob_by_age).
         It allows choosing whether some one goes to work, to school, to kindergarten or to none of those.
+        The connection types are rolled into a boolean matrix of agents by connection types,
+        whose columns are the agents of each connection type.
         :return:
         """
-        ages = np.random.choice(
-            self.data_holder.age_distribution["ages"],
-            size=len(self.agents),
-            p=self.data_holder.age_distribution["probs"]
-        )
+        agents_count = len(self.agents)
+        possible_ages = np.asarray(self.data_holder.age_distribution["ages"])
+        age_indices = np.random.choice(len(possible_ages), size=agents_count,
+                                       p=self.data_holder.age_distribution["probs"])
+        ages = possible_ages[age_indices]
         is_adults = ages >= 18
-        num_of_adults = np.count_nonzero(is_adults)
 
-        workplaces_for_adults: List = np.random.choice(
+        # the probability of each age (rows) to have each connection type (columns), looked up for every agent
+        prob_by_age = np.array([[self.data_holder.connection_types_prob_by_age[age][connection_type]
+                                 for connection_type in ConnectionTypes] for age in possible_ages], dtype=float)
+        probs = prob_by_age[age_indices]
+        membership = np.zeros((agents_count, len(ConnectionTypes)), dtype=bool)
+
+        # if an adult works, decide workplace
+        workers = np.flatnonzero(is_adults & (np.random.random(agents_count) < probs[:, ConnectionTypes.Work]))
+        workplaces = np.random.choice(
             [ConnectionTypes.School, ConnectionTypes.Kindergarten, ConnectionTypes.Work],
-            size=num_of_adults,
+            size=len(workers),
             p=[self.data_holder.teachers_workforce_ratio, self.data_holder.kindergarten_workforce_ratio,
                1 - self.data_holder.teachers_workforce_ratio - self.data_holder.kindergarten_workforce_ratio]
-        ).tolist()
-
-        education_type_probs_by_age = {
-            age: np.array([self.data_holder.connection_types_prob_by_age[age][connection_type] for
-                           connection_type in Education_Types]) for age in self.data_holder.age_distribution["ages"]}
-        total_prob_of_education_by_age = {age: np.sum(education_type_probs_by_age[age])
-                                          for age in self.data_holder.age_distribution["ages"]}
-
-        # Normalize
-        for age in self.data_holder.age_distribution["ages"]:
-            if total_prob_of_education_by_age[age] > 0:
-                education_type_probs_by_age[age] = education_type_probs_by_age[age] / total_prob_of_education_by_age[
-                    age]
-
-        for agent, age, is_adult in zip(self.agents, ages, is_adults):
+        )
+        membership[workers, workplaces] = True
+
+        # a child goes to a single education type, if any, with the normalized probabilities of its age
+        education_probs = probs[:, Education_Types]
+        total_prob_of_education = education_probs.sum(axis=1)
+        students = np.flatnonzero(np.logical_not(is_adults) &
+                                  (np.random.random(agents_count) < total_prob_of_education))
+        cumulative_probs = np.cumsum(education_probs[students], axis=1) / \
+            total_prob_of_education[students, np.newaxis]
+        drawn = (cumulative_probs <= np.random.random(len(students))[:, np.newaxis]).sum(axis=1)
+        education_types = np.array(Education_Types)[np.minimum(drawn, len(Education_Types) - 1)]
+        membership[students, education_types] = True
+
+        membership[:, Non_Exclusive_Types] = \
+            np.random.random((agents_count, len(Non_Exclusive_Types))) < probs[:, Non_Exclusive_Types]
+
+        for agent, age in zip(self.agents, ages.tolist()):
             agent.age = age
-            agent_connection_types = []
-
-            if is_adult and np.random.random() < self.data_holder.connection_types_prob_by_age[age][
-                ConnectionTypes.Work]:
-                # if the agent works, decide workplace
-                agent_connection_types.append(workplaces_for_adults.pop())
-
-            if not is_adult:
-                education_probs = education_type_probs_by_age[age]
-                if np.random.random() < total_prob_of_education_by_age[age]:
-                    # normalize the probabilities
-                    education_type = np.random.choice(Education_Types, p=education_probs, size=1)[0]
-                    # TODO: sample many before the loop
-                    agent_connection_types.append(education_type)
-
-            for connection_type in Non_Exclusive_Types:
-                if np.random.random() < self.data_holder.connection_types_prob_by_age[age][connection_type]:
-                    agent_connection_types.append(connection_type)
-
-            for connection_type in agent_connection_types:
-                self.connection_type_to_agents[connection_type].add(agent)
+        agents = np.empty(agents_count, dtype=object)
+        agents[:] = self.agents
+        for connection_type in ConnectionTypes:
+            self.connection_type_to_agents[connection_type].update(agents[membership[:, connection_type]])
 
     def create_inner_social_circles(self):
         # todo notice that family connection types doesnt notice between ages
         for connection_type in In_Zone_types:
             self.create_social_circles_by_type(connection_type, self.connection_type_to_agents[connection_type])
 
-    def create_social_circles_by_type(self, connection_type: ConnectionTypes, agents_for_type: Set[Agent]):
+    def create_social_circles_by_type(self, connection_type: ConnectionTypes, agents_for_type: Iterable[Agent]):
         """
         creates social circles of a given connection type, with a given list of agents.
         uses self data holder circle size distribution of the given connection type.
@@ -105,60 +99,93 @@ class GeographicCircle(Circle):
         :param agents_for_type: the agents that will be inserted to the social circles
         :return:
         """
-        # calculate amount of agents for each size group
-        # we'll also use size_num_agents to count how many agents were placed in each size group.
+        agents = list(agents_for_type)
+        allocation = self.allocate_social_circles(connection_type, np.array([agent.age for agent in agents]))
+        if allocation is None:
+            return
+        offsets, members = allocation
+
+        circles = []
+        for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+            circle = SocialCircle(connection_type)
+            circle.add_many([agents[position] for position in members[start:end].tolist()])
+            circles.append(circle)
+        self.connection_type_to_social_circles[connection_type].extend(circles)
+        self.all_social_circles.extend(circles)
+
+    def allocate_social_circles(self, connection_type: ConnectionTypes, ages: np.ndarray) \
+            -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        divides agents (by their position in ages) between social circles of a given connection type.
+        each agent rolls the size group of its circle, and the agents of each size group are dealt to
+        round(agents / size) circles in turns, so the circles are as equal as possible.
+        if the connection type has a distribution of adults, the first turns of each circle, as many as the adults
+        it rolled, go to adults, and the rest to non adults.
+        :param connection_type: the connection type currently created
+        :param ages: the ages of the agents to allocate
+        :return: the circles' offsets and members (agents by position), the members of circle i are
+        members[offsets[i]:offsets[i + 1]]. None if the type has no circles
+        """
         possible_sizes, probs = self.data_holder.circles_size_distribution_by_connection_type[connection_type]
         if len(possible_sizes) == 0 and len(probs) == 0:
-            return
-
-        size_num_agents = {size: 0 for size in possible_sizes}
-        rolls = np.random.choice(possible_sizes, size=len(agents_for_type), p=probs)
-        for roll in rolls:
-            size_num_agents[roll] += 1
-
-        # populate circles in each size group
-        for size in possible_sizes:
-            if size_num_agents[size] == 0:
+            return None
+
+        # how many agents go to each size group
+        quotas = np.bincount(np.random.choice(len(possible_sizes), size=len(ages), p=probs),
+                             minlength=len(possible_sizes))
+
+        # if the distribution is age dependent, the agents are split to adults and non adults (each in a random
+        # order), otherwise everyone is taken in a random order, as non adults
+        adult_type_distribution = self.data_holder.adult_distributions.get(connection_type)
+        order = np.random.permutation(len(ages))
+        if adult_type_distribution:
+            is_adult = ages[order] > 18
+            adults, non_adults = order[is_adult], order[np.logical_not(is_adult)]
+        else:
+            adults, non_adults = order[:0], order
+        next_adult = next_non_adult = 0
+
+        circles_count = 0
+        circle_ids = []
+        members = []
+        for size, quota in zip(possible_sizes, quotas):
+            if quota == 0:
                 continue
 
-            # create circles
-            amount_of_circles = max(1, round(size_num_agents[size] / size))
-            circles = [SocialCircle(connection_type) for _ in range(amount_of_circles)]
-            # index is used to go over all circles in the size group s.t. the population is divided as qeually as possible
-            index = 0
+            amount_of_circles = max(1, round(quota / size))
+            # the turns of the size group, dealt to the circles one after another
+            turns = np.arange(quota)
+            turn_circles = turns % amount_of_circles
+            turn_members = np.full(quota, -1, dtype=np.int64)
 
-            # if the distribution is age dependent, fill adults first.
-            # check if there is a distribution of adults in for the connection_type
-            adult_type_distribution = self.data_holder.adult_distributions.get(connection_type)
+            free_turns = turns
             if adult_type_distribution:
                 # get random amount of adults for each circle according to distribution
                 circles_adult_number = np.random.choice(**adult_type_distribution[size], size=amount_of_circles)
-                # divide population according to age
-                adults = [agent for agent in agents_for_type if agent.age > 18]
-                non_adults = [agent for agent in agents_for_type if agent.age <= 18]
-                # place adults where needed, non adults elsewhere, where circles need to be populated
-                while len(adults) > 0 and size_num_agents[size] > 0:
-                    circle = circles[index % len(circles)]
-                    # if there are more adults needed, or no more kids, circle gets an adult
-                    if circles_adult_number[index % len(circles)] > circle.agent_count or len(non_adults) == 0:
-                        agent = adults.pop()
-                    else:
-                        agent = non_adults.pop()
-                    circle.add_agent(agent)
-                    agents_for_type.remove(agent)
-                    index += 1
-                    size_num_agents[size] -= 1
-
-            # fill in the rest of the population 
-            while len(agents_for_type) > 0 and size_num_agents[size] > 0:
-                agent = agents_for_type.pop()
-                circle = circles[index % len(circles)]
-                circle.add_agent(agent)
-                index += 1
-                size_num_agents[size] -= 1
-
-            self.connection_type_to_social_circles[connection_type].extend(circles)
-            self.all_social_circles.extend(circles)
+                adult_turns = np.flatnonzero(turns // amount_of_circles < circles_adult_number[turn_circles])
+                adult_turns = adult_turns[:len(adults) - next_adult]
+                turn_members[adult_turns] = adults[next_adult:next_adult + len(adult_turns)]
+                next_adult += len(adult_turns)
+                free_turns = np.flatnonzero(turn_members < 0)
+
+            # non adults fill the rest of the turns, and if they run out, adults do
+            non_adult_turns = free_turns[:len(non_adults) - next_non_adult]
+            turn_members[non_adult_turns] = non_adults[next_non_adult:next_non_adult + len(non_adult_turns)]
+            next_non_adult += len(non_adult_turns)
+            extra_adult_turns = free_turns[len(non_adult_turns):][:len(adults) - next_adult]
+            turn_members[extra_adult_turns] = adults[next_adult:next_adult + len(extra_adult_turns)]
+            next_adult += len(extra_adult_turns)
+
+            filled = turn_members >= 0
+            circle_ids.append(circles_count + turn_circles[filled])
+            members.append(turn_members[filled])
+            circles_count += amount_of_circles
+
+        circle_ids = np.concatenate(circle_ids) if circle_ids else np.array([], dtype=np.int64)
+        members = np.concatenate(members) if members else np.array([], dtype=np.int64)
+        offsets = np.zeros(circles_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(circle_ids, minlength=circles_count), out=offsets[1:])
+        return offsets, members[np.argsort(circle_ids, kind="stable")]
 
     def add_self_agents_to_dict(self, geographic_circle_to_agents_by_connection_types):
         for connection_type in Multi_Zone_types:
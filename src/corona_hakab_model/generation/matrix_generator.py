@@ -5,9 +5,9 @@ import math
 import os.path
 import pickle
 from collections import namedtuple
-from itertools import islice
-from random import random, choice, sample
-from typing import List, Dict, Set
+from enum import IntFlag
+from itertools import chain
+from typing import List, Dict, Set, Tuple, Union
 from typing import TYPE_CHECKING
 
 import numpy as np
@@ -21,7 +21,7 @@ from generation.connection_types import (
     Random_Clustered_types,
 )
 from generation.matrix_consts import MatrixConsts, ConnectionTypeData
-from generation.node import Node
+from generation.scale_free_graph import scale_free_edges
 from project_structure import OUTPUT_FOLDER
 
 from parasymbolic_matrix.parasymbolic import ParasymbolicMatrix
@@ -33,42 +33,202 @@ class AgentConnections:
         self.weekly_connections: Set[int] = set()
 
 
+class ContactFlags(IntFlag):
+    DAILY = 1
+    WEEKLY = 2
+
+
+def _gather_positions(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """
+    the positions of all the items of the given ranges (by their starts and item counts), concatenated
+    """
+    # position of each item inside its own range, shifted to the range's start
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + offsets
+
+
+class ContactsCSR:
+    """
+    the contacts of a single connection type, in compressed sparse row form.
+    the contacts of agent i are indices[indptr[i]:indptr[i + 1]], and flags holds the ContactFlags of each of them.
+    """
+    __slots__ = ("indptr", "indices", "flags")
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, flags: np.ndarray):
+        self.indptr = indptr
+        self.indices = indices
+        self.flags = flags
+
+    @classmethod
+    def from_pairs(cls, size: int, rows: np.ndarray, columns: np.ndarray, flags: np.ndarray) -> "ContactsCSR":
+        """
+        builds the csr out of (row, column, flags) triplets, given in any order
+        """
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=size), out=indptr[1:])
+        return cls(indptr, columns[order].astype(np.int32), flags[order].astype(np.uint8))
+
+    @property
+    def size(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def is_daily(self) -> np.ndarray:
+        return (self.flags & ContactFlags.DAILY).astype(bool)
+
+    def gather(self, rows: np.ndarray):
+        """
+        gathers the contacts of all given rows at once.
+        :param rows: indices of the agents whose contacts are needed
+        :return: (owners, contacts, is_daily) arrays, such that contacts[k] is a contact of rows[owners[k]]
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        owners = np.repeat(np.arange(len(rows)), counts)
+        positions = _gather_positions(starts, counts)
+        return owners, self.indices[positions], (self.flags[positions] & ContactFlags.DAILY).astype(bool)
+
+    def row(self, index: int) -> AgentConnections:
+        agent_connections = AgentConnections()
+        start, end = self.indptr[index], self.indptr[index + 1]
+        is_daily = (self.flags[start:end] & ContactFlags.DAILY).astype(bool)
+        agent_connections.daily_connections.update(self.indices[start:end][is_daily].tolist())
+        agent_connections.weekly_connections.update(self.indices[start:end][~is_daily].tolist())
+        return agent_connections
+
+
+class CliqueContacts:
+    """
+    the contacts of a connection type whose circles are fully connected (cliques), all of them daily.
+    instead of the contacts of every member, only the members of each clique are kept:
+    the members of clique c are members[indptr[c]:indptr[c + 1]], and clique_of_agent[i] is the clique of agent i
+    (-1 if it is in none). the contacts of agent i are the other members of its clique.
+    """
+    __slots__ = ("indptr", "members", "clique_of_agent")
+
+    def __init__(self, indptr: np.ndarray, members: np.ndarray, clique_of_agent: np.ndarray):
+        self.indptr = indptr
+        self.members = members
+        self.clique_of_agent = clique_of_agent
+
+    @classmethod
+    def from_cliques(cls, size: int, cliques: List[np.ndarray]) -> "CliqueContacts":
+        indptr = np.zeros(len(cliques) + 1, dtype=np.int64)
+        np.cumsum([len(clique) for clique in cliques], out=indptr[1:])
+        members = np.concatenate(cliques).astype(np.int32) if cliques else np.array([], dtype=np.int32)
+        clique_of_agent = np.full(size, -1, dtype=np.int32)
+        clique_of_agent[members] = np.repeat(np.arange(len(cliques)), np.diff(indptr))
+        return cls(indptr, members, clique_of_agent)
+
+    @property
+    def size(self) -> int:
+        return len(self.clique_of_agent)
+
+    def gather(self, rows):
+        """
+        gathers the contacts of all given rows at once.
+        :param rows: indices of the agents whose contacts are needed
+        :return: (owners, contacts, is_daily) arrays, such that contacts[k] is a contact of rows[owners[k]]
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cliques = self.clique_of_agent[rows]
+        in_clique = np.flatnonzero(cliques >= 0)
+        starts = self.indptr[cliques[in_clique]]
+        counts = self.indptr[cliques[in_clique] + 1] - starts
+        owners = np.repeat(in_clique, counts)
+        contacts = self.members[_gather_positions(starts, counts)]
+        # an agent is not a contact of itself
+        not_self = contacts != rows[owners]
+        return owners[not_self], contacts[not_self], np.ones(np.count_nonzero(not_self), dtype=bool)
+
+    def row(self, index: int) -> AgentConnections:
+        agent_connections = AgentConnections()
+        clique = self.clique_of_agent[index]
+        if clique >= 0:
+            members = self.members[self.indptr[clique]:self.indptr[clique + 1]]
+            agent_connections.daily_connections.update(members[members != index].tolist())
+        return agent_connections
+
+
+Contacts = Union[ContactsCSR, CliqueContacts]
+
+
+class _ConnectedIdsByStrength:
+    """
+    read only view of the contacts, in the old form of agent index -> {connection type: AgentConnections}
+    """
+    __slots__ = ("connection_data",)
+
+    def __init__(self, connection_data: "ConnectionData"):
+        self.connection_data = connection_data
+
+    def __getitem__(self, agent_index: int) -> Dict[ConnectionTypes, AgentConnections]:
+        return {connection_type: contacts.row(agent_index)
+                for connection_type, contacts in self.connection_data.contacts_by_connection_type.items()}
+
+    def __len__(self):
+        return self.connection_data.size
+
+
 class ConnectionData:
+    """
+    holds the daily and weekly contacts of each agent, as a ContactsCSR for every connection type
+    (or CliqueContacts for the fully connected ones).
+    exported as a folder of .npy files, which are memory-mapped when imported.
+    """
     __slots__ = (
-        "connected_ids_by_strength",
+        "size",
+        "contacts_by_connection_type",
     )
 
-    def __init__(self, agents):
-        self.connected_ids_by_strength = {agent.index: {connection_type: AgentConnections() for connection_type
-                                                        in ConnectionTypes} for agent in agents}
+    def __init__(self, size: int, contacts_by_connection_type: Dict[ConnectionTypes, Contacts]):
+        self.size = size
+        self.contacts_by_connection_type = contacts_by_connection_type
 
-    def export(self, export_path, file_name="connection_data"):
-        if not file_name.endswith(".pickle"):
-            file_name += ".pickle"
+    @property
+    def connected_ids_by_strength(self) -> _ConnectedIdsByStrength:
+        return _ConnectedIdsByStrength(self)
 
-        with open(os.path.join(export_path, file_name), "wb") as export_file:
-            pickle.dump(self, export_file)
+    def export(self, export_path, file_name="connection_data"):
+        folder = os.path.join(export_path, file_name)
+        os.makedirs(folder, exist_ok=True)
+        for connection_type, contacts in self.contacts_by_connection_type.items():
+            for field in type(contacts).__slots__:
+                np.save(os.path.join(folder, f"{connection_type.name}_{field}.npy"), getattr(contacts, field))
 
     @staticmethod
-    def import_connection_data(import_file_path: str) -> "ConnectionData":
-        with open(import_file_path, "rb") as import_file:
-            connection_data = pickle.load(import_file)
-
-        # pickle's version should be updated per application's version
-        return connection_data
+    def import_connection_data(import_folder_path: str) -> "ConnectionData":
+        contacts_by_connection_type = {}
+        for connection_type in ConnectionTypes:
+            # the kind of contacts is told by the files there are
+            contacts_class = CliqueContacts if os.path.exists(
+                os.path.join(import_folder_path, f"{connection_type.name}_members.npy")) else ContactsCSR
+            fields = [np.load(os.path.join(import_folder_path, f"{connection_type.name}_{field}.npy"), mmap_mode="r")
+                      for field in contacts_class.__slots__]
+            contacts_by_connection_type[connection_type] = contacts_class(*fields)
+        size = contacts_by_connection_type[ConnectionTypes(0)].size
+        return ConnectionData(size, contacts_by_connection_type)
 
 
 class MatrixData:
+    # matrix data pickled before the cliques were kept apart has none
+    clique_assignment_data = ()
+
     def __getstate__(self):
         # The fields that will be pickled (we can't pickle the matrix itself)
         return {
             'matrix_assignment_data': self.matrix_assignment_data,
+            'clique_assignment_data': self.clique_assignment_data,
             'depth': self.depth,
             'size': self.size
         }
 
-    def __init__(self, size, depth, matrix_assignment_data):
-        self.matrix_assignment_data: MatrixAssignmentData = matrix_assignment_data
+    def __init__(self, size, depth, matrix_assignment_data, clique_assignment_data=()):
+        self.matrix_assignment_data: List[MatrixAssignmentData] = matrix_assignment_data
+        # the fully connected circles, kept as their members rather than a row for each of them
+        self.clique_assignment_data: List[CliqueAssignmentData] = clique_assignment_data
         self.depth = depth
         self.size = size
         self._matrix = None  # Lazy evaluated only if needed
@@ -85,6 +245,17 @@ class MatrixData:
         with self._matrix.lock_rebuild():
             for depth, index, conns, v in self.matrix_assignment_data:
                 self._matrix[depth, index, conns] = v
+            for depth, members, strength in self.clique_assignment_data:
+                self._set_clique(depth, members, strength)
+
+    def _set_clique(self, depth, members, strength):
+        if hasattr(self._matrix, "set_clique"):
+            self._matrix.set_clique(depth, members, strength)
+            return
+        # builds of the matrix without cliques get the row of each member
+        for member in members:
+            others = members[members != member]
+            self._matrix[depth, int(member), others] = np.full(len(others), strength, dtype=np.float32)
 
     def export(self, file_name: str):
         if not file_name.endswith(".pickle"):
@@ -103,6 +274,8 @@ class MatrixData:
 
 
 MatrixAssignmentData = namedtuple('MatrixAssignmentData', ['depth', 'index', 'conns', 'v'])
+# a circle in which every two members are connected, with the same strength
+CliqueAssignmentData = namedtuple('CliqueAssignmentData', ['depth', 'members', 'strength'])
 
 
 class MatrixGenerator:
@@ -115,8 +288,12 @@ class MatrixGenerator:
     ):
         # initiate everything
         self.matrix_assignment_data = []
+        self.clique_assignment_data = []
         self.logger = logging.getLogger("MatrixGenerator")
-        self.connection_data = ConnectionData(population_data.agents)
+        # (rows, columns, flags) arrays of the contacts of each connection type, gathered into a csr once done
+        self.contacts_triplets = {con_type: [] for con_type in ConnectionTypes}
+        # the members of each fully connected circle, of the connect to all types
+        self.cliques = {con_type: [] for con_type in Connect_To_All_types}
         self.matrix_consts = matrix_consts
         self._unpack_population_data(population_data)
         self.size = len(self.agents)
@@ -140,7 +317,8 @@ class MatrixGenerator:
                     con_type_data, self.social_circles_by_connection_type[con_type], current_depth
                 )
 
-        self.matrix_data = MatrixData(self.size, self.depth, self.matrix_assignment_data)
+        self.matrix_data = MatrixData(self.size, self.depth, self.matrix_assignment_data, self.clique_assignment_data)
+        self.connection_data = self._build_connection_data()
 
     def _unpack_population_data(self, population_data):
         self.agents = population_data.agents
@@ -149,38 +327,43 @@ class MatrixGenerator:
         self.geographic_circle_by_agent_index = population_data.geographic_circle_by_agent_index
         self.social_circles_by_agent_index = population_data.social_circles_by_agent_index
 
-    def _add_layer(self, con_type_data: ConnectionTypeData, connections: List[List[int]], depth: int):
-        # insert all connections to matrix
-        # we need to remember the strengths so the connection will be symmetric
-        known_strengths = {}
-        for agent, conns in zip(self.agents, connections):
-            if len(conns) == 0:
-                continue
-
-            conns = np.array(conns)
-            conns.sort()
-
-            strengthes = con_type_data.get_strengths(len(conns))
-
-            # check if some strengths were determined earlier
-            for index, conn in enumerate(conns):
-                known_strength = known_strengths.get((conn, agent.index), None)
-                if known_strength != None:
-                    strengthes[index] = known_strength
-                    del known_strengths[(conn, agent.index)]
-                else:
-                    # connection is new. store the strength for future use
-                    known_strengths[(agent.index, conn)] = strengthes[index]
+    def _add_contacts(self, con_type: ConnectionTypes, rows: np.ndarray, columns: np.ndarray, flags: np.ndarray):
+        self.contacts_triplets[con_type].append((rows, columns, flags))
 
-                if strengthes[index] == con_type_data.connection_strength:
-                    self.connection_data.connected_ids_by_strength[agent.index][
-                        con_type_data.connection_type].daily_connections.add(conn)
-                else:
-                    self.connection_data.connected_ids_by_strength[agent.index][
-                        con_type_data.connection_type].weekly_connections.add(conn)
-
-            v = np.full_like(conns, strengthes, dtype=np.float32)
-            self.matrix_assignment_data.append(MatrixAssignmentData(depth, agent.index, conns, v.copy()))
+    def _build_connection_data(self) -> ConnectionData:
+        contacts_by_connection_type = {}
+        for con_type, triplets in self.contacts_triplets.items():
+            if con_type in self.cliques:
+                contacts_by_connection_type[con_type] = CliqueContacts.from_cliques(self.size, self.cliques[con_type])
+                continue
+            if triplets:
+                rows, columns, flags = (np.concatenate(arrays) for arrays in zip(*triplets))
+            else:
+                rows, columns, flags = (np.array([], dtype=np.int64) for _ in range(3))
+            contacts_by_connection_type[con_type] = ContactsCSR.from_pairs(self.size, rows, columns, flags)
+        return ConnectionData(self.size, contacts_by_connection_type)
+
+    def _add_layer(self, con_type_data: ConnectionTypeData, edges: Tuple[np.ndarray, np.ndarray], depth: int):
+        """
+        insert all connections to matrix and contacts.
+        the strength is rolled once for every edge (given once), so the connection will be symmetric
+        """
+        edges_u, edges_v = edges
+        strengths = con_type_data.get_strengths(len(edges_u))
+        flags = np.where(strengths == con_type_data.connection_strength, ContactFlags.DAILY, ContactFlags.WEEKLY)
+
+        rows = np.concatenate([edges_u, edges_v])
+        columns = np.concatenate([edges_v, edges_u])
+        values = np.tile(strengths.astype(np.float32), 2)
+        self._add_contacts(con_type_data.connection_type, rows, columns, np.tile(flags, 2))
+
+        # a sorted row of the matrix for every agent with connections
+        order = np.lexsort((columns, rows))
+        rows, columns, values = rows[order], columns[order], values[order]
+        row_starts = np.flatnonzero(np.diff(rows, prepend=-1))
+        for row, conns, v in zip(rows[row_starts].tolist(), np.split(columns, row_starts[1:]),
+                                 np.split(values, row_starts[1:])):
+            self.matrix_assignment_data.append(MatrixAssignmentData(depth, row, conns, v))
 
     def _create_fully_connected_circles_matrix(self, con_type_data: ConnectionTypeData, circles: List[SocialCircle],
                                                depth):
@@ -193,144 +376,130 @@ class MatrixGenerator:
                 # An empty circle (shouldn't happen) or a single-agent circle (there isn't any meaning to the
                 # connection strength between an agent to itself)
                 continue
-            ids = np.array([a.index for a in circle.agents])
+            ids = np.sort([a.index for a in circle.agents])
 
-            vals = np.full_like(ids, connection_strength, dtype=np.float32)
-            for i, agent in enumerate(circle.agents):
-                temp = vals[i]
-                vals[i] = 0
-                self.matrix_assignment_data.append(MatrixAssignmentData(depth, int(agent.index), ids, vals.copy()))
-                vals[i] = temp
-                self.connection_data.connected_ids_by_strength[agent.index][
-                    con_type_data.connection_type].daily_connections.update(set(ids))
+            # every member is connected to (and a daily contact of) all other members,
+            # so only the members are kept, and not the connections between them
+            self.clique_assignment_data.append(CliqueAssignmentData(depth, ids, connection_strength))
+            self.cliques[con_type_data.connection_type].append(ids)
 
     def _create_scale_free_graph(self, con_type_data: ConnectionTypeData, circles: List[SocialCircle], depth):
-        # the new connections will be saved here
-        connections = [[] for _ in self.agents]
+        # the agents of the circles that are too small to cluster will be saved here
+        small_circles = []
+        # and the edges of the scale free circles here
+        edges_u, edges_v = [], []
         # gets data from matrix consts
         connection_strength = con_type_data.connection_strength
         if connection_strength == 0:
             return
 
         # adding all super small circles, into one circle, and randomly create connections inside it
-        super_small_circles_combined = SocialCircle(con_type_data.connection_type)
+        super_small_circles_combined = []
 
         for circle in circles:
-            agents = circle.agents
-            indexes = [agent.index for agent in agents]
-            nodes: List[Node] = [Node(index) for index in indexes]
-
             # the number of nodes. writes it for simplicity
-            n = len(indexes)
-            connections_amounts = con_type_data.get_scale_free_connections_amount(shape=n)
-
-            # saves the already-inserted nodes
-            np.random.shuffle(nodes)
+            n = len(circle.agents)
             initial_con_amount = math.ceil(con_type_data.total_connections_amount) + 1
 
             # checks, if the circle is too small for any algorithm. if so adds to super small circle
             if n < initial_con_amount:
-                super_small_circles_combined.add_many(circle.agents)
+                super_small_circles_combined.extend(agent.index for agent in circle.agents)
                 continue
 
             # checks, if the circle is too small for normal clustering
             if n < self.matrix_consts.clustering_switching_point:
-                self._randomly_connect_single_circle(circle, connections, con_type_data.total_connections_amount)
+                small_circles.append([agent.index for agent in circle.agents])
                 continue
 
-            connected_nodes = set()
-
-            # manually generate the minimum required connections
-            for i in range(initial_con_amount):
-                other_nodes = nodes[0:initial_con_amount]
-                other_nodes.pop(i)
-                nodes[i].add_connections(other_nodes)
-                connected_nodes.add(nodes[i])
-
-            # add the rest of the nodes, one at a time
-            for node, num_connections in zip(islice(nodes, initial_con_amount, None), connections_amounts):
-                # selects the first node to attach to randomly
-                first_connection = choice(list(connected_nodes))
-                # fill connections other than first_connection
-                while len(node.connected) < num_connections - 1:
-                    if random() < con_type_data.triad_p:
-                        # close the triad with a node from first_connection's connections
-                        possible_nodes = first_connection.connected
-                    else:
-                        # connect with a node, which is not first connection
-                        possible_nodes = connected_nodes
-
-                    # prevent connecting a connected node
-                    if len(possible_nodes) - len(node.connected) > 100:  # TODO 100 is made up. should be optimized
-                        possible_list = list(possible_nodes)
-                        random_friend = choice(possible_list)
-                        while random_friend in node.connected:
-                            random_friend = choice(possible_list)
-                    else:
-                        possible_nodes = possible_nodes.difference(node.connected).difference({first_connection})
-                        random_friend = choice(list(possible_nodes))
-                    Node.connect(random_friend, node)
-                # connect to bff here to prevent self-selection in bff's friends
-                Node.connect(first_connection, node)
-                connected_nodes.add(node)
-
-            for connected_node in nodes:
-                connections[connected_node.index].extend([other_node.index for other_node in connected_node.connected])
-
-        # adding connections between all super small circles
-        self._randomly_connect_single_circle(super_small_circles_combined, connections,
-                                             con_type_data.total_connections_amount)
+            connections_amounts = con_type_data.get_scale_free_connections_amount(shape=n)
+            # the agents, by the order in which they are added to the graph
+            indexes = np.random.permutation([agent.index for agent in circle.agents])
+            circle_u, circle_v = scale_free_edges(n, connections_amounts.tolist(), initial_con_amount,
+                                                  con_type_data.triad_p)
+            edges_u.append(indexes[circle_u])
+            edges_v.append(indexes[circle_v])
+
+        # adding connections inside the small circles, and between all super small circles
+        small_circles.append(super_small_circles_combined)
+        small_circles_u, small_circles_v = self._randomly_connect_circles(small_circles,
+                                                                          con_type_data.total_connections_amount)
 
         # insert connections to matrix
-        self._add_layer(con_type_data, connections, depth)
+        self._add_layer(con_type_data, (np.concatenate([small_circles_u, *edges_u]),
+                                        np.concatenate([small_circles_v, *edges_v])), depth)
 
     def _create_randomly_connected_layer(self, con_type_data: ConnectionTypeData,
                                          circles: List[SocialCircle], depth):
-        # the new connections will be saved here
-        connections = [[] for _ in self.agents]
         # gets data from matrix consts
         connection_strength = con_type_data.connection_strength
         if connection_strength == 0:
             return
 
-        for circle in circles:
-            self._randomly_connect_single_circle(circle, connections, con_type_data.total_connections_amount)
+        edges = self._randomly_connect_circles([[agent.index for agent in circle.agents] for circle in circles],
+                                               con_type_data.total_connections_amount)
 
         # insert all connections to matrix
-        self._add_layer(con_type_data, connections, depth)
+        self._add_layer(con_type_data, edges, depth)
 
-    def _randomly_connect_single_circle(self, circle: SocialCircle, connections: List[List], scale_factor: float):
+    def _randomly_connect_circles(self, circles_agents: List[List[int]], scale_factor: float,
+                                  max_rounds: int = 10) -> Tuple[np.ndarray, np.ndarray]:
         """
-        creates circle's connections, and adds them to a given connections list
-        connections amount will be generated from an exponential distribution
-        :param circle: the social circle too small
-        :param connections: the connections list
+        randomly connects the agents inside each of the given circles, by matching stubs (a configuration model).
+        the connections amount of every agent is generated from an exponential distribution (capped by the
+        circle's size), every agent gets that many stubs, and the stubs of each circle are shuffled and paired.
+        pairs that are self loops or repeat an existing connection are dropped, and their stubs are matched again,
+        for up to max_rounds rounds.
+        :param circles_agents: the agents (by index) of each circle
         :param scale_factor: average amount of connections for each agent
-        :return:
+        :param max_rounds: the maximal amount of times to match the stubs
+        :return: the edges (rows and columns arrays, each edge given once, with row < column)
         """
-        remaining_contacts = {
-            agent.index: math.ceil(np.random.exponential(scale_factor - 0.5)) for agent in circle.agents
-        }
-
-        agent_id_pool = set([agent.index for agent in circle.agents])
-
-        # while there are still connections left to make
-        while len(agent_id_pool) >= 2:
-            current_agent_id = agent_id_pool.pop()
-
-            rc = min(remaining_contacts[current_agent_id], len(agent_id_pool))
-            conns = sample(list(agent_id_pool), rc)
-            connections[current_agent_id].extend(conns)
-            for other_agent_id in conns:
-                connections[other_agent_id].append(current_agent_id)
-            to_remove = set()
-            for id in conns:
-                remaining_contacts[id] -= 1
-                if remaining_contacts[id] == 0:
-                    to_remove.add(id)
-            assert to_remove <= agent_id_pool
-
-            agent_id_pool.difference_update(to_remove)
+        circles_sizes = np.array([len(agents) for agents in circles_agents], dtype=np.int64)
+        agents = np.fromiter(chain.from_iterable(circles_agents), dtype=np.int64, count=circles_sizes.sum())
+        agents_circles = np.repeat(np.arange(len(circles_agents)), circles_sizes)
+        connections_amounts = np.minimum(np.ceil(np.random.exponential(scale_factor - 0.5, size=len(agents))),
+                                         np.maximum(circles_sizes[agents_circles] - 1, 0)).astype(np.int64)
+
+        stubs = np.repeat(agents, connections_amounts)
+        stubs_circles = np.repeat(agents_circles, connections_amounts)
+        edges_u, edges_v = [], []
+        # the edges made so far, as keys of row * size + column
+        edges_keys = np.array([], dtype=np.int64)
+        for _ in range(max_rounds):
+            if len(stubs) < 2:
+                break
+            # shuffle the stubs inside each circle, and pair every stub in an even place with the next one
+            order = np.lexsort((np.random.random(len(stubs)), stubs_circles))
+            stubs, stubs_circles = stubs[order], stubs_circles[order]
+            circles_starts = np.flatnonzero(np.concatenate([[True], stubs_circles[1:] != stubs_circles[:-1]]))
+            circles_counts = np.diff(np.append(circles_starts, len(stubs)))
+            place_in_circle = np.arange(len(stubs)) - np.repeat(circles_starts, circles_counts)
+            firsts = np.flatnonzero((place_in_circle % 2 == 0) &
+                                    (place_in_circle + 1 < np.repeat(circles_counts, circles_counts)))
+            u = np.minimum(stubs[firsts], stubs[firsts + 1])
+            v = np.maximum(stubs[firsts], stubs[firsts + 1])
+
+            # keep only the first pair of every new connection, that isn't a self loop
+            keys = u * self.size + v
+            _, first_of_key = np.unique(keys, return_index=True)
+            is_kept = np.zeros(len(keys), dtype=bool)
+            is_kept[first_of_key] = True
+            is_kept &= (u != v) & ~np.isin(keys, edges_keys)
+            if not is_kept.any():
+                break
+            edges_u.append(u[is_kept])
+            edges_v.append(v[is_kept])
+            edges_keys = np.concatenate([edges_keys, keys[is_kept]])
+
+            # the stubs of the dropped pairs, and the unpaired stubs, are matched again
+            is_matched = np.zeros(len(stubs), dtype=bool)
+            is_matched[firsts[is_kept]] = True
+            is_matched[firsts[is_kept] + 1] = True
+            stubs, stubs_circles = stubs[~is_matched], stubs_circles[~is_matched]
+
+        if not edges_u:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(edges_u), np.concatenate(edges_v)
 
     def export_matrix_data(self, export_dir=OUTPUT_FOLDER, export_filename='matrix.pickle'):
         self.matrix_data.export(os.path.join(export_dir, export_filename))
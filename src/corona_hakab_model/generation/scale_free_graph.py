@@ -0,0 +1,66 @@
+from random import random, randrange, choice
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+def scale_free_edges(nodes_count: int, connections_amounts: Sequence[int], initial_nodes_count: int,
+                     triad_p: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    grows a clustered scale free graph (Holme-Kim style) by adding its nodes one at a time.
+    the first initial_nodes_count nodes are fully connected. every node after them connects to a random earlier node
+    (its first connection), and then to more earlier nodes until it has its amount of connections: each of them is,
+    with probability triad_p, a neighbor of the first connection (closing a triad), and otherwise any earlier node.
+    since a random neighbor is picked by degree, the triads make the attachment preferential.
+
+    the nodes are added in order, so the earlier nodes of node i are range(i), and a random one is a single draw.
+    the neighbors of each node are kept in a list, for drawing a random neighbor at once.
+    :param nodes_count: the amount of nodes in the graph
+    :param connections_amounts: the amount of connections of each node that is added after the initial ones
+    :param initial_nodes_count: the amount of fully connected nodes the graph starts with
+    :param triad_p: the probability of each connection (other than the first one) to close a triad
+    :return: (u, v) arrays of the edges between the nodes (by their order), each edge given once
+    """
+    neighbors = [[other for other in range(initial_nodes_count) if other != node]
+                 for node in range(initial_nodes_count)]
+    neighbors.extend([] for _ in range(initial_nodes_count, nodes_count))
+    initial_u, initial_v = np.triu_indices(initial_nodes_count, k=1)
+    edges_u, edges_v = [], []
+
+    for node, num_connections in zip(range(initial_nodes_count, nodes_count), connections_amounts):
+        first_connection = randrange(node)
+        first_neighbors = neighbors[first_connection]
+        connected = {first_connection}
+        friends = []
+        while len(friends) < num_connections - 1:
+            friend = None
+            if random() < triad_p:
+                # close the triad with a node from first_connection's connections
+                if len(first_neighbors) > 2 * len(connected):
+                    friend = choice(first_neighbors)
+                    while friend in connected:
+                        friend = choice(first_neighbors)
+                else:
+                    possible_friends = [other for other in first_neighbors if other not in connected]
+                    if possible_friends:
+                        friend = choice(possible_friends)
+            if friend is None:
+                # connect with any earlier node, which is not connected yet
+                if node <= len(connected):
+                    break
+                friend = randrange(node)
+                while friend in connected:
+                    friend = randrange(node)
+            connected.add(friend)
+            friends.append(friend)
+        # connect to the first connection last, so it is not picked from its own neighbors
+        friends.append(first_connection)
+
+        for friend in friends:
+            neighbors[friend].append(node)
+        neighbors[node] = friends
+        edges_u.extend(friends)
+        edges_v.extend([node] * len(friends))
+
+    return (np.concatenate([initial_u, np.array(edges_u, dtype=np.int64)]),
+            np.concatenate([initial_v, np.array(edges_v, dtype=np.int64)]))
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Dict
+from typing import TYPE_CHECKING, Dict, List, Sequence
 
 import numpy as np
 
@@ -12,11 +12,39 @@ if TYPE_CHECKING:
 
 
 class InfectionInfo:
+    """
+    how an agent was infected: through which connection type, and by which infector (None if not backtracked)
+    """
+
     def __init__(self, infector_agent, connection_type):
         self.infector_agent = infector_agent
         self.connection_type = connection_type
 
 
+class RandomConnectionPools:
+    """
+    The pools in which the agents meet their random connections of a connection type (by agent index),
+    and the total random connections of each pool.
+    an agent that is alone in its pool can't randomly meet anyone, so it is not in any pool (its pool is -1).
+    """
+
+    def __init__(self, pools: Sequence[Sequence[int]], totals: Sequence[float], population_size: int):
+        self.pool_of_agent = np.full(population_size, -1, dtype=np.int64)
+        for pool, agents_id in enumerate(pools):
+            if len(agents_id) > 1:
+                self.pool_of_agent[agents_id] = pool
+        self.totals = np.array(totals, dtype=float)
+
+        # the agents of the pools, sorted by pool, and where each pool starts
+        self.agents = np.flatnonzero(self.pool_of_agent >= 0)
+        self.agents = self.agents[np.argsort(self.pool_of_agent[self.agents], kind="stable")]
+        self.agent_pools = self.pool_of_agent[self.agents]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.agent_pools, minlength=len(self.totals)))])
+
+    def members(self, pool: int) -> np.ndarray:
+        return self.agents[self.offsets[pool]:self.offsets[pool + 1]]
+
+
 class InfectionManager:
     """
     Manages the infection stage
@@ -24,6 +52,33 @@ class InfectionManager:
 
     def __init__(self, sim_manager: SimulationManager):
         self.manager = sim_manager
+        self.random_connection_pools = self._make_random_connection_pools()
+
+    def _make_random_connection_pools(self) -> Dict[connection_types.ConnectionTypes, RandomConnectionPools]:
+        """
+        the agents meet random connections within their social circle,
+        or for the geo random connection types, within all the social circles of their geographic circle
+        """
+        population_size = len(self.manager.agents)
+        random_connection_pools = {}
+        for connection_type in connection_types.With_Random_Connections:
+            circles = self.manager.social_circles_by_connection_type[connection_type]
+            random_connection_pools[connection_type] = RandomConnectionPools(
+                [[agent.index for agent in circle.agents] for circle in circles],
+                [circle.total_random_connections for circle in circles],
+                population_size)
+
+        for connection_type in connection_types.With_Geo_Random_Connections:
+            circles_by_geographic_circle = [geographic_circle.connection_type_to_social_circles[connection_type]
+                                            for geographic_circle in self.manager.geographic_circles]
+            random_connection_pools[connection_type] = RandomConnectionPools(
+                [[agent.index for circle in circles for agent in circle.agents]
+                 for circles in circles_by_geographic_circle],
+                [np.sum([circle.total_random_connections for circle in circles])
+                 for circles in circles_by_geographic_circle],
+                population_size)
+
+        return random_connection_pools
 
     def infection_step(self) -> Dict[Agent, InfectionInfo]:
         """
@@ -31,9 +86,11 @@ class InfectionManager:
         returns a dict of agent_index to InfectionInfo objects.
         """
         # perform infection
-        infections: Dict[Agent, InfectionInfo] = self._perform_infection()
+        with self.manager.step_profiler.phase("matrix infection"):
+            infections: Dict[Agent, InfectionInfo] = self._perform_infection()
         # note - this may overwrite
-        infections.update(self._infect_random_connections())
+        with self.manager.step_profiler.phase("random connections infection"):
+            infections.update(self._infect_random_connections())
 
         return infections
 
@@ -51,27 +108,52 @@ class InfectionManager:
         # v = [True if an agent can infect other agents in this time step]
         v = np.random.random(len(self.manager.agents)) < self.manager.contagiousness_vector
 
-        # u = mat dot_product v (log of the probability that an agent will get infected)
-        u = self.manager.matrix.prob_any(v)
+        if self.manager.consts.backtrack_infection_sources or \
+                not hasattr(self.manager.matrix, "prob_any_by_component"):
+            # u = mat dot_product v (log of the probability that an agent will get infected)
+            u = self.manager.matrix.prob_any(v)
+
+            # calculate the infections boolean vector
+            infections = self.manager.susceptible_vector & (np.random.random(u.shape) < u)
+
+            infected_indices = np.flatnonzero(infections)
+            return {self.manager.agents[agent_index]: self._get_infection_info(int(agent_index), v) for agent_index in
+                    infected_indices}
+
+        # the probability to be infected through each connection type, computed along with the combined one,
+        # so the infections can be attributed to the connection types without backtracking their sources
+        probs_by_connection_type = self.manager.matrix.prob_any_by_component(v)
+        u = 1 - np.prod(1 - probs_by_connection_type, axis=1)
 
-        # calculate the infections boolean vector
         infections = self.manager.susceptible_vector & (np.random.random(u.shape) < u)
 
         infected_indices = np.flatnonzero(infections)
-        return {self.manager.agents[agent_index]: self._get_infection_info(int(agent_index), v) for agent_index in
-                infected_indices}
+        infection_methods = self._draw_connection_types(self._hazards(probs_by_connection_type[infected_indices]))
+        return {self.manager.agents[agent_index]: InfectionInfo(None, connection_type)
+                for agent_index, connection_type in zip(infected_indices, infection_methods)}
 
-    def _infect_random_connections(self) -> Dict[Agent, InfectionInfo]:
-        connections = self.manager.num_of_random_connections * self.manager.random_connections_factor
+    @staticmethod
+    def _hazards(probs: np.ndarray) -> np.ndarray:
+        """
+        the hazards of infection probabilities (by connection type).
+        the connection types compete on the infection, so each is as likely as its share of the hazard
+        """
+        return -np.log1p(-np.minimum(probs.astype(float), 1 - 1e-9))
+
+    @staticmethod
+    def _draw_connection_types(weights: np.ndarray) -> List[connection_types.ConnectionTypes]:
+        """
+        draw a connection type for each row of weights (by connection type), with probabilities proportional to them
+        """
+        cumulative_weights = np.cumsum(weights, axis=1)
+        draws = np.random.random(len(weights)) * cumulative_weights[:, -1]
+        drawn = np.minimum((cumulative_weights <= draws[:, np.newaxis]).sum(axis=1), weights.shape[1] - 1)
+        return [connection_types.ConnectionTypes(int(connection_type)) for connection_type in drawn]
 
-        probs_not_infected_from_random_connection = self._get_probs_not_infected_from_random_connection(connections)
-        probs_not_infected_from_geo_random_connection = self._get_probs_not_infected_from_geo_random_connection(connections)
+    def _infect_random_connections(self) -> Dict[Agent, InfectionInfo]:
+        connections = self.manager.update_matrix_manager.effective_random_connections
 
-        # every agent can have up to one value for each connection type from both vectors.
-        # so, if he has a value for a connection type in one vector,
-        # the value for the same connection type in the other vector will be 1.
-        # adding both vectors and subtracting 1 will preserve the value that was set in the vector.
-        probs_not_infected_from_connection = (probs_not_infected_from_random_connection + probs_not_infected_from_geo_random_connection) - 1
+        probs_not_infected_from_connection = self._get_probs_not_infected_from_random_connection(connections)
 
         not_infected_probs = np.power(probs_not_infected_from_connection, connections)
         prob_infected_in_any_circle = 1 - not_infected_probs.prod(axis=1)
@@ -79,58 +161,38 @@ class InfectionManager:
                      (np.random.random(len(self.manager.agents)) < prob_infected_in_any_circle)
 
         infected_indices = np.flatnonzero(infections)
-        return {self.manager.agents[agent_index]: self._get_random_infection_info(int(agent_index),
-                                                                                  1 - not_infected_probs[agent_index])
-                for agent_index in infected_indices}
+        hazards = self._hazards(1 - not_infected_probs[infected_indices])
+        if self.manager.consts.backtrack_infection_sources:
+            return {self.manager.agents[agent_index]:
+                    self._get_random_infection_info(int(agent_index), agent_hazards)
+                    for agent_index, agent_hazards in zip(infected_indices, hazards)}
+
+        infection_methods = self._draw_connection_types(hazards)
+        return {self.manager.agents[agent_index]: InfectionInfo(None, connection_type)
+                for agent_index, connection_type in zip(infected_indices, infection_methods)}
 
     def _get_probs_not_infected_from_random_connection(self, connections):
+        """
+        the probability of each agent not to be infected by a single random connection of each connection type.
+        the probability of a random connection to be infectious is the contagiousness weighted random connections
+        of the agent's pool, out of the pool's total random connections
+        """
         probs_not_infected_from_random_connection = np.ones_like(connections, dtype=float)
 
-        for connection_type in connection_types.With_Random_Connections:
-            for circle in self.manager.social_circles_by_connection_type[connection_type]:
-                agents_id = [agent.index for agent in circle.agents]
-
-                if len(agents_id) == 1:
-                    # One-Agent circle, you can't randomly meet yourself..
-                    continue
-
-                total_infectious_random_connections = np.dot(
-                    self.manager.contagiousness_vector[agents_id],
-                    connections[agents_id, connection_type],
-                )
+        for connection_type, pools in self.random_connection_pools.items():
+            total_infectious_random_connections = np.bincount(
+                pools.agent_pools,
+                weights=self.manager.contagiousness_vector[pools.agents] * connections[pools.agents, connection_type],
+                minlength=len(pools.totals),
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                prob = total_infectious_random_connections / pools.totals
 
-                prob = total_infectious_random_connections / circle.total_random_connections
-
-                probs_not_infected_from_random_connection[agents_id, connection_type] = \
-                    1 - prob * self.manager.random_connections_strength[connection_type]
+            probs_not_infected_from_random_connection[pools.agents, connection_type] = \
+                1 - prob[pools.agent_pools] * self.manager.random_connections_strength[connection_type]
 
         return probs_not_infected_from_random_connection
 
-    def _get_probs_not_infected_from_geo_random_connection(self, connections):
-        probs_not_infected_from_geo_random_connection = np.ones_like(connections, dtype=float)
-
-        for connection_type in connection_types.With_Geo_Random_Connections:
-            for geographic_circle in self.manager.geographic_circles:
-                circles = geographic_circle.connection_type_to_social_circles[connection_type]
-                agents_id = [agent.index for circle in circles for agent in circle.agents]
-
-                if len(agents_id) == 1:
-                    # One-Agent in circles, you can't randomly meet yourself..
-                    continue
-
-                total_infectious_random_connections = np.dot(
-                    self.manager.contagiousness_vector[agents_id],
-                    connections[agents_id, connection_type],
-                )
-
-                circles_total_random_connections = np.sum([circle.total_random_connections for circle in circles])
-                prob = total_infectious_random_connections / circles_total_random_connections
-
-                probs_not_infected_from_geo_random_connection[agents_id, connection_type] = \
-                    1 - prob * self.manager.random_connections_strength[connection_type]
-
-        return probs_not_infected_from_geo_random_connection
-
     def _get_infection_info(self, agent_index: int, possible_infectors: np.ndarray):
         if not self.manager.consts.backtrack_infection_sources:
             return None
@@ -151,32 +213,18 @@ class InfectionManager:
         infection_probabilities = [ip / norm_factor for ip in infection_probabilities]
         return np.random.choice(infection_cases, p=infection_probabilities)
 
-    def _get_random_infection_info(self, agent_id: int, infection_probs: np.ndarray):
+    def _get_random_infection_info(self, agent_id: int, hazards: np.ndarray):
         if not self.manager.consts.backtrack_infection_sources:
             return None
         
         # determine infection method
-        connection_type = np.random.choice(len(infection_probs), p=infection_probs / np.sum(infection_probs))
+        connection_type = np.random.choice(len(hazards), p=hazards / np.sum(hazards))
 
         # determine infector
-        agents_id = []
-
-        if connection_type in connection_types.With_Random_Connections:
-            infectious_circle = next(circle for circle in self.manager.social_circles_by_agent_index[agent_id]
-                                     if circle.connection_type == connection_type)
-            agents_id = [agent.index for agent in infectious_circle.agents]
-
-        if connection_type in connection_types.With_Geo_Random_Connections:
-            # TODO: if we see that this part of code is slow -
-            #  add dict of agents and the geo circle that they work in(should be created in the generation process)
-            agent_connection_type_circle = next(circle for circle in self.manager.social_circles_by_agent_index[agent_id]
-                                                if circle.connection_type == connection_type)
-            agent_geo_circle = next(geo_circle for geo_circle in self.manager.geographic_circles
-                                    if agent_connection_type_circle in geo_circle.connection_type_to_social_circles[connection_type])
-            infectious_circles = [circle for circle in agent_geo_circle.connection_type_to_social_circles[connection_type]]
-            agents_id = [agent.index for circle in infectious_circles for agent in circle.agents]
-
-        connections = self.manager.num_of_random_connections * self.manager.random_connections_factor
+        pools = self.random_connection_pools[connection_type]
+        agents_id = pools.members(pools.pool_of_agent[agent_id])
+
+        connections = self.manager.update_matrix_manager.effective_random_connections
         infectious_agents = self.manager.contagiousness_vector[agents_id] * connections[agents_id, connection_type]
         infector_id = np.random.choice(agents_id, p=infectious_agents / np.sum(infectious_agents))
         return InfectionInfo(self.manager.agents[infector_id], connection_type)
@@ -6,6 +6,7 @@ import os.path
 from pathlib import Path
 import sys
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 
 import numpy as np
 
@@ -13,6 +14,7 @@ from analyzers.fit_to_graph import compare_real_to_simulation
 from analyzers.state_machine_analysis import extract_state_machine_analysis
 from common.application_utils import generate_from_folder, generate_from_master_folder, make_circles_consts, \
     make_matrix_consts
+from common.background_writer import BackgroundWriter
 from common.isolation_types import IsolationTypes
 from consts import Consts
 from generation.circles_generator import PopulationData
@@ -92,7 +94,16 @@ def generate_data(args):
     gm.save_to_folder(args.output_folder)
 
 
-def run_simulation(args):
+def run_simulation(args, output_writer: BackgroundWriter = None):
+    """
+    run a simulation, writing its results through output_writer.
+    a writer can be shared by consecutive runs, so the results of a run are written while the next one runs.
+    if not given, the run has its own writer, and waits for it to be done before returning
+    """
+    if output_writer is None:
+        with BackgroundWriter() as output_writer:
+            return run_simulation(args, output_writer)
+
     print(args)
 
     Path(args.output).mkdir(parents=True, exist_ok=True)
@@ -225,6 +236,9 @@ def run_simulation(args):
                                     lambda manager: manager.left_isolation_by_reason['negative_tests']),
             LambdaValueSupervisable("Number of tests",
                                     lambda manager: manager.healthcare_manager.num_of_tested),
+            LambdaValueSupervisable("Pending medical transitions",
+                                    lambda manager: len(manager.medical_state_manager.pending_transfers)),
+            Supervisable.StepTime(),
         ),
         population_data,
         matrix_data,
@@ -232,22 +246,30 @@ def run_simulation(args):
         initial_agent_constraints,
         run_args=args,
         consts=consts,
+        output_writer=output_writer,
     )
     print(sm)
     sm.run()
     df: pd.DataFrame = sm.dump(filename=args.output)
     # using parent since args.output gives the sim_records folder
-    consts.export(export_path=Path(args.output).parent, file_name="simulation_consts.json")
-    df.plot()
+    output_writer.submit(consts.export, export_path=Path(args.output).parent, file_name="simulation_consts.json")
     if args.figure_path:
         if not os.path.splitext(args.figure_path)[1]:
             args.figure_path = args.figure_path + '.png'
-        plt.savefig(args.figure_path)
+        output_writer.submit(save_figure, df, args.figure_path)
 
     if args.show_plot:
+        df.plot()
         plt.show()
 
 
+def save_figure(df: pd.DataFrame, figure_path):
+    # pyplot is not thread safe, so the figure is drawn without it, to be saved from the background writer
+    figure = Figure()
+    df.plot(ax=figure.subplots())
+    figure.savefig(figure_path)
+
+
 def set_seeds(seed=0):
     seed = seed or None
     np.random.seed(seed)
@@ -1,6 +1,5 @@
 import logging
 from collections import defaultdict, Counter
-from itertools import groupby, chain
 from numpy.random import shuffle
 from typing import Callable, Iterable, List, Union
 
@@ -8,9 +7,12 @@ import numpy as np
 
 import infection
 import update_matrix
-from common.agent import SickAgents, InitialAgentsConstraints, Agent
+from common.agent import SickAgents, InitialAgentsConstraints
+from common.background_writer import SynchronousWriter
 from common.isolation_types import IsolationTypes
 from common.state_machine import PendingTransfers
+from common.step_profiler import StepProfiler
+from common.util import IndexQueue
 from consts import Consts
 from detection_model import healthcare
 from generation.circles_generator import PopulationData
@@ -35,7 +37,8 @@ class SimulationManager:
             connection_data: ConnectionData,
             inital_agent_constraints: InitialAgentsConstraints,
             run_args,
-            consts: Consts = Consts()):
+            consts: Consts = Consts(),
+            output_writer: SynchronousWriter = None):
         # setting logger
         self.logger = logging.getLogger("simulation")
         logging.basicConfig()
@@ -60,6 +63,8 @@ class SimulationManager:
         self.connection_data = connection_data
 
         self.run_args = run_args
+        # the files of the run are written through the output writer, possibly in the background
+        self.output_writer = output_writer or SynchronousWriter()
 
         # setting up medical things
         self.consts = consts
@@ -68,7 +73,7 @@ class SimulationManager:
 
         self.pending_transfers = PendingTransfers()
 
-        # the manager holds the vector, but the agents update it
+        # the manager holds the vectors, and updates them from the medical state tables upon medical state changes
         self.contagiousness_vector = np.zeros(len(self.agents), dtype=float)  # how likely to infect others
         self.susceptible_vector = np.zeros(len(self.agents), dtype=bool)  # can get infected
 
@@ -77,7 +82,7 @@ class SimulationManager:
         self.test_willingness_vector = np.zeros(len(self.agents), dtype=float)
         self.tested_vector = np.zeros(len(self.agents), dtype=bool)
         self.tested_positive_vector = np.zeros(len(self.agents), dtype=bool)
-        self.consecutive_negative_tests = Counter()
+        self.consecutive_negative_tests = np.zeros(len(self.agents), dtype=int)
         self.ever_tested_positive_vector = np.zeros(len(self.agents), dtype=bool)
         self.agents_in_isolation = np.full(fill_value=IsolationTypes.NONE,
                                            shape=len(self.agents),
@@ -86,16 +91,24 @@ class SimulationManager:
         self.date_of_last_test = np.zeros(len(self.agents), dtype=int)
         self.step_to_isolate_agent = np.full(len(self.agents), -1, dtype=np.int32)  # full of null step
         self.step_to_free_agent = np.full(len(self.agents), -1, dtype=np.int32)  # full of null step
+        # the step arrays above are the source of truth, these queues only index which agents to check on each step
+        self.agents_to_isolate_queue = IndexQueue()
+        self.agents_to_free_queue = IndexQueue()
         self.left_isolation_by_reason = Counter()
 
         # initializing agents to current simulation
         for agent in self.agents:
-            agent.add_to_simulation(self, initial_state)
+            agent.add_to_simulation(self)
         initial_state.add_many(self.agents)
+        self.contagiousness_age_bucket = self.medical_machine.tables.age_bucket_ids(
+            np.array([agent.age for agent in self.agents], dtype=int))
+        self.update_medical_vectors(np.arange(len(self.agents)),
+                                    np.full(len(self.agents), initial_state.index, dtype=np.int8))
 
         # initializing simulation modules
+        self.step_profiler = StepProfiler(self.matrix, run_args.profile, run_args.profile_steps)
         self.simulation_progression = SimulationProgression([Supervisable.coerce(a, self) for a in supervisable_makers],
-                                                            self)
+                                                            self, run_args.output)
         self.update_matrix_manager = update_matrix.UpdateMatrixManager(self)
         if run_args.validate_matrix:
             self.update_matrix_manager.validate_matrix()
@@ -135,104 +148,176 @@ class SimulationManager:
         run one step
         """
 
+        self.step_profiler.start_step(self.current_step)
+
         # checks if there is a policy to active.
-        self.policy_manager.perform_policies()
+        with self.step_profiler.phase("policies"):
+            self.policy_manager.perform_policies()
 
-        self.healthcare_manager.step()
+        with self.step_profiler.phase("healthcare testing"):
+            self.healthcare_manager.step()
 
         self.new_sick_by_infection_method = {connection_type: 0 for connection_type in ConnectionTypes}
         self.new_sick_by_infector_medical_state = defaultdict(int)
         # run infection
-        new_infection_cases = self.infection_manager.infection_step()
-        for agent, new_infection_case in new_infection_cases.items():
-            self.sick_agents.add_agent(agent.get_snapshot())
-
-            if self.consts.backtrack_infection_sources:
-                self.new_sick_by_infection_method[new_infection_case.connection_type] += 1
-                self.new_sick_by_infector_medical_state[new_infection_case.infector_agent.medical_state.name] += 1
+        with self.step_profiler.phase("infection logging"):
+            new_infection_cases = self.infection_manager.infection_step()
+            new_sick = np.fromiter((agent.index for agent in new_infection_cases), dtype=np.int64,
+                                   count=len(new_infection_cases))
+            # the connection type and infector of each infection, -1 where unknown
+            cases = list(new_infection_cases.values())
+            infection_methods = np.fromiter((-1 if case is None else case.connection_type for case in cases),
+                                            dtype=np.int8, count=len(cases))
+            infectors = np.fromiter((-1 if case is None or case.infector_agent is None else case.infector_agent.index
+                                     for case in cases), dtype=np.int64, count=len(cases))
+            infector_states = np.where(infectors == -1, -1, self.medical_machine.state_index[infectors])
+            self.sick_agents.add_agents(self.current_step, new_sick, infectors, infection_methods, infector_states)
+
+            for connection_type, count in zip(*np.unique(infection_methods[infection_methods != -1],
+                                                         return_counts=True)):
+                self.new_sick_by_infection_method[ConnectionTypes(int(connection_type))] += int(count)
+            for state_index, count in zip(*np.unique(infector_states[infector_states != -1], return_counts=True)):
+                self.new_sick_by_infector_medical_state[self.medical_machine.states[state_index].name] += int(count)
 
         # progress transfers
-        medical_machine_step_result = self.medical_state_manager.step(new_infection_cases.keys())
+        with self.step_profiler.phase("medical transitions"):
+            medical_machine_step_result = self.medical_state_manager.step(new_infection_cases.keys())
         self.new_sick_counter = medical_machine_step_result['new_sick']
 
         self.current_step += 1
 
-        self.simulation_progression.snapshot(self)
+        with self.step_profiler.phase("supervisor snapshot"):
+            self.simulation_progression.snapshot(self)
+        self.step_profiler.end_step()
+
+    def update_medical_vectors(self, agents: np.ndarray, state_indices: np.ndarray):
+        """
+        update the medical vectors of agents (by index) that entered the respective medical states (by index)
+        """
+        tables = self.medical_machine.tables
+        self.contagiousness_vector[agents] = tables.contagiousness[state_indices, self.contagiousness_age_bucket[agents]]
+        self.susceptible_vector[agents] = tables.susceptible[state_indices]
+        self.test_willingness_vector[agents] = tables.test_willingness[state_indices]
+        self.living_agents_vector[agents[tables.is_deceased[state_indices]]] = False
 
     def progress_isolations(self):
         # Need to isolate every non-hotel isolated verified infected agent
-        detected_positive_indices = [agent for agent in self.healthcare_manager.positive_detected_today
-                                     if self.agents_in_isolation[agent] != IsolationTypes.HOTEL]
-        # This is pretty fast even for large number of agents.
-        # It removes the need to activate step_to_isolate_dist over and over again
-        days_to_enter_isolation = self.consts.step_to_isolate_dist(size=len(self.agents))
-        for agent_index in detected_positive_indices:
-            # Get number of days agent is isolated
-            if self.agents_in_isolation[agent_index] != IsolationTypes.NONE:
-                # TODO: Need to take into account when got out of isolation also
-                number_of_days_isolated = self.current_step - self.step_to_isolate_agent[agent_index]
-            else:
-                number_of_days_isolated = 0
-            weekly_connection_isolation_ratio = 1 - min(number_of_days_isolated / 7, 1)
-
-            # Isolate the agent
-            self.step_to_isolate_agent[agent_index] = self.current_step + days_to_enter_isolation[agent_index]
-            if not self.consts.isolate_first_circle:
-                continue
-            days_to_be_isolated = self.consts.home_isolation_time_bound - number_of_days_isolated
-            for connection, connected_agents in self.connection_data.connected_ids_by_strength[agent_index].items():
-                # need to be home isolated
-                days_to_isolate_for_conn = self.consts.home_isolation_time_bound \
-                    if connection == ConnectionTypes.Family \
-                    else days_to_be_isolated
-                for daily_agent_index in connected_agents.daily_connections:
-                    # Need to isolate, ones that are not isolated/about.
-                    # If tested positive, does not need further isolation
-                    if self.step_to_isolate_agent[daily_agent_index] < self.current_step and \
-                            self.agents_in_isolation[daily_agent_index] == IsolationTypes.NONE and \
-                            daily_agent_index not in detected_positive_indices:
-                        self.step_to_isolate_agent[daily_agent_index] = self.current_step + \
-                                                                        days_to_enter_isolation[daily_agent_index]
-                        self.step_to_free_agent[daily_agent_index] = max(self.step_to_isolate_agent[daily_agent_index] +
-                                                                         days_to_isolate_for_conn,
-                                                                         self.step_to_free_agent[daily_agent_index])
-
-                agents_to_iterate, how_many_to_isolate = self._get_sorted_weekly_to_isolate(
-                    connected_agents.weekly_connections,
-                    weekly_connection_isolation_ratio)
-                # For every agent we isolate, we randomly choose when he met the agent
-                # Then, we need
-                days_to_isolate = self.consts.home_isolation_time_bound - np.random.randint(low=number_of_days_isolated,
-                                                                                            high=7,
-                                                                                            size=how_many_to_isolate)
-                for index, weekly_agent_index in enumerate(agents_to_iterate):
-                    if index == how_many_to_isolate:
-                        break
-                    # If already about to get isolated or is isolated, do not update it
-                    # Do not isolate again those that got tested right now
-                    if self.step_to_isolate_agent[weekly_agent_index] < self.current_step and \
-                            weekly_agent_index not in detected_positive_indices:
-                        continue
-                    self.step_to_isolate_agent[weekly_agent_index] = self.current_step + \
-                                                                     days_to_enter_isolation[weekly_agent_index]
-                    self.step_to_free_agent[weekly_agent_index] = self.step_to_isolate_agent[weekly_agent_index] + \
-                                                                  days_to_isolate[index]
+        detected_positive = self.healthcare_manager.positive_detected_today
+        detected_positive = detected_positive[self.agents_in_isolation[detected_positive] != IsolationTypes.HOTEL]
+        is_detected_positive = np.zeros(len(self.agents), dtype=bool)
+        is_detected_positive[detected_positive] = True
+
+        # Need to isolate, ones that are not isolated/about.
+        # If tested positive, does not need further isolation
+        can_be_isolated = (self.step_to_isolate_agent < self.current_step) & \
+                          (self.agents_in_isolation == IsolationTypes.NONE) & \
+                          np.logical_not(is_detected_positive)
+
+        # Get number of days each agent is isolated
+        # TODO: Need to take into account when got out of isolation also
+        number_of_days_isolated = np.where(self.agents_in_isolation[detected_positive] != IsolationTypes.NONE,
+                                           self.current_step - self.step_to_isolate_agent[detected_positive],
+                                           0)
+
+        # Isolate the agents
+        self.schedule_isolation(detected_positive)
+        if self.consts.isolate_first_circle:
+            self._isolate_first_circle(detected_positive, number_of_days_isolated, can_be_isolated)
 
         # Isolating symptomatic agents
         if self.consts.isolate_symptomatic:
-            for agent in self.medical_state_manager.new_agents_with_symptoms:
-                # If is not getting ready to be isolated, or isolated already, then isolate
-                if self.step_to_isolate_agent[agent.index] < self.current_step and \
-                        self.agents_in_isolation[agent.index] == IsolationTypes.NONE and \
-                        agent.index not in detected_positive_indices:
-                    self.step_to_isolate_agent[agent.index] = self.current_step + days_to_enter_isolation[agent.index]
+            new_agents_with_symptoms = self.medical_state_manager.new_agents_with_symptoms
+            # If is not getting ready to be isolated, or isolated already, then isolate
+            new_agents_with_symptoms = new_agents_with_symptoms[can_be_isolated[new_agents_with_symptoms]]
+            self.schedule_isolation(new_agents_with_symptoms)
 
         # TODO: Remove healthy agents from isolation?
         self.isolate_agents()
         self.free_isolated_agents()
 
+    def _isolate_first_circle(self, detected_positive: np.ndarray, number_of_days_isolated: np.ndarray,
+                              can_be_isolated: np.ndarray):
+        """
+        schedules the isolation of the daily contacts and of a part of the weekly contacts of every detected agent.
+        all the contacts of all the detected agents are handled at once, using the contacts csr of each connection type.
+        """
+        weekly_connection_isolation_ratio = 1 - np.minimum(number_of_days_isolated / 7, 1)
+        days_to_be_isolated = self.consts.home_isolation_time_bound - number_of_days_isolated
+        # ever infected agents are the first to be isolated from the weekly contacts
+        ever_infected = np.logical_not(self.susceptible_vector)
+
+        contacts_to_isolate = []
+        days_to_isolate = []
+        for connection_type, contacts_csr in self.connection_data.contacts_by_connection_type.items():
+            owners, contacts, is_daily = contacts_csr.gather(detected_positive)
+
+            # need to be home isolated
+            if connection_type == ConnectionTypes.Family:
+                days_to_isolate_for_conn = np.full(len(owners), self.consts.home_isolation_time_bound)
+            else:
+                days_to_isolate_for_conn = days_to_be_isolated[owners]
+            daily = is_daily & can_be_isolated[contacts]
+            contacts_to_isolate.append(contacts[daily])
+            days_to_isolate.append(days_to_isolate_for_conn[daily])
+
+            # only a ratio of the weekly contacts that are not isolated is isolated,
+            # depending on how long ago the detected agent was isolated
+            weekly = np.flatnonzero(np.logical_not(is_daily) &
+                                    (self.agents_in_isolation[contacts] == IsolationTypes.NONE))
+            weekly_owners = owners[weekly]
+            weekly_per_owner = np.bincount(weekly_owners, minlength=len(detected_positive))
+            how_many_to_isolate = np.round(weekly_per_owner * weekly_connection_isolation_ratio).astype(int)
+            # sort each owner's weekly contacts - infected ones first, then a random order
+            order = np.lexsort((np.random.random(len(weekly)), np.logical_not(ever_infected[contacts[weekly]]),
+                                weekly_owners))
+            weekly = weekly[order]
+            weekly_owners = weekly_owners[order]
+            rank_in_owner = np.arange(len(weekly)) - (np.cumsum(weekly_per_owner) - weekly_per_owner)[weekly_owners]
+            chosen = rank_in_owner < how_many_to_isolate[weekly_owners]
+            # For every agent we isolate, we randomly choose when he met the agent
+            weekly, weekly_owners = weekly[chosen], weekly_owners[chosen]
+            met_days_ago = np.random.randint(low=number_of_days_isolated[weekly_owners], high=7)
+            # If already about to get isolated or is isolated, do not update it
+            # Do not isolate again those that got tested right now
+            still_can_be_isolated = can_be_isolated[contacts[weekly]]
+            contacts_to_isolate.append(contacts[weekly][still_can_be_isolated])
+            days_to_isolate.append((self.consts.home_isolation_time_bound - met_days_ago)[still_can_be_isolated])
+
+        # scatter the isolation dates. an agent that is a contact of several detected agents
+        # is isolated for the longest period of them
+        contacts_to_isolate, contact_inds = np.unique(np.concatenate(contacts_to_isolate), return_inverse=True)
+        max_days_to_isolate = np.zeros(len(contacts_to_isolate), dtype=int)
+        np.maximum.at(max_days_to_isolate, contact_inds, np.concatenate(days_to_isolate))
+        self.schedule_isolation(contacts_to_isolate)
+        self.schedule_release(contacts_to_isolate,
+                              np.maximum(self.step_to_free_agent[contacts_to_isolate],
+                                         self.step_to_isolate_agent[contacts_to_isolate] + max_days_to_isolate))
+
+    def schedule_isolation(self, agents: np.ndarray):
+        """
+        draw the number of days until each of the agents enters isolation, and schedule it
+        """
+        steps_to_isolate = self.current_step + self.consts.step_to_isolate_dist(size=len(agents))
+        self.step_to_isolate_agent[agents] = steps_to_isolate
+        self.agents_to_isolate_queue.push(agents, steps_to_isolate)
+
+    def schedule_release(self, agents: np.ndarray, steps_to_free: Union[int, np.ndarray]):
+        """
+        schedule the agents to be freed from isolation on the given steps
+        """
+        self.step_to_free_agent[agents] = steps_to_free
+        self.agents_to_free_queue.push(agents, steps_to_free)
+
+    def _pop_due_agents(self, queue: IndexQueue, step_of_agent: np.ndarray) -> np.ndarray:
+        """
+        get the agents scheduled to the current step in the queue.
+        entries that were rescheduled or cancelled since being pushed no longer match the step array and are dropped.
+        """
+        candidates = queue.pop(self.current_step)
+        return np.unique(candidates[step_of_agent[candidates] == self.current_step])
+
     def free_isolated_agents(self):
-        agents_to_free = np.flatnonzero(self.step_to_free_agent == self.current_step)
+        agents_to_free = self._pop_due_agents(self.agents_to_free_queue, self.step_to_free_agent)
 
         for agent in agents_to_free:
             for connection in ConnectionTypes:
@@ -245,84 +330,49 @@ class SimulationManager:
         self.agents_in_isolation[agents_to_free] = IsolationTypes.NONE
         self.step_to_free_agent[agents_to_free] = -1
         self.left_isolation_by_reason['negative_tests'] = len(self.healthcare_manager.freed_neg_tested)
-        self.left_isolation_by_reason['due_date'] = len(set(agents_to_free).difference(
-            self.healthcare_manager.freed_neg_tested))
-
-    def _get_sorted_weekly_to_isolate(self, weekly_connection, isolation_ratio):
-        agents_to_iterate = [agent_id for agent_id in weekly_connection
-                             if self.agents_in_isolation[agent_id] == IsolationTypes.NONE]
-        non_infected_agents = self.medical_machine.default_state_upon_infection.ever_visited
-        # We group to infected and non-infected
-        how_many_to_isolate = int(round(len(agents_to_iterate) * isolation_ratio))
-        agents_to_iterate_grouped_temp = list(groupby(agents_to_iterate,
-                                                      key=lambda y: self.agents[y] in non_infected_agents))
-        infected_agents_grouped = chain(
-            *[group_iter[1] for group_iter in agents_to_iterate_grouped_temp if group_iter[1]])
-        healthy_agents_grouped = chain(
-            *[group_iter[1] for group_iter in agents_to_iterate_grouped_temp if not group_iter[1]])
-        agents_to_iterate = chain(infected_agents_grouped, healthy_agents_grouped)
-        return agents_to_iterate, how_many_to_isolate
-
-    def get_isolation_groups_by_reason(self, agents_to_group):
-        tested_positive = list()
-        first_circle = list()
-        symptomatic = list()
-        for agent in agents_to_group:
-            if self.ever_tested_positive_vector[agent.index]:
-                # If until isolation starts, got negative answer
-                # do not change isolation status
-                if self.tested_positive_vector[agent.index]:
-                    tested_positive.append(agent)
-            elif agent.medical_state.has_symptoms:
-                symptomatic.append(agent)
-            else:
-                first_circle.append(agent)
+        self.left_isolation_by_reason['due_date'] = len(np.setdiff1d(agents_to_free,
+                                                                     self.healthcare_manager.freed_neg_tested))
+
+    def get_isolation_groups_by_reason(self, agents_to_group: np.ndarray):
+        ever_tested_positive = self.ever_tested_positive_vector[agents_to_group]
+        # If until isolation starts, got negative answer
+        # do not change isolation status
+        tested_positive = agents_to_group[ever_tested_positive & self.tested_positive_vector[agents_to_group]]
+        not_tested = agents_to_group[np.logical_not(ever_tested_positive)]
+        has_symptoms = self.medical_state_manager.has_symptoms_vector[not_tested]
         return dict(tested_positive=tested_positive,
-                    first_circle=first_circle,
-                    symptomatic=symptomatic)
+                    first_circle=not_tested[np.logical_not(has_symptoms)],
+                    symptomatic=not_tested[has_symptoms])
+
+    @staticmethod
+    def _sample_obeying_agents(agents: np.ndarray, p_obey: float) -> np.ndarray:
+        return np.random.permutation(agents)[:round(p_obey * len(agents))]
 
     def isolate_agents(self):
-        can_be_isolated = self.step_to_isolate_agent == self.current_step  # this is the day to isolate them
-        remaining = self.agents[can_be_isolated]  # get those agents
+        # this is the day to isolate them
+        remaining = self._pop_due_agents(self.agents_to_isolate_queue, self.step_to_isolate_agent)
         isolation_groups = self.get_isolation_groups_by_reason(remaining)
-        remaining_sick_or_symp = isolation_groups['tested_positive'] + isolation_groups['symptomatic']
+        remaining_sick_or_symp = np.concatenate((isolation_groups['tested_positive'], isolation_groups['symptomatic']))
         remaining_healthy = isolation_groups['first_circle']
         # Sample who will obey
-        # Cannot sample if array is of size 0
-        if len(remaining_sick_or_symp) == 0:
-            sick_or_symp_will_obey_isolation = np.empty((0,), dtype=Agent)
-        else:
-            sample_size = round(self.consts.sick_to_p_obey_isolation[True] *
-                                len(remaining_sick_or_symp))
-            sick_or_symp_will_obey_isolation = np.random.choice(remaining_sick_or_symp,
-                                                                size=sample_size,
-                                                                replace=False)
-        if len(remaining_healthy) == 0:
-            healthy_will_obey_isolation = np.empty((0,), dtype=Agent)
-        else:
-            sample_size = round(self.consts.sick_to_p_obey_isolation[False] *
-                                len(remaining_healthy))
-            healthy_will_obey_isolation = np.random.choice(remaining_healthy,
-                                                           size=sample_size,
-                                                           replace=False)
-
-        for agent in np.concatenate((sick_or_symp_will_obey_isolation,
-                                     healthy_will_obey_isolation)):
-            # keep track about who is in isolation and its type
-            current_isolation_type = self.get_isolation_type(agent)
-            isolation_factor = self.consts.isolation_factor[current_isolation_type]
-            self.update_matrix_manager.change_agent_relations_by_factor(agent,
-                                                                        isolation_factor)  # change the matrix
-            self.agents_in_isolation[agent.index] = current_isolation_type
-
-    def get_isolation_type(self, agent):  # TODO: not here...
+        will_obey_isolation = np.concatenate((
+            self._sample_obeying_agents(remaining_sick_or_symp, self.consts.sick_to_p_obey_isolation[True]),
+            self._sample_obeying_agents(remaining_healthy, self.consts.sick_to_p_obey_isolation[False])))
+
+        # keep track about who is in isolation and its type
+        isolation_types = self.get_isolation_types(will_obey_isolation)
+        for isolation_type in (IsolationTypes.HOME, IsolationTypes.HOTEL):
+            agents_to_isolate = will_obey_isolation[isolation_types == isolation_type]
+            self.update_matrix_manager.change_agents_relations_by_factor(
+                agents_to_isolate, self.consts.isolation_factor[isolation_type])  # change the matrix
+            self.agents_in_isolation[agents_to_isolate] = isolation_type
+
+    def get_isolation_types(self, agents: np.ndarray) -> np.ndarray:  # TODO: not here...
         """
-            Gets as input an agent and return the kind of isolation he should be in
+            Gets as input agent indices and return the kind of isolation each of them should be in
         """
         # This is OK, since once getting sick, you won't need to be isolated once you recover
-        if self.ever_tested_positive_vector[agent.index]:
-            return IsolationTypes.HOTEL
-        return IsolationTypes.HOME
+        return np.where(self.ever_tested_positive_vector[agents], IsolationTypes.HOTEL, IsolationTypes.HOME)
 
     def get_agents_out_of_isolation(self, agents_list: List):
         for agent in agents_list:
@@ -364,17 +414,17 @@ class SimulationManager:
                         agents_to_infect.append(temp_agent)
                         break
 
-        for agent in agents_to_infect:
-            agent.set_medical_state_no_inform(self.medical_machine.default_state_upon_infection)
-            self.sick_agents.add_agent(agent.get_snapshot())
-
+        infected_state = self.medical_machine.default_state_upon_infection
+        infected_indices = np.array([agent.index for agent in agents_to_infect], dtype=np.int64)
+        self.sick_agents.add_agents(self.current_step, infected_indices)
         self.medical_machine.initial.remove_many(agents_to_infect)
-        self.medical_machine.default_state_upon_infection.add_many(agents_to_infect)
+        infected_state.add_many(agents_to_infect)
+        self.update_medical_vectors(infected_indices, np.full(len(infected_indices), infected_state.index,
+                                                              dtype=np.int8))
+        self.medical_state_manager.has_symptoms_vector[infected_indices] = infected_state.has_symptoms
 
         # take list of agents and create a pending transfer from their initial state to the next state
-        self.medical_state_manager.pending_transfers.extend(
-            self.medical_machine.default_state_upon_infection.transfer(agents_to_infect)
-        )
+        self.medical_state_manager.pending_transfers.extend(infected_state.transfer(infected_indices))
 
     def run(self):
         """
@@ -382,19 +432,21 @@ class SimulationManager:
         """
         self.setup_sick()
         if self.run_args.initial_sick_agents_path:
-            self.sick_agents.export(self.run_args.initial_sick_agents_path)
+            self.sick_agents.export(self.run_args.initial_sick_agents_path, self)
         for i in range(self.consts.total_steps):
             self.step()
             self.logger.info(f"performing step {i + 1}/{self.consts.total_steps}")
         if self.run_args.all_sick_agents_path:
-            self.sick_agents.export(self.run_args.all_sick_agents_path)
+            self.sick_agents.export(self.run_args.all_sick_agents_path, self)
+        if self.run_args.output:
+            self.output_writer.submit(self.step_profiler.export, self.run_args.output)
 
         # clearing lru cache after run
         # self.consts.medical_state_machine.cache_clear()
         Supervisable.coerce.cache_clear()
 
     def dump(self, **kwargs):
-        return self.simulation_progression.dump(**kwargs)
+        return self.simulation_progression.dump(writer=self.output_writer, **kwargs)
 
     def __str__(self):
         return f"<SimulationManager: SIZE_OF_POPULATION={len(self.agents)}, " f"STEPS_TO_RUN={self.consts.total_steps}>"
@@ -1,6 +1,7 @@
-from collections import defaultdict
 from typing import List
 
+import numpy as np
+
 from common.agent import Agent
 from common.medical_state_machine import MedicalStateMachine
 from common.state_machine import PendingTransfers
@@ -27,49 +28,39 @@ class MedicalStateManager:
         self.medical_state_machine = self.manager.medical_machine if self.manager \
             else medical_state_machine
         self.pending_transfers = PendingTransfers()
-        self.new_agents_with_symptoms = set()
+        self.new_agents_with_symptoms = np.array([], dtype=np.int64)
+        # which agents are currently in a medical state with symptoms
+        self.has_symptoms_vector = np.full(len(self.manager.agents) if self.manager else 0,
+                                           self.medical_state_machine.initial.has_symptoms, dtype=bool)
 
     def step(self, new_sick: List[Agent]):
         """
         :param new_sick: List of new agents that got sick
         :return:
         """
-        self.new_agents_with_symptoms.clear()
-        # all the new sick agents are leaving their previous step
-        changed_state_leaving = defaultdict(list)
-        # agents which are going to enter the new state
-        changed_state_introduced = defaultdict(list)
-        # list of all the new sick agents
-
-        # all the new sick are going to get to the next state
-        for agent in new_sick:
-            changed_state_leaving[agent.medical_state].append(agent)
-            if self.manager:
-                agent.set_medical_state_no_inform(self.medical_state_machine.get_state_upon_infection(agent))
-            else:  # TODO: Find a more elegant way to do this
-                agent.medical_state = self.medical_state_machine.get_state_upon_infection(agent)
-
-            changed_state_introduced[agent.medical_state].append(agent)
+        machine = self.medical_state_machine
+        # all the new sick agents are leaving their previous state, to the state upon infection
+        new_sick_agents = np.fromiter((agent.index for agent in new_sick), dtype=np.int64, count=len(new_sick))
+        new_sick_destinations = np.fromiter(
+            (machine.state_indices[machine.get_state_upon_infection(agent)] for agent in new_sick),
+            dtype=np.int8, count=len(new_sick))
 
         # saves this number for supervising
         new_sick_counter = len(new_sick)
 
-        moved = self.pending_transfers.advance()
-        for (agent, destination, origin, _) in moved:
-            if self.manager:
-                agent.set_medical_state_no_inform(destination)
-            else:  # TODO: Find a more elegant way to do this
-                agent.medical_state = destination
-            changed_state_introduced[destination].append(agent)
-            changed_state_leaving[origin].append(agent)
-            if destination.has_symptoms and not origin.has_symptoms:
-                if self.manager:
-                    self.new_agents_with_symptoms.add(agent)
-        for state, agents in changed_state_introduced.items():
-            state.add_many(agents)
-            self.pending_transfers.extend(state.transfer(agents))
+        moved_agents, moved_destinations, moved_origins = self.pending_transfers.advance()
+        agents = np.concatenate((new_sick_agents, moved_agents))
+        origins = np.concatenate((machine.state_index[new_sick_agents], moved_origins))
+        destinations = np.concatenate((new_sick_destinations, moved_destinations))
+
+        if self.manager:
+            self.manager.update_medical_vectors(agents, destinations)
+            has_symptoms = machine.tables.has_symptoms
+            self.has_symptoms_vector[agents] = has_symptoms[destinations]
+            self.new_agents_with_symptoms = agents[has_symptoms[destinations] & np.logical_not(has_symptoms[origins])]
 
-        for state, agents in changed_state_leaving.items():
-            state.remove_many(agents)
+        machine.move_agents(agents, origins, destinations)
+        for destination in np.unique(destinations):
+            self.pending_transfers.extend(machine.states[destination].transfer(agents[destinations == destination]))
 
         return dict(new_sick=new_sick_counter)
@@ -68,6 +68,14 @@ def write_swim():
         return self._prob_any(v, nz)
         """,
     )
+    pswim.extend_py_def(
+        "prob_any_by_component",
+        "self, v",
+        """
+        nz = np.flatnonzero(v).astype(np.uint64, copy=False)
+        return self._prob_any_by_component(v, nz).reshape(self.get_size(), -1)
+        """,
+    )
     pswim.extend_py_def(
         "__setitem__",
         "self, key, v",
@@ -78,6 +86,14 @@ def write_swim():
         self.batch_set(comp, row, indices, v)
         """,
     )
+    pswim.extend_py_def(
+        "set_clique",
+        "self, comp, members, strength",
+        """
+        members = np.asanyarray(members, dtype=np.uint64)
+        self.batch_set_clique(comp, members, strength)
+        """,
+    )
     pswim.extend_py_def(
         "lock_rebuild",
         "self",
@@ -3,6 +3,7 @@
 #include <iostream>
 #include <thread>
 #include <algorithm>
+#include <cassert>
 
 #define POOL_SIZE 2
 
@@ -97,18 +98,31 @@ BareSparseMatrix::~BareSparseMatrix(){
 CoffedSparseMatrix::CoffedSparseMatrix(size_t size) : BareSparseMatrix(size){
     col_coefficients = new dtype[size];
     row_coefficients = new dtype[size];
+    clique_of_row = new size_t[size];
     for (auto i = 0; i < size; i++){
         col_coefficients[i] = row_coefficients[i] = 1.0;
+        clique_of_row[i] = NO_CLIQUE;
     }
 }
 
 dtype CoffedSparseMatrix::get(size_t row, size_t column){
+    return sparse_get(row, column) + clique_get(row, column);
+}
+
+dtype CoffedSparseMatrix::sparse_get(size_t row, size_t column){
     auto coffs = row_coefficients[row] * col_coefficients[column];
     if (coffs == 0)
         return 0;
     return BareSparseMatrix::get(row, column) * coffs;
 }
 
+dtype CoffedSparseMatrix::clique_get(size_t row, size_t column){
+    auto clique = clique_of_row[row];
+    if (clique == NO_CLIQUE || row == column || clique_of_row[column] != clique)
+        return 0;
+    return clique_strengths[clique] * row_coefficients[row] * col_coefficients[column];
+}
+
 void CoffedSparseMatrix::mul_row(size_t row, dtype factor){
     row_coefficients[row] *= factor;
     total = NAN;
@@ -139,16 +153,40 @@ void CoffedSparseMatrix::reset_mul_col(size_t col){
     total = NAN;
 }
 
+void CoffedSparseMatrix::set_clique(size_t const* members, size_t m_len, dtype strength){
+    auto clique = cliques.size();
+    for (auto i = 0; i < m_len; i++){
+        // a row in two cliques would be counted in both
+        assert(clique_of_row[members[i]] == NO_CLIQUE);
+    }
+    cliques.emplace_back(members, members + m_len);
+    std::sort(cliques.back().begin(), cliques.back().end());
+    clique_strengths.push_back(strength);
+    for (auto i = 0; i < m_len; i++){
+        clique_of_row[members[i]] = clique;
+    }
+}
+
+double CoffedSparseMatrix::clique_total(){
+    // every member is connected to all the others, so the total of a clique is its strength times
+    // the sum of its row coefficients times the sum of its column coefficients, without the diagonal
+    double ret = 0;
+    for (auto clique = 0; clique < cliques.size(); clique++){
+        double row_sum = 0, col_sum = 0, diagonal = 0;
+        for (auto member: cliques[clique]){
+            row_sum += row_coefficients[member];
+            col_sum += col_coefficients[member];
+            diagonal += row_coefficients[member] * col_coefficients[member];
+        }
+        ret += clique_strengths[clique] * (row_sum * col_sum - diagonal);
+    }
+    return ret;
+}
+
 std::vector<std::vector<size_t>> CoffedSparseMatrix::non_zero_columns(){
     std::vector<std::vector<size_t>> ret;
     for (auto row_num = 0; row_num < size; row_num++){
-        auto& row = rows[row_num];
-        std::vector<size_t> el;
-        el.reserve(row.size());
-        for (auto&& it = row.cbegin(); it != row.cend(); it++){
-            el.push_back(it->first);
-        }
-        ret.push_back(el);
+        ret.push_back(non_zero_column(row_num));
     }
     return ret;
 }
@@ -160,12 +198,22 @@ std::vector<size_t> CoffedSparseMatrix::non_zero_column(size_t row_num){
     for (auto&& it = row.cbegin(); it != row.cend(); it++){
         ret.push_back(it->first);
     }
+    auto clique = clique_of_row[row_num];
+    if (clique != NO_CLIQUE){
+        for (auto member: cliques[clique]){
+            if (member != row_num)
+                ret.push_back(member);
+        }
+        std::sort(ret.begin(), ret.end());
+        ret.erase(std::unique(ret.begin(), ret.end()), ret.end());
+    }
     return ret;
 }
 
 CoffedSparseMatrix::~CoffedSparseMatrix(){
     delete[] row_coefficients;
     delete[] col_coefficients;
+    delete[] clique_of_row;
 }
 // endregion
 // region parasymbolic
@@ -243,6 +291,8 @@ void ParasymbolicMatrix::rebuild_row(size_t row_num){
             //we are done with this row
             break;
         }
+        // a connection that is also in a clique of any component gets it here, and not from the clique
+        total += cliques_get(row_num, min_index);
         row_indices.push_back(min_index);
         row_data.push_back(total);
         inner.columns[min_index].insert(row_num);
@@ -292,14 +342,23 @@ void ParasymbolicMatrix::rebuild_factor(dtype factor){
     }
 }
 
+dtype ParasymbolicMatrix::cliques_get(size_t row, size_t column){
+    dtype ret = 0;
+    for (auto comp_num = 0; comp_num < component_count; comp_num++){
+        ret += components[comp_num]->clique_get(row, column) * factors[comp_num];
+    }
+    return ret;
+}
+
 dtype ParasymbolicMatrix::get(size_t row, size_t column){
     if (calc_lock)
         return NAN;
     auto& row_indices = inner.indices[row];
     auto bin = binary_search(row_indices, column);
-    if (bin == -1)
-        return 0;
-    return inner.data[row][bin];
+    // the cliques are only in inner where there are other connections
+    if (bin != -1)
+        return inner.data[row][bin];
+    return cliques_get(row, column);
 }
 dtype ParasymbolicMatrix::get(size_t comp, size_t row, size_t column){
     if (calc_lock)
@@ -315,6 +374,12 @@ double ParasymbolicMatrix::total(){
         auto& data = inner.data[i];
         for (auto j = data.cbegin(); j < data.cend(); j++)
             ret += *j;
+        // the connections of the cliques that are in inner are counted by the cliques' totals
+        for (auto column: inner.indices[i])
+            ret -= cliques_get(i, column);
+    }
+    for (auto comp_num = 0; comp_num < component_count; comp_num++){
+        ret += components[comp_num]->clique_total() * factors[comp_num];
     }
     return (float)ret;
 }
@@ -323,8 +388,65 @@ size_t ParasymbolicMatrix::get_size(){
     return inner.size;
 }
 
+std::vector<CliqueContagion> ParasymbolicMatrix::clique_contagion(dtype const* A_v,
+                        size_t const * A_non_zero_indices, size_t nzi_len){
+    // bucket the contagious rows by their clique in each component that has cliques (a counting sort),
+    // so each row only goes over the contagious members of its own clique
+    std::vector<CliqueContagion> ret(component_count);
+    for (auto comp_num = 0; comp_num < component_count; comp_num++){
+        auto comp = components[comp_num];
+        if (comp->cliques.empty())
+            continue;
+        auto& contagion = ret[comp_num];
+        contagion.offsets.assign(comp->cliques.size() + 1, 0);
+        for (auto nz_index = 0; nz_index < nzi_len; nz_index++){
+            auto clique = comp->clique_of_row[A_non_zero_indices[nz_index]];
+            if (clique != NO_CLIQUE)
+                contagion.offsets[clique + 1]++;
+        }
+        for (auto clique = 0; clique < comp->cliques.size(); clique++){
+            contagion.offsets[clique + 1] += contagion.offsets[clique];
+        }
+        contagion.members.resize(contagion.offsets.back());
+        contagion.weights.resize(contagion.offsets.back());
+        std::vector<size_t> next(contagion.offsets.begin(), contagion.offsets.end() - 1);
+        for (auto nz_index = 0; nz_index < nzi_len; nz_index++){
+            auto j = A_non_zero_indices[nz_index];
+            auto clique = comp->clique_of_row[j];
+            if (clique == NO_CLIQUE)
+                continue;
+            auto position = next[clique]++;
+            contagion.members[position] = j;
+            contagion.weights[position] = A_v[j] * comp->col_coefficients[j];
+        }
+    }
+    return ret;
+}
+
+double ParasymbolicMatrix::clique_not_infected(size_t comp_num, size_t row_num,
+                        std::vector<CliqueContagion> const& contagion){
+    // the probability of a row not to be infected by any of the other contagious members of its clique
+    auto comp = components[comp_num];
+    auto& comp_contagion = contagion[comp_num];
+    if (comp_contagion.offsets.empty())
+        return 1;
+    auto clique = comp->clique_of_row[row_num];
+    if (clique == NO_CLIQUE)
+        return 1;
+    auto row_strength = comp->clique_strengths[clique] * comp->row_coefficients[row_num] * factors[comp_num];
+    auto& row_indices = inner.indices[row_num];
+    double ret = 1;
+    for (auto i = comp_contagion.offsets[clique]; i < comp_contagion.offsets[clique + 1]; i++){
+        auto member = comp_contagion.members[i];
+        // the members that the row has other connections with are in inner, along with their clique strength
+        if (member != row_num && binary_search(row_indices, member) == -1)
+            ret *= 1 - row_strength * comp_contagion.weights[i];
+    }
+    return ret;
+}
+
 void ParasymbolicMatrix::_prob_any_row(size_t row_num, dtype const* A_v, size_t v_len, size_t const * A_non_zero_indices, size_t nzi_len,
-                        dtype** AF_out, size_t* o_size){
+                        std::vector<CliqueContagion> const* contagion, dtype** AF_out, size_t* o_size){
     dtype inv_ret = 1;
     size_t nz_index = 0;
     auto& row_indices = inner.indices[row_num];
@@ -346,6 +468,9 @@ void ParasymbolicMatrix::_prob_any_row(size_t row_num, dtype const* A_v, size_t
             nz_index++;
         }
     }
+    for (auto comp_num = 0; comp_num < component_count; comp_num++){
+        inv_ret *= clique_not_infected(comp_num, row_num, *contagion);
+    }
     (*AF_out)[row_num] = 1-inv_ret;
 }
 
@@ -353,10 +478,12 @@ void ParasymbolicMatrix::_prob_any(dtype const* A_v, size_t v_len, size_t const
                         dtype** AF_out, size_t* o_size){
     *o_size = inner.size;
     *AF_out = new dtype[inner.size];
+    auto contagion = clique_contagion(A_v, A_non_zero_indices, nzi_len);
+    auto contagion_ptr = &contagion;
     std::vector<std::future<void>> futures (inner.size);
     for (auto row_num = 0; row_num < inner.size; row_num++){
         futures[row_num] = pool->push([=](int) {
-                this->_prob_any_row(row_num, A_v, v_len, A_non_zero_indices, nzi_len, AF_out, o_size);
+                this->_prob_any_row(row_num, A_v, v_len, A_non_zero_indices, nzi_len, contagion_ptr, AF_out, o_size);
             }
         );
     }
@@ -366,6 +493,71 @@ void ParasymbolicMatrix::_prob_any(dtype const* A_v, size_t v_len, size_t const
 
 }
 
+void ParasymbolicMatrix::_prob_any_by_component_row(size_t row_num, dtype const* A_v,
+                        size_t const * A_non_zero_indices, size_t nzi_len,
+                        std::vector<CliqueContagion> const* contagion, dtype* out){
+    // the log of the probability not to be infected through each component.
+    // the log of each entry is split between the components by their share of the entry,
+    // so the product of the components' probabilities not to be infected is that of the whole row
+    std::vector<double> log_not_infected(component_count, 0);
+    size_t nz_index = 0;
+    auto& row_indices = inner.indices[row_num];
+    auto& row_data = inner.data[row_num];
+    size_t r_i_index = 0;
+    size_t t_i_len = row_indices.size();
+    while (r_i_index != t_i_len && nz_index != nzi_len){
+        auto i = row_indices[r_i_index];
+        auto j = A_non_zero_indices[nz_index];
+        if (i < j){
+            r_i_index++;
+        }
+        else if (j < i){
+            nz_index++;
+        }
+        else /*j == i*/{
+            auto total = row_data[r_i_index];
+            if (total != 0){
+                // an entry that infects for sure (like in _prob_any, where it zeroes the product)
+                auto log_entry = log(std::max<double>(1 - total * A_v[j], 0));
+                for (auto comp_num = 0; comp_num < component_count; comp_num++){
+                    // including the clique of the component, if the connection is in one
+                    auto comp_value = components[comp_num]->get(row_num, j) * factors[comp_num];
+                    if (comp_value == 0)
+                        continue;
+                    log_not_infected[comp_num] += log_entry * comp_value / total;
+                }
+            }
+            r_i_index++;
+            nz_index++;
+        }
+    }
+    for (auto comp_num = 0; comp_num < component_count; comp_num++){
+        // the cliques are only in their own component
+        log_not_infected[comp_num] += log(std::max<double>(clique_not_infected(comp_num, row_num, *contagion), 0));
+        out[row_num * component_count + comp_num] = 1 - exp(log_not_infected[comp_num]);
+    }
+}
+
+void ParasymbolicMatrix::_prob_any_by_component(dtype const* A_v, size_t v_len, size_t const * A_non_zero_indices,
+                        size_t nzi_len, dtype** AF_out, size_t* o_size){
+    // row major, a row of component_count probabilities per agent
+    *o_size = inner.size * component_count;
+    *AF_out = new dtype[*o_size];
+    auto out = *AF_out;
+    auto contagion = clique_contagion(A_v, A_non_zero_indices, nzi_len);
+    auto contagion_ptr = &contagion;
+    std::vector<std::future<void>> futures (inner.size);
+    for (auto row_num = 0; row_num < inner.size; row_num++){
+        futures[row_num] = pool->push([=](int) {
+                this->_prob_any_by_component_row(row_num, A_v, A_non_zero_indices, nzi_len, contagion_ptr, out);
+            }
+        );
+    }
+    for (auto row_num = 0; row_num < inner.size; row_num++){
+        futures[row_num].get();
+    }
+}
+
 void ParasymbolicMatrix::operator*=(dtype rhs){
     for (auto comp_num = 0; comp_num < component_count; comp_num++){
         factors[comp_num] *= rhs;
@@ -392,6 +584,20 @@ void ParasymbolicMatrix::mul_sub_col(size_t component, size_t col, dtype factor)
     if (!calc_lock) rebuild_column(col);
 }
 
+void ParasymbolicMatrix::mul_sub_rows_cols(size_t component, size_t const* A_indices, size_t i_len, dtype factor){
+    auto comp = components[component];
+    for (auto i = 0; i < i_len; i++){
+        comp->mul_row(A_indices[i], factor);
+        comp->mul_col(A_indices[i], factor);
+    }
+    if (calc_lock)
+        return;
+    for (auto i = 0; i < i_len; i++){
+        rebuild_row(A_indices[i]);
+        rebuild_column(A_indices[i]);
+    }
+}
+
 void ParasymbolicMatrix::set_sub_row(size_t component, size_t row, dtype coeff){
     auto comp = components[component];
     comp->set_row(row, coeff);
@@ -422,6 +628,16 @@ void ParasymbolicMatrix::batch_set(size_t component_num, size_t row, size_t cons
     if (!calc_lock) rebuild_row(row);
 }
 
+void ParasymbolicMatrix::batch_set_clique(size_t component_num, size_t const* A_members, size_t m_len, dtype strength){
+    components[component_num]->set_clique(A_members, m_len, strength);
+    if (calc_lock)
+        return;
+    // the cliques are only in inner where there are other connections, in the rows of their members
+    for (auto i = 0; i < m_len; i++){
+        rebuild_row(A_members[i]);
+    }
+}
+
 void ParasymbolicMatrix::set_calc_lock(bool value){
     calc_lock = value;
     if (!calc_lock) rebuild_all();
@@ -4,6 +4,7 @@
 #include <vector>
 #include <tuple>
 #include <unordered_set>
+#include <cstdint>
 
 typedef float dtype;
 
@@ -28,20 +29,33 @@ class BareSparseMatrix{
         virtual ~BareSparseMatrix();
 };
 
+// the index of the clique of a row that is not in any clique
+const size_t NO_CLIQUE = SIZE_MAX;
+
 class CoffedSparseMatrix: public BareSparseMatrix{
     private:
         dtype* col_coefficients;
         dtype* row_coefficients;
+        // fully connected sets of rows (cliques), stored implicitly as their members and the strength of every
+        // connection between two of them. each row is in a single clique at most (asserted when set).
+        // a connection of a clique adds to the connections of the other components between the same rows
+        std::vector<std::vector<size_t>> cliques;
+        std::vector<dtype> clique_strengths;
+        size_t* clique_of_row;
         friend class ParasymbolicMatrix;
     public:
         CoffedSparseMatrix(size_t size);
         dtype get(size_t row, size_t column);
+        dtype sparse_get(size_t row, size_t column);
+        dtype clique_get(size_t row, size_t column);
         void mul_row(size_t row, dtype factor);
         void mul_col(size_t col, dtype factor);
         void set_row(size_t row, dtype coeff);
         void set_col(size_t row, dtype coeff);
         void reset_mul_row(size_t row);
         void reset_mul_col(size_t col);
+        void set_clique(size_t const* members, size_t m_len, dtype strength);
+        double clique_total();
         virtual ~CoffedSparseMatrix();
 
         std::vector<std::vector<size_t>> non_zero_columns();
@@ -61,6 +75,15 @@ class FastSparseMatrix{
         ~FastSparseMatrix();
 };
 
+// the contagious members of the cliques of a single component, gathered once for each prob_any call
+struct CliqueContagion{
+    // the contagious members of clique i are members[offsets[i]:offsets[i + 1]]
+    std::vector<size_t> offsets;
+    std::vector<size_t> members;
+    // the contagiousness of each of them, times its column coefficient
+    std::vector<dtype> weights;
+};
+
 class ParasymbolicMatrix{
     private:
         size_t component_count;
@@ -75,9 +98,15 @@ class ParasymbolicMatrix{
         void rebuild_row(size_t);
         void rebuild_column(size_t);
         void rebuild_factor(dtype);
+        dtype cliques_get(size_t row, size_t column);
 
+        std::vector<CliqueContagion> clique_contagion(dtype const* A_v, size_t const * A_non_zero_indices,
+                        size_t nzi_len);
+        double clique_not_infected(size_t comp_num, size_t row_num, std::vector<CliqueContagion> const& contagion);
         void _prob_any_row(size_t row_num, dtype const* A_v, size_t v_len, size_t const * A_non_zero_indices, size_t nzi_len,
-                        dtype** AF_out, size_t* o_size);
+                        std::vector<CliqueContagion> const* contagion, dtype** AF_out, size_t* o_size);
+        void _prob_any_by_component_row(size_t row_num, dtype const* A_v, size_t const * A_non_zero_indices,
+                        size_t nzi_len, std::vector<CliqueContagion> const* contagion, dtype* out);
     public:
         ParasymbolicMatrix(size_t size, size_t component_count);
         dtype get(size_t row, size_t column);
@@ -86,16 +115,20 @@ class ParasymbolicMatrix{
         size_t get_size();
         void _prob_any(dtype const* A_v, size_t v_len, size_t const * A_non_zero_indices, size_t nzi_len,
                         dtype** AF_out, size_t* o_size);
+        void _prob_any_by_component(dtype const* A_v, size_t v_len, size_t const * A_non_zero_indices, size_t nzi_len,
+                        dtype** AF_out, size_t* o_size);
         void operator*=(dtype rhs);
         void set_factors(dtype const* A_factors, size_t f_len);
         void mul_sub_row(size_t component, size_t row, dtype factor);
         void mul_sub_col(size_t component, size_t col, dtype factor);
+        void mul_sub_rows_cols(size_t component, size_t const* A_indices, size_t i_len, dtype factor);
         void reset_mul_row(size_t component, size_t row);
         void reset_mul_col(size_t component, size_t col);
         void set_sub_row(size_t component, size_t row, dtype coeff);
         void set_sub_col(size_t component, size_t col, dtype coeff);
         void batch_set(size_t component_num, size_t row, size_t const* A_columns, size_t c_len,
          dtype const* A_values, size_t v_len);
+        void batch_set_clique(size_t component_num, size_t const* A_members, size_t m_len, dtype strength);
         void set_calc_lock(bool value);
         virtual ~ParasymbolicMatrix();
         std::vector<std::vector<std::vector<size_t>>> non_zero_columns();
@@ -0,0 +1,36 @@
+"""
+Profile a whole run of main (with the same command line arguments) under yappi,
+and save the results in callgrind format to the profilings folder.
+For a per step profile of the simulation, use the --profile and --profile-steps arguments of simulate instead.
+set QCACHEGRIND_PATH to a qcachegrind executable to open the results when done.
+(this module must not be named profile, since that shadows the standard library module that cProfile imports)
+"""
+import os
+import subprocess
+from pathlib import Path
+from time import time
+from warnings import warn
+
+import yappi
+
+import main
+from project_structure import SOURCE_FOLDER
+
+qcachegrind_path = os.environ.get("QCACHEGRIND_PATH")
+
+if __name__ == "__main__":
+    yappi.start()
+    main.main()
+    yappi.stop()
+
+    stats = yappi.get_func_stats()
+    dest_folder = SOURCE_FOLDER / "profilings"
+    dest_folder.mkdir(parents=True, exist_ok=True)
+    dest_path = dest_folder / f"callgrind.out.{int(time())}"
+    stats.save(str(dest_path), "CALLGRIND")
+    print(f"saved profile to {dest_path}")
+
+    if qcachegrind_path and Path(qcachegrind_path).exists():
+        subprocess.Popen([str(Path(qcachegrind_path).absolute()), str(dest_path)], close_fds=True)
+    else:
+        warn("set QCACHEGRIND_PATH to a valid path to open results")
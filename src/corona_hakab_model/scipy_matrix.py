@@ -1,10 +1,17 @@
 from contextlib import contextmanager
+from time import perf_counter
 
 import numpy as np
 from scipy.sparse import lil_matrix
 
 
 class ScipyMatrix:
+    # how many times the matrix was rebuilt, and how long it took, for profiling
+    rebuild_count = 0
+    rebuild_time = 0.0
+    # the log matrix split by the components, built when first needed after each change
+    component_lgs = None
+
     def __init__(self, size, depth):
         self.size = size
         self.sub_matrices = [lil_matrix((size, size), dtype=np.float32) for _ in range(depth)]
@@ -15,6 +22,8 @@ class ScipyMatrix:
         self.rebuild_all()
 
     def rebuild_all(self):
+        start = perf_counter()
+        self.component_lgs = None
         self.sum = sum(s * c for (s, c) in zip(self.sub_matrices, self.coffs))
 
         self.lg = lil_matrix((self.size, self.size), dtype=np.float32)
@@ -24,6 +33,8 @@ class ScipyMatrix:
         # updates the log matrix if non zeros are found
         if len(nz[0]):
             self.lg[nz] = np.log(1 - self.sum[nz])
+        self.rebuild_count += 1
+        self.rebuild_time += perf_counter() - start
 
     def total(self):
         return self.sum.sum()
@@ -32,8 +43,21 @@ class ScipyMatrix:
         ret = self.lg.dot(v)
         return 1 - np.exp(ret)
 
+    def prob_any_by_component(self, v):
+        """
+        like prob_any, but the probability of each row through each of the components (as columns).
+        the log of each entry is split between the components by their share of the entry,
+        so the combined probability of a row is 1 - prod(1 - its components' probabilities)
+        """
+        if self.component_lgs is None:
+            lg_share = self.lg.tocsr().multiply(self.sum.tocsr().power(-1))
+            self.component_lgs = [lg_share.multiply(s * c).tocsr() for (s, c) in zip(self.sub_matrices, self.coffs)]
+        ret = np.stack([component_lg.dot(v) for component_lg in self.component_lgs], axis=1)
+        return 1 - np.exp(ret)
+
     def __imul__(self, other):
         self.coffs = [c * other for c in self.coffs]
+        self.component_lgs = None
         if not self.build_lock:
             nz = self.sum.nonzero()
             self.lg = lil_matrix((self.size, self.size), dtype=np.float32)
@@ -57,6 +81,12 @@ class ScipyMatrix:
         if not self.build_lock:
             self.rebuild_all()
 
+    def mul_sub_rows_cols(self, comp, indices, factor):
+        self.sub_matrices[comp][indices] *= factor
+        self.sub_matrices[comp][:, indices] *= factor
+        if not self.build_lock:
+            self.rebuild_all()
+
     def __setitem__(self, key, value):
         comp, row, indices = key
         if not len(indices):
@@ -66,6 +96,20 @@ class ScipyMatrix:
         if not self.build_lock:
             self.rebuild_all()
 
+    def set_clique(self, comp, members, strength):
+        """
+        connect every two different members with the given strength
+        """
+        members = np.asarray(members)
+        rows = np.repeat(members, len(members))
+        columns = np.tile(members, len(members))
+        not_self = rows != columns
+        if not np.any(not_self):
+            return
+        self.sub_matrices[comp][rows[not_self], columns[not_self]] = strength
+        if not self.build_lock:
+            self.rebuild_all()
+
     @contextmanager
     def lock_rebuild(self):
         self.build_lock = False
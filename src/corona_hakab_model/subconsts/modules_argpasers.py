@@ -65,8 +65,8 @@ def get_simulation_args_parser():
                      help='Previously exported matrix data file to use in the simulation')
     sim.add_argument('--connection_data',
                      dest='connection_data',
-                     default=OUTPUT_FOLDER / 'connection_data.pickle',
-                     help='Previously exported agent connection data file to use in the simulation')
+                     default=OUTPUT_FOLDER / 'connection_data',
+                     help='Previously exported agent connection data folder to use in the simulation')
     sim.add_argument('--initial_sick',
                      dest='initial_sick_agents_path',
                      help='Output csv file for initial sick agents - after setup of simulation')
@@ -100,6 +100,17 @@ def get_simulation_args_parser():
                      action='store_true',
                      default=False,
                      help='Validates if the matrix generated is symmetric and all the inputs are probabilities')
+    sim.add_argument('--profile',
+                     dest='profile',
+                     default=None,
+                     help='Run the simulation steps under cProfile, and save the stats to this file')
+    sim.add_argument('--profile-steps',
+                     dest='profile_steps',
+                     nargs=2,
+                     type=int,
+                     metavar=('FIRST', 'LAST'),
+                     default=None,
+                     help='Profile only the steps FIRST to LAST (inclusive). Defaults to all the steps')
     sim.set_defaults(feature=True)
     compare_to_csv = subparser.add_parser("shift-real-life", help="First input is real life csv with "
                                                                   "statistics and seconds is simulation output."
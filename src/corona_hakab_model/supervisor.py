@@ -2,8 +2,10 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
 from functools import lru_cache
-from typing import Any, Callable, List, NamedTuple, Sequence, Union, Dict
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence, Union, Dict
 from pathlib import Path
+import csv
+import os
 import manager
 import numpy as np
 import pandas as pd
@@ -12,6 +14,8 @@ from common.state_machine import StochasticState
 from common.medical_state import ImmuneState
 from typing import TYPE_CHECKING
 from common.histogram import TimeHistograms
+from common.background_writer import SynchronousWriter
+from common.util import ColumnBuffer
 
 if TYPE_CHECKING:
     from common.state_machine import State
@@ -25,11 +29,19 @@ class SimulationProgression:
     # todo I want the supervisor to decide when the simulation ends
     # todo record write/read results as text
 
-    def __init__(self, supervisables: Sequence[Supervisable], manager: "manager.SimulationManager"):
-        self.supervisables = supervisables
+    def __init__(self, supervisables: Sequence[Supervisable], manager: "manager.SimulationManager",
+                 output_folder: Optional[str] = None):
+        self.graph = SupervisableGraph(supervisables)
+        self.supervisables = self.graph.outputs
         self.manager = manager
 
         self.time_vector = []
+        # if given an output folder, the values that are sampled each step are streamed to it as the simulation runs
+        self.streamed_supervisables = [s for s in self.graph.sources if isinstance(s, ValueSupervisable) and s.streamed]
+        self.results_stream = None
+        if output_folder is not None:
+            self.results_stream = ResultsStream(Path(output_folder) / "final_results.csv.partial",
+                                                [s.name() for s in self.streamed_supervisables])
 
     def snapshot(self, manager):
         t = self.manager.current_step
@@ -38,14 +50,24 @@ class SimulationProgression:
         # Assert the first snapshot is done at t=0 & there is a single snapshot at each time step
         assert self.time_vector[t] == t
 
-        for s in self.supervisables:
+        # only the sources sample the manager, everything else is derived from them on publish
+        for s in self.graph.sources:
             s.snapshot(manager)
 
-    def dump(self, filename):
+        if self.results_stream is not None:
+            self.results_stream.write_row(t, [s.data[-1] for s in self.streamed_supervisables])
+
+    def dump(self, filename, writer: Optional[SynchronousWriter] = None):
+        """
+        publish the results, and write them to the folder filename through writer (right away if None).
+        returns the final results
+        """
+        writer = writer or SynchronousWriter()
         file_name = Path(filename) / "final_results.csv"
         file_name.parent.mkdir(parents=True, exist_ok=True)
 
         tabular_supervisables = [s for s in self.supervisables if isinstance(s, TabularSupervisable)]
+        long_format_supervisables = [s for s in self.supervisables if isinstance(s, LongFormatSupervisable)]
         value_supervisables = [s for s in self.supervisables if isinstance(s, ValueSupervisable)]
 
         # Output each tabular sample to a new csv file
@@ -54,14 +76,87 @@ class SimulationProgression:
             for day, table in day_to_table_dict.items():
                 sample_file_name = file_name.parent / f"{s.name()} {day}.csv"
                 df = pd.DataFrame(table)
-                df.to_csv(sample_file_name)
+                writer.submit(df.to_csv, sample_file_name)
+
+        # Output each long format table to a single csv file, and the names of its coded columns to another
+        for s in long_format_supervisables:
+            writer.submit(pd.DataFrame(s.publish()).to_csv, file_name.parent / f"{s.name()}.csv", index=False)
+            for column, code_names in s.code_names().items():
+                writer.submit(pd.DataFrame({"code": np.arange(len(code_names)), "name": code_names}).to_csv,
+                              file_name.parent / f"{s.name()} {column} codes.csv", index=False)
+
+        if self.results_stream is not None:
+            # the final results are the completed stream, with the values derived from the whole run added
+            self.results_stream.close()
+            streamed = pd.read_csv(self.results_stream.path, index_col=0)
+            streamed_data = {s.key(): streamed.iloc[:, i].to_numpy() for i, s in enumerate(self.streamed_supervisables)}
+            all_data = dict((s.name(), streamed_data[s.key()]) if s.key() in streamed_data else s.publish()
+                            for s in value_supervisables)
+            df = pd.DataFrame(all_data, index=self.time_vector)
+            # the stream is only removed once the final results replace it
+            writer.submit(self._write_final_results, df, file_name, self.results_stream.path)
+            self.results_stream = None
+            return df
 
         all_data = dict([s.publish() for s in value_supervisables])
 
         df = pd.DataFrame(all_data, index=self.time_vector)
-        df.to_csv(file_name)
+        writer.submit(df.to_csv, file_name)
         return df
 
+    @staticmethod
+    def _write_final_results(df: pd.DataFrame, file_name: Path, stream_path: Path):
+        df.to_csv(file_name)
+        os.remove(stream_path)
+
+
+class SupervisableGraph:
+    """
+    supervisables compiled into a DAG, in which supervisables with equal keys (and their inputs) are shared.
+    only the sources, the supervisables that are not derived from others, sample the manager, once per step.
+    """
+
+    def __init__(self, supervisables: Sequence[Supervisable]):
+        self.nodes: Dict[Any, Supervisable] = {}
+        self.outputs = [self._add(s) for s in supervisables]
+        self.sources = [s for s in self.nodes.values() if not isinstance(s, _DerivedSupervisable)]
+
+    def _add(self, supervisable: Supervisable) -> Supervisable:
+        if isinstance(supervisable, _DerivedSupervisable):
+            supervisable.inputs = [self._add(i) for i in supervisable.inputs]
+        return self.nodes.setdefault(supervisable.key(), supervisable)
+
+
+class ResultsStream:
+    """
+    writes the values of each step to a csv file as soon as they are sampled,
+    so the results of a run can be read while it is in progress, or after it crashed.
+    the header row is the schema: the step column followed by the names of the values.
+    """
+
+    def __init__(self, path: Path, names: Sequence[str], fsync_interval: int = 10):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.rows = 0
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([""] + list(names))
+        self.file.flush()
+
+    def write_row(self, step: int, values: Sequence):
+        self.writer.writerow([step] + list(values))
+        self.rows += 1
+        # flushed every row so readers see it, but only synced to the disk every few rows since it is slow
+        self.file.flush()
+        if self.rows % self.fsync_interval == 0:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
 
 class Supervisable(ABC):
     @abstractmethod
@@ -79,6 +174,13 @@ class Supervisable(ABC):
     def name(self) -> str:
         pass
 
+    def key(self):
+        """
+        supervisables with equal keys compute the same values, and are shared in a SupervisableGraph.
+        by default, a supervisable is only equal to itself
+        """
+        return type(self), id(self)
+
     @classmethod
     @lru_cache
     def coerce(cls, arg, manager: "manager.SimulationManager") -> Supervisable:
@@ -196,6 +298,13 @@ class Supervisable(ABC):
         def __call__(self, manager):
             return _NewInfectedCount()
 
+    class StepTime:
+        def __init__(self, phase: Optional[str] = None):
+            self.phase = phase
+
+        def __call__(self, manager):
+            return _StepTimeSupervisable(self.phase)
+
     class CurrentInfectedTable:
         def __init__(self, *args, **kwargs):
             self.args = args
@@ -243,6 +352,9 @@ SupervisableMaker = Callable[[Any], Supervisable]
 
 
 class ValueSupervisable(Supervisable):
+    # whether a value is sampled on each snapshot, so it can be streamed as the simulation runs
+    streamed = True
+
     def __init__(self):
         self.data = []
 
@@ -279,6 +391,35 @@ class TabularSupervisable(Supervisable):
         return {name_i: data_i for name_i, data_i in zip(self.names(), self.data)}
 
 
+class LongFormatSupervisable(Supervisable):
+    """
+    a table sampled on some of the days, kept in long format (a row per sampled day and item) in a ColumnBuffer
+    """
+
+    def __init__(self, dtypes: Dict[str, Any], filter_fn: Callable[["manager.SimulationManager"], bool] = None):
+        self.buffer = ColumnBuffer({"day": np.int32, **dtypes})
+        self.filter = filter_fn
+
+    @abstractmethod
+    def get(self, manager: "manager.SimulationManager") -> Dict[str, np.ndarray]:
+        pass
+
+    def code_names(self) -> Dict[str, Sequence[str]]:
+        """
+        the names of the codes of each coded column
+        """
+        return {}
+
+    def snapshot(self, manager: "manager.SimulationManager"):
+        if self.filter is None or self.filter(manager):
+            columns = self.get(manager)
+            rows = len(next(iter(columns.values())))
+            self.buffer.extend(day=np.full(rows, manager.current_step), **columns)
+
+    def publish(self) -> Dict[str, np.ndarray]:
+        return self.buffer.view()
+
+
 class PeriodicReportSupervisable(TabularSupervisable):
     def __init__(self, interval):
         super().__init__(lambda manager: manager.current_step % interval == 0)
@@ -325,6 +466,9 @@ class LambdaValueSupervisable(ValueSupervisable):
     def name(self) -> str:
         return self._name
 
+    def key(self):
+        return type(self), self._name, self.lam
+
     def get(self, manager) -> float:
         return self.lam(manager)
 
@@ -340,6 +484,9 @@ class _StateSupervisable(ValueSupervisable):
     def name(self) -> str:
         return self.state.name
 
+    def key(self):
+        return type(self), self.state.name
+
 
 class _StateTotalSoFarSupervisable(ValueSupervisable):
     def __init__(self, state: State):
@@ -353,47 +500,86 @@ class _StateTotalSoFarSupervisable(ValueSupervisable):
     def name(self) -> str:
         return self.__name
 
+    def key(self):
+        return type(self), self.state.name
+
 
-class _CurrentInfectedTable(PeriodicReportSupervisable):
+class _CurrentInfectedTable(LongFormatSupervisable):
     def __init__(self, interval):
-        super().__init__(interval)
-        self.sick_states = None
-
-    def get(self, manager) -> Dict[str, List]:
-        if self.sick_states is None:
-            medical_states = manager.medical_machine.states_by_name.values()
-            self.sick_states = [s for s in medical_states if isinstance(s, StochasticState) or isinstance(s, ImmuneState)]
-
-        agent_ids = []
-        agent_ages = []
-        medical_status = []
-
-        for state in self.sick_states:
-            agent_ids += [agent.index for agent in state.agents]
-            agent_ages += [agent.age for agent in state.agents]
-            medical_status += [state.name] * state.agent_count
+        super().__init__(dict(agent_id=np.int64, agent_age=np.int32, medical_state=np.int8),
+                         lambda manager: manager.current_step % interval == 0)
+        self.is_sick_state = None
+        self.state_names = []
+
+    def get(self, manager) -> Dict[str, np.ndarray]:
+        machine = manager.medical_machine
+        if self.is_sick_state is None:
+            self.state_names = [state.name for state in machine.states]
+            # the extra last entry is for agents without a state, whose state index is -1
+            self.is_sick_state = np.array([isinstance(s, StochasticState) or isinstance(s, ImmuneState)
+                                           for s in machine.states] + [False])
+
+        state_index = machine.state_index[:len(manager.agents)]
+        agent_ids = np.flatnonzero(self.is_sick_state[state_index])
         return {
             "agent_id": agent_ids,
-            "agent_age": agent_ages,
-            "medical_status": medical_status
+            "agent_age": machine.agent_ages[agent_ids],
+            "medical_state": state_index[agent_ids]
         }
 
+    def code_names(self) -> Dict[str, Sequence[str]]:
+        return {"medical_state": self.state_names}
+
     def name(self) -> str:
         return "infected_table"
 
 
-class _DelayedSupervisable(ValueSupervisable):
-    def __init__(self, inner: ValueSupervisable, delay: int):
+class _DerivedSupervisable(ValueSupervisable):
+    """
+    a supervisable whose values are computed from the series of its inputs.
+    it does not sample the manager, its whole series is computed at once on publish
+    """
+
+    # the values are computed from the whole run, on publish
+    streamed = False
+
+    def __init__(self, inputs: Sequence[ValueSupervisable]):
         super().__init__()
-        self.inner = inner
+        self.inputs = list(inputs)
+
+    def get(self, manager: "manager.SimulationManager"):
+        raise NotImplementedError("derived supervisables are computed on publish")
+
+    def snapshot(self, manager: "manager.SimulationManager"):
+        pass
+
+    @abstractmethod
+    def compute(self, *series: np.ndarray) -> np.ndarray:
+        pass
+
+    def publish(self):
+        # the series keep the dtype of their inputs, only the ones that can have nans are floats
+        self.data = self.compute(*(np.asarray(i.publish()[1]) for i in self.inputs))
+        return super().publish()
+
+    def key(self):
+        return (type(self), self.name()) + tuple(i.key() for i in self.inputs)
+
+
+class _DelayedSupervisable(_DerivedSupervisable):
+    def __init__(self, inner: ValueSupervisable, delay: int):
+        super().__init__([inner])
         self.delay = delay
 
-    def get(self, manager: "manager.SimulationManager") -> float:
-        desired_date = manager.current_step - self.delay
-        if desired_date < 0:
-            return np.nan
-        else:
-            return self.inner.data[desired_date]
+    @property
+    def inner(self):
+        return self.inputs[0]
+
+    def compute(self, series: np.ndarray) -> np.ndarray:
+        delayed = np.full(len(series), np.nan)
+        if self.delay < len(series):
+            delayed[self.delay:] = series[:len(series) - self.delay]
+        return delayed
 
     def name(self) -> str:
         return self.inner.name() + f" + {self.delay} days"
@@ -401,47 +587,28 @@ class _DelayedSupervisable(ValueSupervisable):
     def names(self):
         return [n + f" + {self.delay} days" for n in self.inner.names()]
 
-    def snapshot(self, manager: "manager.SimulationManager"):
-        self.inner.snapshot(manager)
-        super().snapshot(manager)
-
 
-class _NameOverrideSupervisable(ValueSupervisable):
+class _NameOverrideSupervisable(_DerivedSupervisable):
     def __init__(self, inner: ValueSupervisable, name: str):
-        super().__init__()
+        super().__init__([inner])
         self.__name = name
-        self.inner = inner
 
-    def get(self, manager: "manager.SimulationManager"):
-        return self.inner.get(manager)
-
-    def snapshot(self, manager: "manager.SimulationManager"):
-        self.inner.snapshot(manager)
-        super().snapshot(manager)
-
-    def publish(self):
-        return super().publish()
+    def compute(self, series: np.ndarray) -> np.ndarray:
+        return series
 
     def name(self) -> str:
         return self.__name
 
 
-class _DiffSupervisable(ValueSupervisable):
+class _DiffSupervisable(_DerivedSupervisable):
     def __init__(self, inner: ValueSupervisable):
-        super().__init__()
-        self.inner = inner
+        super().__init__([inner])
 
-    def get(self, manager: "manager.SimulationManager") -> float:
-        if manager.current_step < 1:
-            return 0
-        return self.inner.data[manager.current_step] - self.inner.data[manager.current_step - 1]
-
-    def snapshot(self, manager: "manager.SimulationManager"):
-        self.inner.snapshot(manager)
-        super().snapshot(manager)
+    def compute(self, series: np.ndarray) -> np.ndarray:
+        return np.diff(series, prepend=series[:1])
 
     def name(self) -> str:
-        return self.inner.name() + " diff"
+        return self.inputs[0].name() + " diff"
 
 
 class VectorSupervisable(ValueSupervisable, ABC):
@@ -474,22 +641,21 @@ class _StackedFloatSupervisable(VectorSupervisable):
         return [i.name() for i in self.inners]
 
 
-class _SumSupervisable(ValueSupervisable):
+class _SumSupervisable(_DerivedSupervisable):
     def __init__(self, inners: List[ValueSupervisable], **kwargs):
-        super().__init__()
-        self.inners = inners
+        super().__init__(inners)
         self.kwargs = kwargs
 
-    def get(self, manager: "manager.SimulationManager") -> float:
-        return sum(s.get(manager) for s in self.inners)
+    def compute(self, *series: np.ndarray) -> np.ndarray:
+        return np.sum(series, axis=0)
 
     def names(self):
-        return ["Total(" + ", ".join(names) + ")" for names in zip(*(i.names() for i in self.inners))]
+        return ["Total(" + ", ".join(names) + ")" for names in zip(*(i.names() for i in self.inputs))]
 
     def name(self) -> str:
         if "name" in self.kwargs:
             return self.kwargs["name"]
-        return "Total(" + ", ".join(n.name() for n in self.inners)
+        return "Total(" + ", ".join(n.name() for n in self.inputs)
 
 
 # todo this is broken. needs adaptation to parasymbolic matrix
@@ -510,6 +676,9 @@ class _EffectiveR0Supervisable(ValueSupervisable):
     def name(self) -> str:
         return "effective R"
 
+    def key(self):
+        return type(self),
+
 
 class _NewInfectedCount(ValueSupervisable):
     def __init__(self):
@@ -521,19 +690,41 @@ class _NewInfectedCount(ValueSupervisable):
     def name(self) -> str:
         return "new infected"
 
+    def key(self):
+        return type(self),
 
-class _GrowthFactor(ValueSupervisable):
-    def __init__(self, new_infected_supervisor, sum_supervisor):
+
+class _StepTimeSupervisable(ValueSupervisable):
+    """
+    the wall time (in seconds) of a phase of each step, or of all of its phases if phase is None.
+    the step is sampled at its snapshot, so the time of the supervisor snapshot phase itself is not included.
+    """
+
+    def __init__(self, phase: Optional[str] = None):
         super().__init__()
-        self.new_infected_supervisor = new_infected_supervisor
-        self.sum_supervisor = sum_supervisor
+        self.phase = phase
 
     def get(self, manager) -> float:
-        new_infected = self.new_infected_supervisor.get(manager)
-        sum = self.sum_supervisor.get(manager)
-        if sum == 0:
-            return np.nan
-        return new_infected / sum
+        if self.phase is None:
+            return manager.step_profiler.total()
+        return manager.step_profiler.current[self.phase]
+
+    def name(self) -> str:
+        if self.phase is None:
+            return "step time"
+        return f"step time - {self.phase}"
+
+    def key(self):
+        return type(self), self.phase
+
+
+class _GrowthFactor(_DerivedSupervisable):
+    def __init__(self, new_infected_supervisor, sum_supervisor):
+        super().__init__([new_infected_supervisor, sum_supervisor])
+
+    def compute(self, new_infected: np.ndarray, total: np.ndarray) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(total == 0, np.nan, new_infected / total)
 
     def name(self) -> str:
         return "growth factor"
@@ -555,24 +746,15 @@ class _TimeBasedHistograms(Supervisable):
         return {self.name(): self.histograms.get()}
 
 
-class _PostProcessSupervisor(ValueSupervisable):
+class _PostProcessSupervisor(_DerivedSupervisable):
     def __init__(self, supervisables: Union[List[Supervisable], Supervisable], func: Callable, name: str):
-        super().__init__()
-        self._name = name
-        self.func = func
         if isinstance(supervisables, Supervisable):
             supervisables = [supervisables]
-        self.supervisables = supervisables
-
-    def get(self, manager: "manager.SimulationManager"):
-        pass
-
-    def snapshot(self, manager: "manager.SimulationManager"):
-        [v.snapshot(manager) for v in self.supervisables]
-        # super().snapshot(manager)
+        super().__init__(supervisables)
+        self._name = name
+        self.func = func
 
-    def publish(self):
-        vectors = [s.publish()[1] for s in self.supervisables]
+    def compute(self, *vectors: np.ndarray) -> np.ndarray:
         expected_length_of_result = len(vectors[0])
 
         res = self.func(*vectors)
@@ -583,8 +765,7 @@ class _PostProcessSupervisor(ValueSupervisable):
             temp[-len(res):] = res
             res = temp
 
-        self.data = res
-        return super().publish()
+        return res
 
     def name(self) -> str:
         return self._name
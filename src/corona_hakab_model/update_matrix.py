@@ -27,6 +27,9 @@ class UpdateMatrixManager:
         self.logger = manager.logger
         self.consts = manager.consts
         self.size = len(manager.agents)
+        # the random connections of each agent of each connection type, after the policies' factors.
+        # kept up to date with the factors, only at the cells they change
+        self.effective_random_connections = manager.num_of_random_connections * manager.random_connections_factor
         # todo unpack more important information
         self.normalize_factor = None
         self.total_contagious_probability = None
@@ -82,12 +85,27 @@ class UpdateMatrixManager:
         self.matrix.reset_mul_col(connection_type, index)
         self.manager.agents_connections_coeffs[index, connection_type] = 1
         self.manager.random_connections_factor[index, connection_type] = 1
+        self.effective_random_connections[index, connection_type] = \
+            self.manager.num_of_random_connections[index, connection_type]
 
     def factor_agent(self, index, connection_type, factor):
         self.matrix.mul_sub_row(connection_type, index, factor)
         self.matrix.mul_sub_col(connection_type, index, factor)
         self.manager.agents_connections_coeffs[index, connection_type] *= factor
         self.manager.random_connections_factor[index, connection_type] *= factor
+        self.effective_random_connections[index, connection_type] *= factor
+
+    def factor_agents(self, indices: np.ndarray, connection_type, factor):
+        # only in builds of the matrix that have it
+        if hasattr(self.matrix, "mul_sub_rows_cols"):
+            self.matrix.mul_sub_rows_cols(connection_type, indices.astype(np.uint64, copy=False), factor)
+        else:
+            for index in indices.tolist():
+                self.matrix.mul_sub_row(connection_type, index, factor)
+                self.matrix.mul_sub_col(connection_type, index, factor)
+        self.manager.agents_connections_coeffs[indices, connection_type] *= factor
+        self.manager.random_connections_factor[indices, connection_type] *= factor
+        self.effective_random_connections[indices, connection_type] *= factor
 
     def reset_policies_by_connection_type(self, connection_type, agents_ids_to_reset=None):
         if agents_ids_to_reset is None:
@@ -143,6 +161,20 @@ class UpdateMatrixManager:
         for connection_type, connection_factor in factor.items():
             self.factor_agent(agent.index, connection_type, connection_factor)
 
+    def change_agents_relations_by_factor(self, indices: np.ndarray, factor):
+        """
+        like change_agent_relations_by_factor, but for many (unique) agents at once
+        """
+        if len(indices) == 0:
+            return
+        try:
+            float(factor)  # If the input is a number, we create dict with the factor
+            factor = {connection: factor for connection in ConnectionTypes}
+        except TypeError:  # If they do not succeed, proceed
+            pass
+        for connection_type, connection_factor in factor.items():
+            self.factor_agents(indices, connection_type, connection_factor)
+
     def validate_matrix(self):
         submatrixes_rows_nonzero_columns = self.matrix.non_zero_columns()
         for rows_nonzero_columns in submatrixes_rows_nonzero_columns:
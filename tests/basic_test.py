@@ -1,4 +1,11 @@
-from common.util import HasDuration, Queue
+import jsonpickle
+import numpy as np
+
+from common.background_writer import BackgroundWriter
+from common.distributions import Discrete, dist
+from common.state_machine import PendingTransfers, StateMachine, StochasticState, TerminalState, Transfers
+from common.step_profiler import StepProfiler
+from common.util import BucketDict, HasDuration, IndexQueue, Queue
 
 
 def test_queue():
@@ -33,5 +40,140 @@ def test_queue():
     assert advance() == {"f_0"}
 
 
+def test_index_queue():
+    queue = IndexQueue()
+    queue.push([0, 1, 2, 3], [0, 2, 2, 5])
+    queue.push([4], 2)
+
+    assert set(queue.pop(0)) == {0}
+    assert set(queue.pop(1)) == set()
+    assert set(queue.pop(2)) == {1, 2, 4}
+    # day 5 is skipped, so its agents are dropped
+    assert set(queue.pop(6)) == set()
+    queue.push([5], 10)
+    assert set(queue.pop(10)) == {5}
+
+
+def test_pending_transfers():
+    def transfers(agents, durations):
+        return Transfers(np.array(agents), np.zeros(len(agents), dtype=np.int8), np.ones(len(agents), dtype=np.int8),
+                         np.array(durations))
+
+    def advance():
+        agents, _, _ = queue.advance()
+        return set(agents)
+
+    queue = PendingTransfers()
+    queue.extend(transfers([0, 1, 2, 3], [1, 2, 4, 3]))
+    queue.extend(transfers([4], [1]))
+    assert list(queue.peek_counts()) == [2, 1, 1, 1]
+
+    assert advance() == {0, 4}
+    queue.extend(transfers([5, 6], [1, 4]))
+    assert advance() == {1, 5}
+    assert advance() == {3}
+    assert advance() == {2}
+    assert advance() == {6}
+    assert len(queue) == 0
+    queue.extend(transfers([7], [6]))
+    for _ in range(5):
+        assert advance() == set()
+    assert advance() == {7}
+
+
+def test_age_buckets():
+    class Agent:
+        def __init__(self, index, age):
+            self.index = index
+            self.age = age
+
+    def days(n):
+        return lambda size=None: np.full(size, n)
+
+    start = StochasticState("start")
+    machine = StateMachine(start)
+    end = TerminalState("end")
+    # the destination depends on being at most 20, the duration on being at most 50
+    start.add_transfer(end, BucketDict({50: days(1), 100: days(2)}), BucketDict({20: 1., 100: 1.}))
+
+    ages = np.array([0, 20, 21, 50, 51, 120])
+    start.add_many(Agent(i, age) for i, age in enumerate(ages))
+    assert list(machine.bucket_ids(start.index, np.arange(len(ages)))) == [0, 0, 1, 1, 2, 2]
+    assert list(start.transfer(np.arange(len(ages))).durations) == [1, 1, 1, 1, 2, 2]
+
+
+def test_distributions():
+    rng = np.random.default_rng(0)
+    distributions = [dist(3), dist(1, 3), dist(1, 3, 10), Discrete([1, 2, 5], [0.2, 0.5, 0.3])]
+    means = [3, 2, 3, 2.7]
+    for distribution, mean in zip(distributions, means):
+        samples = distribution.sample(100_000, rng)
+        assert abs(samples.mean() - mean) < 0.05
+        assert jsonpickle.decode(jsonpickle.encode(distribution)) == distribution
+
+    frequencies = np.bincount(distributions[-1].sample(100_000, rng), minlength=6) / 100_000
+    assert np.allclose(frequencies, [0, 0.2, 0.5, 0, 0, 0.3], atol=0.01)
+
+
+def test_step_profiler():
+    class Matrix:
+        rebuild_count = 0
+        rebuild_time = 0.0
+
+    matrix = Matrix()
+    profiler = StepProfiler(matrix)
+    for step in range(2):
+        profiler.start_step(step)
+        with profiler.phase("healthcare testing"):
+            with profiler.phase("isolation"):
+                matrix.rebuild_count += 3
+        profiler.end_step()
+
+    report = profiler.report()
+    assert list(report.index) == [0, 1]
+    assert list(report["matrix rebuilds"]) == [3, 3]
+    # the nested phase is not counted in its enclosing phase
+    assert (report["healthcare testing"] + report["isolation"] <= report["total"]).all()
+    assert (report["policies"] == 0).all()
+
+
+def test_background_writer():
+    def fail():
+        raise IOError("disk full")
+
+    written = []
+    with BackgroundWriter(max_pending=2) as writer:
+        for i in range(10):
+            writer.submit(written.append, i)
+        writer.join()
+        assert written == list(range(10))
+
+        writer.submit(fail)
+        try:
+            # the job may fail before this submit, which then raises its error
+            writer.submit(written.append, "skipped")
+            writer.join()
+        except IOError:
+            pass
+        else:
+            assert False, "the error of the job was not raised"
+
+        # the writer stays failed
+        try:
+            writer.submit(written.append, "after the error")
+        except RuntimeError:
+            pass
+        else:
+            assert False, "a failed writer took a job"
+        writer.join()
+    assert written[-1] == 9
+
+
 if __name__ == "__main__":
     test_queue()
+    test_index_queue()
+    test_pending_transfers()
+    test_age_buckets()
+    test_distributions()
+    test_step_profiler()
+    test_background_writer()
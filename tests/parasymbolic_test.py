@@ -3,8 +3,10 @@ from io import BytesIO
 from itertools import product
 
 import numpy as np
+import pytest
 from bsa.parasym import read_parasym, write_parasym
 from parasymbolic_matrix import ParasymbolicMatrix
+from scipy_matrix import ScipyMatrix
 
 
 class MockParasymbolicMatrix:
@@ -45,6 +47,25 @@ class MockParasymbolicMatrix:
             ret.append(1 - i_r)
         return ret
 
+    def prob_any_by_component(self, v):
+        ret = []
+        v = np.asanyarray(v)
+        for row in range(self.size):
+            log_not_infected = np.zeros(len(self.components))
+            for col in range(self.size):
+                total = self.get(row, col)
+                if total == 0:
+                    continue
+                # an entry that infects for sure zeroes the probability not to be infected, like in prob_any
+                with np.errstate(divide="ignore"):
+                    log_entry = np.log(max(1 - v[col] * total, 0))
+                for comp, (c, f) in enumerate(zip(self.components, self.coffs)):
+                    if c.get(row, col) * f == 0:
+                        continue
+                    log_not_infected[comp] += log_entry * c.get(row, col) * f / total
+            ret.append(1 - np.exp(log_not_infected))
+        return np.array(ret)
+
     def __imul__(self, other):
         self.coffs = [c * other for c in self.coffs]
         return self
@@ -68,21 +89,35 @@ class MockParasymbolicMatrix:
         comp, row, indices = key
         self.components[comp].arr[row][indices] = value
 
+    def set_clique(self, comp, members, strength):
+        for i, j in product(members, repeat=2):
+            if i != j:
+                self.components[comp].arr[i, j] = strength
+
     @contextmanager
     def lock_rebuild(self):
         yield self
 
 
 v = np.array([0.2, 0, 0.5], dtype=np.float32)
+# the scipy matrix only supports contagiousness of 0 or 1, like the one used in the infection
+bool_v = np.array([True, True, False])
 
 
-def check_equal(ps: ParasymbolicMatrix, mck: MockParasymbolicMatrix, msg: str):
-    for i, j in product(range(3), repeat=2):
-        p, m = ps.get(i, j), mck.get(i, j)
-        assert np.isclose(p, m), f"{msg}, [{i},{j}] {p} vs {m}"
+def check_probs(ps, mck: MockParasymbolicMatrix, msg: str, v=v, by_component=False):
     assert np.isclose(ps.total(), mck.total()), msg
     p, m = ps.prob_any(v), mck.prob_any(v)
     assert np.allclose(p, m), msg
+    if by_component:
+        p, m = ps.prob_any_by_component(v), mck.prob_any_by_component(v)
+        assert np.allclose(p, m, equal_nan=True), msg
+
+
+def check_equal(ps: ParasymbolicMatrix, mck: MockParasymbolicMatrix, msg: str, by_component=False):
+    for i, j in product(range(3), repeat=2):
+        p, m = ps.get(i, j), mck.get(i, j)
+        assert np.isclose(p, m), f"{msg}, [{i},{j}] {p} vs {m}"
+    check_probs(ps, mck, msg, by_component=by_component)
 
 
 def operate(parasym):
@@ -136,6 +171,99 @@ def test_parasym():
         check_equal(main, mock, i)
 
 
+def test_parasym_by_component():
+    if not hasattr(ParasymbolicMatrix, "prob_any_by_component"):
+        pytest.skip("this build of the matrix has no prob_any_by_component")
+    main = ParasymbolicMatrix(3, 2)
+    mock = MockParasymbolicMatrix(3, 2)
+
+    for i, j in zip(operate(main), operate(mock)):
+        assert i == j
+        check_equal(main, mock, i, by_component=True)
+
+
+def build_clique(parasym):
+    with parasym.lock_rebuild():
+        parasym[0, 0, [1]] = [0.2]
+        parasym[0, 1, [0]] = [0.2]
+        parasym.set_clique(1, [0, 2], 0.3)
+
+
+def test_clique():
+    if not hasattr(ParasymbolicMatrix, "set_clique"):
+        pytest.skip("this build of the matrix has no set_clique")
+    main = ParasymbolicMatrix(3, 2)
+    mock = MockParasymbolicMatrix(3, 2)
+    build_clique(main)
+    build_clique(mock)
+    check_equal(main, mock, "clique", by_component=hasattr(main, "prob_any_by_component"))
+
+    for parasym in (main, mock):
+        parasym.mul_sub_row(1, 2, 0.5)
+        parasym.mul_sub_col(1, 0, 0.4)
+        parasym *= 1.5
+    check_equal(main, mock, "clique coefficients", by_component=hasattr(main, "prob_any_by_component"))
+
+
+def build_overlapping_clique(parasym):
+    # the clique of the second component overlaps the connections of the first
+    with parasym.lock_rebuild():
+        parasym[0, 0, [2]] = [0.2]
+        parasym[0, 2, [0, 1]] = [0.2, 0.1]
+        parasym.set_clique(1, [0, 1, 2], 0.3)
+
+
+def test_clique_overlap():
+    if not hasattr(ParasymbolicMatrix, "set_clique"):
+        pytest.skip("this build of the matrix has no set_clique")
+    main = ParasymbolicMatrix(3, 2)
+    mock = MockParasymbolicMatrix(3, 2)
+    build_overlapping_clique(main)
+    build_overlapping_clique(mock)
+    by_component = hasattr(main, "prob_any_by_component")
+    check_equal(main, mock, "clique overlap", by_component=by_component)
+
+    for parasym in (main, mock):
+        parasym.mul_sub_row(1, 2, 0.5)
+        parasym.mul_sub_col(0, 0, 0.4)
+        parasym.mul_sub_col(1, 1, 0.7)
+    check_equal(main, mock, "clique overlap coefficients", by_component=by_component)
+
+
+def build_overlapping(parasym):
+    with parasym.lock_rebuild():
+        parasym[0, 0, [1]] = [0.2]
+        parasym[0, 1, [0]] = [0.2]
+        parasym[0, 2, [1]] = [0.6]
+
+        parasym[1, 0, [1, 2]] = [0.3, 0.1]
+        parasym[1, 2, [0, 1, 2]] = [0.5, 0.3, 0.5]
+
+
+def test_scipy_by_component():
+    scipy = ScipyMatrix(3, 2)
+    mock = MockParasymbolicMatrix(3, 2)
+    build_overlapping(scipy)
+    build_overlapping(mock)
+    check_probs(scipy, mock, "scipy by component", v=bool_v, by_component=True)
+
+
+def test_scipy_clique():
+    scipy = ScipyMatrix(3, 2)
+    mock = MockParasymbolicMatrix(3, 2)
+    build_clique(scipy)
+    build_clique(mock)
+    check_probs(scipy, mock, "scipy clique", v=bool_v, by_component=True)
+
+
+def test_scipy_clique_overlap():
+    scipy = ScipyMatrix(3, 2)
+    mock = MockParasymbolicMatrix(3, 2)
+    build_overlapping_clique(scipy)
+    build_overlapping_clique(mock)
+    check_probs(scipy, mock, "scipy clique overlap", v=bool_v, by_component=True)
+
+
 def test_read_write():
     arr = ParasymbolicMatrix(3, 2)
     with arr.lock_rebuild():
@@ -158,4 +286,10 @@ def test_read_write():
 
 
 if __name__ == "__main__":
+    test_scipy_by_component()
+    test_scipy_clique()
+    test_scipy_clique_overlap()
     test_parasym()
+    test_parasym_by_component()
+    test_clique()
+    test_clique_overlap()